@@ -28,6 +28,7 @@ import tempfile
 from cStringIO import StringIO
 from shutil import rmtree
 from time import strftime, sleep
+import threading
 
 import urllib2
 
@@ -36,6 +37,7 @@ from elasticsearch import Elasticsearch, ConnectionError, NotFoundError
 
 from rules.models import get_es_address
 from rules.es_graphs import get_es_major_version
+from rules.es_query import ESQuery
 
 # Avoid logging every request
 es_logger = logging.getLogger('elasticsearch')
@@ -356,10 +358,26 @@ KIBANA6_NAMESPACE = {
     "color": "#00bfb3",
 }
 
+_es_client = None
+_es_client_lock = threading.Lock()
+
+
+def get_es_client():
+    # Client shared by the process, so connections to ES are kept alive. It
+    # is created again when ES address changes in system settings.
+    global _es_client
+    es_addr = get_es_address()
+    with _es_client_lock:
+        if _es_client is None or _es_client[0] != es_addr:
+            client = Elasticsearch([es_addr], timeout=ESQuery.TIMEOUT, maxsize=settings.ELASTICSEARCH_POOL_SIZE,
+                                   http_compress=True)
+            _es_client = (es_addr, client)
+        return _es_client[1]
+
+
 class ESData(object):
     def __init__(self):
-        es_addr = get_es_address()
-        self.client = Elasticsearch([es_addr])
+        self.client = get_es_client()
 
     def _kibana_request(self, url, data):
         headers = {
@@ -21,38 +21,49 @@ along with Scirius.  If not, see <http://www.gnu.org/licenses/>.
 from __future__ import unicode_literals
 from django.conf import settings
 from django.template.defaultfilters import filesizeformat
+from django.utils.safestring import mark_safe
 from datetime import datetime
 
 import socket
-import requests
 import json
 from time import time, mktime
 import math
 
-from rules.es_query import ESQuery
+from rules.es_query import ESQuery, es_logger, get_es_transport
 from rules.models import get_es_address, get_es_path
 from scirius.utils import merge_dict_deeply
 
 
 ES_VERSION = None
+# time of the next version request, when ES could not be reached
+ES_VERSION_RETRY = None
+ES_VERSION_RETRY_DELAY = 60
 def get_es_major_version():
-    global ES_VERSION
+    global ES_VERSION, ES_VERSION_RETRY
     if ES_VERSION is not None:
         return ES_VERSION[0]
 
+    # templates of queries are selected by version, a request to ES
+    # failing for each query would double its duration
+    if ES_VERSION_RETRY is not None and time() < ES_VERSION_RETRY:
+        return 6
+
     try:
         es_stats = ESStats(None).get()
         es_version = es_stats['nodes']['versions'][0].split('.')
     except (TypeError, ValueError, ESError):
+        ES_VERSION_RETRY = time() + ES_VERSION_RETRY_DELAY
         return 6
 
     ES_VERSION = [int(v) for v in es_version]
+    ES_VERSION_RETRY = None
     return ES_VERSION[0]
 
 
 def reset_es_version():
-    global ES_VERSION
+    global ES_VERSION, ES_VERSION_RETRY
     ES_VERSION = None
+    ES_VERSION_RETRY = None
 
 
 def get_top_query():
@@ -1327,7 +1338,7 @@ SIGS_LIST_HITS = """
             "constant_score" : {
                 "filter" : {
                     "terms" : { 
-                        "alert.signature_id" : [{{ sids }}]
+                        "alert.signature_id" : {{ sids }}
                      }
                 }
             }
@@ -1420,7 +1431,7 @@ STATS_URL = "/_cluster/stats"
 INDICES_STATS_DOCS_URL = "/_stats/docs"
 INDICES_STATS_SIZE_URL = "/_stats/store"
 DELETE_ALERTS_URL = "/%s*/_query?q=alert.signature_id:%%d" % settings.ELASTICSEARCH_LOGSTASH_ALERT_INDEX
-DELETE_ALERTS_URL_V5 = "%s*/_delete_by_query" % settings.ELASTICSEARCH_LOGSTASH_ALERT_INDEX
+DELETE_ALERTS_URL_V5 = "%s*/_delete_by_query?wait_for_completion=false" % settings.ELASTICSEARCH_LOGSTASH_ALERT_INDEX
 
 from rules.models import Rule
 from rules.tables import ExtendedRuleTable, RuleStatsTable
@@ -1434,6 +1445,8 @@ class ESError(Exception):
 
 
 class ESRulesStats(ESQuery):
+    CACHE = True
+
     def get(self, count=20, dict_format=False):
         data = self._render_template(get_top_query(), {'count': count, 'field': 'alert.signature_id'})
         es_url = self._get_es_url()
@@ -1458,21 +1471,22 @@ class ESRulesStats(ESQuery):
 
         rules = []
         if data != None:
-            for elt in data:
-                try:
-                    if get_es_major_version() >= 2:
-                        sid=elt['key']
-                    else:
-                        sid=elt['term']
-                    rule = Rule.objects.get(sid=sid)
-                except:
-                    print "Can not find rule with sid %s" % sid
+            if get_es_major_version() >= 2:
+                hits = [(elt['key'], elt['doc_count']) for elt in data]
+            else:
+                hits = [(elt['term'], elt['count']) for elt in data]
+
+            rules_by_sid = Rule.objects.in_bulk([sid for sid, _ in hits])
+            missing = []
+            for sid, count in hits:
+                rule = rules_by_sid.get(sid)
+                if rule is None:
+                    missing.append(sid)
                     continue
-                if get_es_major_version() >= 2:
-                    rule.hits = elt['doc_count']
-                else:
-                    rule.hits = elt['count']
+                rule.hits = count
                 rules.append(rule)
+            if missing:
+                es_logger.warning('Can not find %d rules with hits: %s' % (len(missing), ', '.join(unicode(sid) for sid in missing)))
             rules = ExtendedRuleTable(rules)
             tables.RequestConfig(self.request).configure(rules)
         else:
@@ -1481,6 +1495,8 @@ class ESRulesStats(ESQuery):
         return rules
 
 class ESFieldStats(ESQuery):
+    CACHE = True
+
     def get(self, sid, field, count=20, dict_format=False):
         data = self._render_template(get_top_query(), {'count': count, 'field': field, 'sid': sid})
         es_url = self._get_es_url()
@@ -1527,6 +1543,8 @@ class ESFieldStatsAsTable(ESQuery):
 
 
 class ESSidByHosts(ESQuery):
+    CACHE = True
+
     def get(self, sid, count=20, dict_format=False):
         data = self._render_template(get_sid_by_host_query(), {'rule_sid': sid, 'alerts_number': count})
         es_url = self._get_es_url()
@@ -1560,6 +1578,8 @@ class ESSidByHosts(ESQuery):
 
 
 class ESTimeline(ESQuery):
+    CACHE = True
+
     def get(self, tags=False):
         # 100 points on graph per default
         if not tags:
@@ -1594,6 +1614,8 @@ class ESTimeline(ESQuery):
 
 
 class ESMetricsTimeline(ESQuery):
+    CACHE = True
+
     def get(self, value="eve.total.rate_1m"):
         # 100 points on graph per default
         data = self._render_template(get_stats_query(), {'value': value})
@@ -1628,6 +1650,8 @@ class ESMetricsTimeline(ESQuery):
 
 
 class ESPoststats(ESQuery):
+    CACHE = True
+
     def get(self, value = "poststats.rule_filter_1"):
         data = self._render_template(POSTSTATS_SUMMARY, {'filter': value})
         es_url = self._get_es_url(data='poststats')
@@ -1679,6 +1703,8 @@ def compact_tree(tree):
 
 
 class ESRulesPerCategory(ESQuery):
+    CACHE = True
+
     def get(self):
         data = self._render_template(get_rules_per_category(), {})
         es_url = self._get_es_url()
@@ -1697,16 +1723,16 @@ class ESRulesPerCategory(ESQuery):
 def es_delete_alerts_by_sid_v2(sid):
     delete_url = get_es_path(DELETE_ALERTS_URL) % int(sid)
     try:
-        r = requests.delete(delete_url)
+        r = get_es_transport().request('DELETE', delete_url, timeout=settings.ELASTICSEARCH_DELETE_TIMEOUT)
     except Exception, err:
         return {'msg': 'Elasticsearch error: %s' % err, 'status': 500 }
-    if r.status_code == 200:
-        data = json.loads(r.text)
+    if r.status == 200:
+        data = json.loads(r.data)
         return data
-    elif r.status_code == 400:
-        return {'msg': 'Elasticsearch 2.x needs to have delete-by-plugin installed to delete alerts for a rule.', 'status': r.status_code }
+    elif r.status == 400:
+        return {'msg': 'Elasticsearch 2.x needs to have delete-by-plugin installed to delete alerts for a rule.', 'status': r.status }
     else:
-        return {'msg': 'Unknown error', 'status': r.status_code }
+        return {'msg': 'Unknown error', 'status': r.status }
 
 
 def es_delete_alerts_by_sid_v5(sid):
@@ -1714,17 +1740,18 @@ def es_delete_alerts_by_sid_v5(sid):
     data = { "query": { "match": { "alert.signature_id": sid } } }
     try:
         headers = {'content-type': 'application/json'}
-        r = requests.post(delete_url, data = json.dumps(data), headers=headers)
+        r = get_es_transport().request('POST', delete_url, body=json.dumps(data), headers=headers,
+                                       timeout=settings.ELASTICSEARCH_DELETE_TIMEOUT)
     except Exception, err:
         return {'msg': 'Elasticsearch error: %s' % err, 'status': 500 }
-    if r.status_code == 200:
-        data = json.loads(r.text)
+    if r.status == 200:
+        data = json.loads(r.data)
         data['status'] = 200
         return data
-    elif r.status_code == 400:
-        return {'msg': r.text, 'status': r.status_code }
+    elif r.status == 400:
+        return {'msg': r.data.decode('utf-8', 'replace'), 'status': r.status }
     else:
-        return {'msg': 'Unknown error', 'status': r.status_code }
+        return {'msg': 'Unknown error', 'status': r.status }
 
 
 class ESDeleteAlertsBySid(ESQuery):
@@ -1736,6 +1763,8 @@ class ESDeleteAlertsBySid(ESQuery):
 
 
 class ESAlertsCount(ESQuery):
+    CACHE = True
+
     def get(self, prev = 0):
         if prev:
             templ = get_alerts_trend_per_host()
@@ -1745,7 +1774,7 @@ class ESAlertsCount(ESQuery):
         if prev:
             # compute delta with now and from_date
             from_datetime = datetime.fromtimestamp(self._from_date() / 1000)
-            start_datetime = from_datetime - (datetime.now() - from_datetime)
+            start_datetime = from_datetime - (datetime.fromtimestamp(self._now() / 1000) - from_datetime)
             start_date = mktime(start_datetime.timetuple()) * 1000
             context['start_date'] = start_date
             es_url = self._get_es_url(from_date=start_date)
@@ -1775,6 +1804,8 @@ class ESLatestStats(ESQuery):
 
 
 class ESIppairAlerts(ESQuery):
+    CACHE = True
+
     def get(self):
         data = self._render_template(get_ippair_alerts_count(), {})
         es_url = self._get_es_url()
@@ -1805,6 +1836,8 @@ class ESIppairAlerts(ESQuery):
 
 
 class ESIppairNetworkAlerts(ESQuery):
+    CACHE = True
+
     def get(self):
         data = self._render_template(get_ippair_netinfo_alerts_count(), {})
         es_url = self._get_es_url()
@@ -1867,6 +1900,8 @@ class ESSuriLogTail(ESQuery):
 
 
 class ESTopRules(ESQuery):
+    CACHE = True
+
     def get(self, count=20, order="desc"):
         data = self._render_template(TOP_ALERTS, {'count': count, 'order': order})
         es_url = self._get_es_url()
@@ -1878,9 +1913,15 @@ class ESTopRules(ESQuery):
 
 
 class ESSigsListHits(ESQuery):
+    CACHE = True
+
     def get(self, sids, order="desc"):
-        count = len(sids.split(','))
-        data = self._render_template(SIGS_LIST_HITS, {'sids': sids, 'count': count})
+        # sids is a list or a comma separated string of signature ids,
+        # ValueError is raised on any other value
+        if isinstance(sids, basestring):
+            sids = sids.split(',')
+        sids = [int(sid) for sid in sids]
+        data = self._render_template(SIGS_LIST_HITS, {'sids': mark_safe(json.dumps(sids)), 'count': len(sids)})
         es_url = self._get_es_url()
         data = self._urlopen(es_url, data)
         try:
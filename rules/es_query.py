@@ -1,15 +1,19 @@
 from __future__ import unicode_literals
 
+from collections import OrderedDict
 from datetime import datetime, timedelta
 from time import time
+import hashlib
 import json
 import logging
-import socket
+import sys
+import threading
+import urlparse
 
 from django.conf import settings
 from django.template import Context, Template
-from django.utils.safestring import mark_safe
-import urllib2
+from django.utils.safestring import SafeData, mark_safe
+import urllib3
 
 from rules.models import get_es_address
 from scirius.utils import get_middleware_module
@@ -19,11 +23,148 @@ from scirius.utils import get_middleware_module
 es_logger = logging.getLogger('elasticsearch')
 
 
+class ESTransport(object):
+    # HTTP connections to ES, pooled by host and kept alive between requests.
+    # Responses are gzip compressed by ES and decompressed here. Thread safe,
+    # one instance is shared by the process.
+    def __init__(self, maxsize, timeout):
+        self.timeout = timeout
+        self.pool = urllib3.PoolManager(maxsize=maxsize, retries=False)
+
+    def request(self, method, url, body=None, headers=None, timeout=None):
+        # HTTP errors are returned, only connection errors and timeouts raise
+        # an urllib3.exceptions.HTTPError
+        req_headers = {'accept-encoding': 'gzip'}
+        req_headers.update(headers or {})
+        timeout = urllib3.Timeout(total=timeout or self.timeout)
+        return self.pool.urlopen(method, url, body=body, headers=req_headers, timeout=timeout,
+                                 preload_content=True, decode_content=True)
+
+    def close(self):
+        self.pool.clear()
+
+
+_es_transport = None
+_es_transport_lock = threading.Lock()
+
+
+def get_es_transport():
+    global _es_transport
+    with _es_transport_lock:
+        if _es_transport is None:
+            _es_transport = ESTransport(settings.ELASTICSEARCH_POOL_SIZE, ESQuery.TIMEOUT)
+        return _es_transport
+
+
+class ESQueryCache(object):
+    # Responses of ES searches by digest of their indexes and body. Most
+    # recently used responses are kept in memory up to max_size bytes, each
+    # one until the timeout given when it is stored.
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self.responses = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def key(header, body):
+        return hashlib.sha1(header.encode('utf-8') + b'\n' + body.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        # responses are stored serialized, so callers get their own copy
+        with self.lock:
+            entry = self.responses.pop(key, None)
+            if entry is not None and entry[0] <= time():
+                self.size -= len(entry[1])
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.responses[key] = entry
+            self.hits += 1
+        return json.loads(entry[1])
+
+    def set(self, key, data, timeout):
+        if timeout <= 0 or len(data) > self.max_size:
+            return
+        with self.lock:
+            previous = self.responses.pop(key, None)
+            if previous is not None:
+                self.size -= len(previous[1])
+            self.responses[key] = (time() + timeout, data)
+            self.size += len(data)
+            while self.size > self.max_size:
+                _, evicted = self.responses.popitem(last=False)
+                self.size -= len(evicted[1])
+                self.evictions += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(self.responses),
+                'size': self.size,
+                'max_size': self.max_size,
+            }
+
+    def clear(self):
+        with self.lock:
+            self.responses.clear()
+            self.size = 0
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+
+_es_query_cache = None
+_es_query_cache_lock = threading.Lock()
+
+
+def get_es_query_cache():
+    global _es_query_cache
+    with _es_query_cache_lock:
+        if _es_query_cache is None:
+            _es_query_cache = ESQueryCache(settings.ELASTICSEARCH_CACHE_SIZE)
+        return _es_query_cache
+
+
+_query_templates = {}
+_query_templates_lock = threading.Lock()
+
+
+def get_query_template(tmpl):
+    # Templates of queries are few (one by query type and ES version), they
+    # are compiled once and rendered on each request
+    compiled = _query_templates.get(tmpl)
+    if compiled is None:
+        compiled = Template(tmpl)
+        with _query_templates_lock:
+            compiled = _query_templates.setdefault(tmpl, compiled)
+    return compiled
+
+
+def es_string(value):
+    # value escaped to be put in a JSON string of a template
+    return mark_safe(json.dumps(value)[1:-1])
+
+
+def es_phrase(value):
+    # value as a phrase of a query string, in a JSON string of a template
+    return es_string('"%s"' % value.replace('\\', '\\\\').replace('"', '\\"'))
+
+
 class ESQuery(object):
     TIMEOUT = 30
     MAX_RESULT_WINDOW = 10000
     URL = "%s%s/_search?ignore_unavailable=true"
     INTERVAL_POINTS = 100
+    # responses of the searches are cached, for aggregations only
+    CACHE = False
 
     def __init__(self, request):
         self.request = request
@@ -86,7 +227,7 @@ class ESQuery(object):
             from_date = int(self.request.GET['from_date'])
         else:
             # 30 days ago
-            from_date = (time() - (30 * 24 * 60 * 60)) * 1000
+            from_date = self._now() - (30 * 24 * 60 * 60) * 1000
 
         if from_date >= self._to_date():
             # Asking for a date in the future (browser of the user has clock out of sync), return last hour
@@ -106,9 +247,21 @@ class ESQuery(object):
             if es_format:
                 return '"now"'
             else:
-                return time() * 1000
+                return self._now()
         return to_date
 
+    def _now(self):
+        # Current time in ms, rounded to the timeout of cached responses of
+        # windows ending now, so that their queries are the same meanwhile
+        bucket = max(settings.ELASTICSEARCH_CACHE_LIVE_TIMEOUT, 1)
+        return int(time() / bucket) * bucket * 1000
+
+    def _cache_timeout(self):
+        # recent events may not be indexed yet in windows ending lately
+        if self._now() - self._to_date() < settings.ELASTICSEARCH_CACHE_LIVE_DELAY * 1000:
+            return settings.ELASTICSEARCH_CACHE_LIVE_TIMEOUT
+        return settings.ELASTICSEARCH_CACHE_TIMEOUT
+
     def _interval(self):
         if self.request and 'interval' in self.request.GET:
             interval = int(self.request['interval']) * 1000
@@ -136,8 +289,7 @@ class ESQuery(object):
         hosts = []
         for host in hosts_list:
             if host != '*':
-                host = json.dumps(host).replace('"', '\\"')
-                host = mark_safe(host)
+                host = es_phrase(host)
             hosts.append(host)
 
         if hosts == ['*']:
@@ -148,9 +300,7 @@ class ESQuery(object):
             hosts_filter = mark_safe('(%s)' % ' '.join(hosts_filter))
 
         if qfilter is not None:
-            query_filter = " AND " + qfilter
-            # dump as json but remove quotes since the quotes are already set in templates
-            query_filter = mark_safe(json.dumps(query_filter)[1:-1])
+            query_filter = es_string(" AND " + qfilter)
         else:
             query_filter = ''
 
@@ -159,8 +309,13 @@ class ESQuery(object):
         else:
             bool_clauses = get_middleware_module('common').es_bool_clauses(self.request)
 
-        templ = Template(tmpl)
-        context = Context(dictionary)
+        templ = get_query_template(tmpl)
+        context = Context()
+        for key, value in dictionary.iteritems():
+            # strings can't get out of the JSON strings of templates
+            if isinstance(value, basestring) and not isinstance(value, SafeData):
+                value = es_string(value)
+            context[key] = value
         context.update({
             'hosts': hosts,
             'hosts_filter': hosts_filter,
@@ -176,39 +331,63 @@ class ESQuery(object):
 
     def _urlopen(self, url, data=None, method=None, contenttype='application/json'):
         from rules.es_graphs import ESError
+        query = getattr(_multi_search, 'query', None)
+        cache_key = None
+        if self.CACHE:
+            entry = _search_entry(url, data, method)
+            if entry is not None:
+                cache_key = ESQueryCache.key(*entry)
+            # the search replayed by a multi search was already looked up
+            if cache_key is not None and (query is None or query.state != _MultiSearchQuery.REPLAY):
+                response = get_es_query_cache().get(cache_key)
+                if response is not None:
+                    return response
+
+        if query is not None:
+            response = query.intercept(url, data, method)
+            if response is not None:
+                if cache_key is not None:
+                    get_es_query_cache().set(cache_key, json.dumps(response), self._cache_timeout())
+                return response
+
         headers = {'content-type': contenttype}
-        req = urllib2.Request(url, data, headers)
-        if method is not None:
-            req.get_method = lambda: method
+        if method is None:
+            if data:
+                method = 'POST'
+            else:
+                method = 'GET'
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        elif data is not None:
+            data = bytes(data)
 
         try:
-            out = urllib2.urlopen(req, timeout=self.TIMEOUT)
-        except (urllib2.URLError, urllib2.HTTPError, socket.timeout) as e:
+            out = get_es_transport().request(method, url, data, headers, timeout=self.TIMEOUT)
+        except urllib3.exceptions.HTTPError as e:
             msg = url + '\n'
-            if isinstance(e, socket.timeout):
+            if isinstance(e, urllib3.exceptions.TimeoutError):
                 msg += 'Request timeout'
-            elif isinstance(e, urllib2.HTTPError):
-                msg += '%s %s\n%s\n\n%s' % (e.code, e.reason, e, data)
             else:
                 msg += repr(e)
             es_logger.exception(msg)
             raise ESError(msg, e)
-        else:
-            if settings.DEBUG:
-                if method is None:
-                    if data:
-                        method = 'POST'
-                    else:
-                        method = 'GET'
-                if data:
-                    data = '-- ' + data.decode('utf-8').replace('\n', '\n-- ')
-                else:
-                    data = '-- No data'
-                es_logger.info('%s %s\n%s' % (method, url, data))
 
-        out = out.read()
-        out = json.loads(out)
-        return out
+        if out.status >= 400:
+            msg = url + '\n'
+            msg += '%s %s\n%s\n\n%s' % (out.status, out.reason, out.data.decode('utf-8', 'replace'), data)
+            es_logger.error(msg)
+            raise ESError(msg)
+
+        if settings.DEBUG:
+            if data:
+                data = '-- ' + data.decode('utf-8').replace('\n', '\n-- ')
+            else:
+                data = '-- No data'
+            es_logger.info('%s %s\n%s' % (method, url, data))
+
+        if cache_key is not None:
+            get_es_query_cache().set(cache_key, out.data, self._cache_timeout())
+        return json.loads(out.data)
 
     def _scroll_query(self, es_url, query):
         count = None
@@ -270,3 +449,155 @@ class ESQuery(object):
 
     def get(self, *args, **kwargs):
         raise NotImplementedError('get method of ESQuery must be overriden')
+
+
+# query of a multi search being run by the thread
+_multi_search = threading.local()
+
+
+class _SearchCaptured(Exception):
+    pass
+
+
+def _search_entry(url, data, method):
+    # Returns the header and body of the _msearch entry of a search request,
+    # or None when the request can't be part of a multi search or be cached
+    address = get_es_address()
+    if method not in (None, 'POST') or not data or not url.startswith(address):
+        return None
+
+    path, _, params = url[len(address):].partition('?')
+    index, _, endpoint = path.rpartition('/')
+    if endpoint != '_search' or not index:
+        return None
+
+    header = {'index': index}
+    for key, value in urlparse.parse_qsl(params):
+        if key not in ESMultiSearch.SEARCH_PARAMS:
+            return None
+        header[key] = {'true': True, 'false': False}.get(value, value)
+
+    if not isinstance(data, unicode):
+        data = bytes(data).decode('utf-8')
+    try:
+        # entries of a _msearch must fit on a line
+        body = json.dumps(json.loads(data))
+    except ValueError:
+        return None
+    return json.dumps(header, sort_keys=True), body
+
+
+class _MultiSearchQuery(object):
+    CAPTURE = 'capture'
+    REPLAY = 'replay'
+    DONE = 'done'
+
+    def __init__(self, func, args, kwargs):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.state = self.CAPTURE
+        self.url = None
+        self.entry = None
+        self.response = None
+        self.result = None
+        self.exc_info = None
+
+    def intercept(self, url, data, method):
+        # Called for each request of the query, returns its response or None
+        # to send it to ES
+        if self.state == self.DONE:
+            return None
+
+        entry = _search_entry(url, data, method)
+        if entry is None:
+            return None
+
+        if self.state == self.CAPTURE:
+            self.url = url
+            self.entry = entry
+            raise _SearchCaptured()
+
+        self.state = self.DONE
+        if isinstance(self.response, Exception):
+            raise self.response
+        return self.response
+
+    def run(self):
+        _multi_search.query = self
+        try:
+            self.result = self.func(*self.args, **self.kwargs)
+            self.exc_info = None
+        except _SearchCaptured:
+            pass
+        except Exception:
+            self.exc_info = sys.exc_info()
+        finally:
+            _multi_search.query = None
+
+
+class ESMultiSearch(object):
+    # Sends the searches of independent ES queries with a single _msearch
+    # request. Queries are run twice: a first time to capture their search
+    # request, which is interrupted, then once the _msearch answered, to
+    # post-process the response of their search. Other requests, and
+    # searches following the first one of a query, are sent normally.
+    SEARCH_PARAMS = ('ignore_unavailable', 'preference', 'routing', 'search_type')
+
+    def __init__(self):
+        self.queries = []
+
+    def add(self, func, *args, **kwargs):
+        # func is any callable making ES requests, ie. ESTimeline(request).get
+        # Returns the index of the query
+        self.queries.append(_MultiSearchQuery(func, args, kwargs))
+        return len(self.queries) - 1
+
+    def _msearch(self, queries):
+        from rules.es_graphs import ESError
+        lines = []
+        for query in queries:
+            lines.extend(query.entry)
+        data = '\n'.join(lines) + '\n'
+
+        try:
+            responses = ESQuery(None)._urlopen(get_es_address() + '_msearch', data,
+                                               contenttype='application/x-ndjson')['responses']
+        except ESError as e:
+            return [e] * len(queries)
+
+        if len(responses) != len(queries):
+            e = ESError('Unexpected number of responses in _msearch: %d instead of %d' % (len(responses), len(queries)))
+            return [e] * len(queries)
+
+        results = []
+        for query, response in zip(queries, responses):
+            if 'error' in response:
+                msg = query.url + '\n'
+                msg += '%s\n%s\n\n%s' % (response.get('status'), json.dumps(response['error']), query.entry[1])
+                es_logger.error(msg)
+                results.append(ESError(msg))
+            else:
+                response.pop('status', None)
+                results.append(response)
+        return results
+
+    def run(self):
+        for query in self.queries:
+            query.run()
+
+        captured = [query for query in self.queries if query.entry is not None]
+        if not captured:
+            return
+
+        for query, response in zip(captured, self._msearch(captured)):
+            query.state = _MultiSearchQuery.REPLAY
+            query.response = response
+            query.run()
+
+    def result(self, index):
+        # Returns the result of a query, or raises its exception
+        query = self.queries[index]
+        if query.exc_info is not None:
+            raise query.exc_info[0], query.exc_info[1], query.exc_info[2]
+        return query.result
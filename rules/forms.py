@@ -76,7 +76,7 @@ class SourceForm(forms.ModelForm, CommentForm):
                               widget = forms.PasswordInput(render_value = True))
     class Meta:
         model = Source
-        exclude = ['created_date', 'updated_date', 'cats_count', 'rules_count', 'public_source']
+        exclude = ['created_date', 'updated_date', 'cats_count', 'rules_count', 'public_source', 'imported_version', 'http_etag', 'http_last_modified', 'content_digest']
 
 class AddSourceForm(forms.ModelForm, RulesetChoiceForm):
     file  = forms.FileField(required = False)
@@ -87,7 +87,7 @@ class AddSourceForm(forms.ModelForm, RulesetChoiceForm):
 
     class Meta:
         model = Source
-        exclude = ['created_date', 'updated_date', 'cats_count', 'rules_count', 'public_source']
+        exclude = ['created_date', 'updated_date', 'cats_count', 'rules_count', 'public_source', 'imported_version', 'http_etag', 'http_last_modified', 'content_digest']
 
     def __init__(self, *args, **kwargs):
         super(AddSourceForm, self).__init__(*args, **kwargs)
@@ -101,7 +101,7 @@ class AddPublicSourceForm(forms.ModelForm, RulesetChoiceForm):
 
     class Meta:
         model = Source
-        exclude = ['created_date', 'updated_date', 'cats_count', 'rules_count', 'method', 'datatype']
+        exclude = ['created_date', 'updated_date', 'cats_count', 'rules_count', 'method', 'datatype', 'imported_version', 'http_etag', 'http_last_modified', 'content_digest']
 
     def __init__(self, *args, **kwargs):
         super(AddPublicSourceForm, self).__init__(*args, **kwargs)
@@ -0,0 +1,149 @@
+"""
+Copyright(C) 2018 Stamus Networks
+
+This file is part of Scirius.
+
+Scirius is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Scirius is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Scirius.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from __future__ import unicode_literals
+from importlib import import_module
+import threading
+import socket
+import os
+import psutil
+
+from django.conf import settings
+from django.db import close_old_connections, connection
+
+from rules.models import Job, Source, Ruleset, UserAction
+
+
+# Functions of the jobs by name
+JOBS = {
+    'update_source': 'rules.jobs.update_source',
+    'test_ruleset': 'rules.jobs.test_ruleset',
+    'update_push_all': 'suricata.jobs.update_push_all',
+}
+
+
+def get_job_function(name):
+    module, func = JOBS[name].rsplit('.', 1)
+    return getattr(import_module(module), func)
+
+
+def update_source(job, source, comment=None):
+    source = Source.objects.get(pk=source)
+    job.set_progress(0, 'Updating source "%s"' % source.name)
+    source.update(progress=job.set_progress)
+    UserAction.create(action_type='update_source', comment=comment, user=job.user, source=source)
+    return {'update': 'ok'}
+
+
+def test_ruleset(job, ruleset):
+    ruleset = Ruleset.objects.get(pk=ruleset)
+    job.set_progress(0, 'Testing ruleset "%s"' % ruleset.name)
+    return ruleset.test(progress=job.set_progress)
+
+
+class JobRunner(object):
+    # Runs pending jobs in worker threads. Jobs are claimed in the database,
+    # so that runners of several processes (web server, runjobs command) can
+    # share them without any broker. Workers look for new jobs when woken up
+    # by a submission in the same process, or every poll_interval seconds.
+    # Web processes start their runner when the application is loaded (see
+    # scirius/wsgi.py), the runjobs command is only needed with JOBS_WORKERS
+    # set to 0.
+    CLAIM_CANDIDATES = 10
+
+    def __init__(self, workers, poll_interval):
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.worker = '%s:%d' % (socket.gethostname(), os.getpid())
+        self.threads = []
+        self.event = threading.Event()
+        self.lock = threading.Lock()
+        self.closed = False
+
+    def recover(self):
+        # jobs of dead processes of this host (recycled or crashed web
+        # workers) will never end, they are run again
+        host = socket.gethostname()
+        for job in Job.objects.filter(status=Job.RUNNING, worker__startswith=host + ':'):
+            pid = int(job.worker.rsplit(':', 1)[1])
+            if pid != os.getpid() and not psutil.pid_exists(pid):
+                job.requeue()
+
+    def run_next(self):
+        # Runs the oldest pending job, returns False if there is none
+        candidates = Job.objects.filter(status=Job.PENDING).order_by('pk')[:self.CLAIM_CANDIDATES]
+        for job in candidates:
+            if job.claim(self.worker):
+                job.run()
+                return True
+        return False
+
+    def run_pending(self):
+        while self.run_next():
+            pass
+
+    def _work(self):
+        try:
+            while not self.closed:
+                try:
+                    close_old_connections()
+                    if self.run_next():
+                        continue
+                    self.recover()
+                except Exception:
+                    # database unavailable, try again later
+                    pass
+                self.event.wait(self.poll_interval)
+                self.event.clear()
+        finally:
+            connection.close()
+
+    def start(self):
+        with self.lock:
+            if self.threads or self.workers < 1:
+                return
+            self.recover()
+            for _ in xrange(self.workers):
+                thread = threading.Thread(target=self._work)
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+
+    def wake(self):
+        self.start()
+        self.event.set()
+
+    def close(self):
+        self.closed = True
+        self.event.set()
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+
+_job_runner = None
+_job_runner_lock = threading.Lock()
+
+
+def get_job_runner():
+    global _job_runner
+    with _job_runner_lock:
+        if _job_runner is None:
+            _job_runner = JobRunner(settings.JOBS_WORKERS, settings.JOBS_POLL_INTERVAL)
+        return _job_runner
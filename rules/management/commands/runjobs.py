@@ -0,0 +1,50 @@
+"""
+Copyright(C) 2018 Stamus Networks
+
+This file is part of Scirius.
+
+Scirius is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Scirius is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Scirius.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from __future__ import unicode_literals
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+import time
+
+from rules.jobs import JobRunner
+
+
+class Command(BaseCommand):
+    help = 'Run background jobs (source updates, ruleset tests, pushes).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=2, help='Number of jobs run concurrently')
+        parser.add_argument('--once', action='store_true', default=False, help='Run pending jobs and exit')
+
+    def handle(self, *args, **options):
+        if options['workers'] < 1:
+            raise CommandError('Workers must be positive')
+        runner = JobRunner(options['workers'], settings.JOBS_POLL_INTERVAL)
+        if options['once']:
+            runner.recover()
+            runner.run_pending()
+            return
+
+        runner.start()
+        self.stdout.write('Running jobs with %d workers' % options['workers'])
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            runner.close()
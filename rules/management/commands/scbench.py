@@ -0,0 +1,307 @@
+"""
+Copyright(C) 2018 Stamus Networks
+
+This file is part of Scirius.
+
+Scirius is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Scirius is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Scirius.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from __future__ import unicode_literals
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.http import HttpRequest
+from django.test.utils import override_settings
+from django.utils import timezone
+from idstools import rule as rule_idstools
+from multiprocessing import cpu_count
+import tempfile
+import os
+import shutil
+import time
+import re
+
+from rules.models import Source, SourceAtVersion, Category, Rule, Ruleset, Transformation, RulesetTransformations
+from rules import es_graphs, es_query
+from rules.rule_parser import RuleParser
+from rules.tests_rules import TestRules, TestSandbox, TestSandboxPool
+
+
+RULE_TEMPLATE = 'alert http $EXTERNAL_NET any -> $HOME_NET any (msg:"ET BENCH Synthetic rule %(sid)d"; \
+flow:established,to_client; content:"bench|3b| %(sid)d"; http_header; %(bits)sclasstype:trojan-activity; \
+sid:%(sid)d; rev:%(rev)d; metadata:affected_product Any, attack_target Client_Endpoint, deployment Perimeter, \
+created_at 2018_01_01, updated_at 2018_06_01;)\n'
+
+
+def generate_rules(count, start_sid=3000000, rev=1):
+    for i in xrange(count):
+        sid = start_sid + i
+        if i % 10 == 0:
+            bits = 'flowbits:set,bench.%d; flowbits:noalert; ' % (i / 10)
+        elif i % 10 == 1:
+            bits = 'flowbits:isset,bench.%d; ' % (i / 10)
+        else:
+            bits = ''
+        line = RULE_TEMPLATE % {'sid': sid, 'rev': rev, 'bits': bits}
+        if i % 50 == 0:
+            line = '# ' + line
+        yield line
+
+
+def write_rules_file(count, **kwargs):
+    rfile = tempfile.NamedTemporaryFile(suffix='.rules')
+    for line in generate_rules(count, **kwargs):
+        rfile.write(line.encode('utf-8'))
+    rfile.flush()
+    return rfile
+
+
+class Command(BaseCommand):
+    help = 'Run micro benchmarks on Scirius internals.'
+
+    TARGETS = ('parser', 'parallel', 'generate', 'validate', 'esquery')
+
+    def add_arguments(self, parser):
+        parser.add_argument('target', choices=self.TARGETS, help='Benchmark to run')
+        parser.add_argument('--rules', type=int, default=40000, help='Number of synthetic rules')
+        parser.add_argument('--iterations', type=int, default=3, help='Number of runs (best is reported)')
+        parser.add_argument('--files', type=int, default=40, help='Number of rules files (parallel target)')
+        parser.add_argument('--workers', type=int, default=cpu_count(), help='Number of parser processes (parallel target)')
+        parser.add_argument('--tests', type=int, default=32, help='Number of suricata tests (validate target)')
+        parser.add_argument('--stub-delay', type=float, default=0.05, help='Duration of a stub suricata test (validate target)')
+        parser.add_argument('--renders', type=int, default=200, help='Number of renders by query type (esquery target)')
+        parser.add_argument('--es-version', type=int, default=6, help='Major version of ES of the queries (esquery target)')
+
+    def handle(self, *args, **options):
+        self.rules = options['rules']
+        self.iterations = options['iterations']
+        self.files = options['files']
+        self.workers = options['workers']
+        self.tests = options['tests']
+        self.stub_delay = options['stub_delay']
+        self.renders = options['renders']
+        self.es_version = options['es_version']
+        if self.iterations < 1:
+            raise CommandError('Iterations must be positive')
+        getattr(self, 'bench_%s' % options['target'])()
+
+    def timeit(self, label, func):
+        best = None
+        for _ in xrange(self.iterations):
+            start = time.time()
+            func()
+            duration = time.time() - start
+            if best is None or duration < best:
+                best = duration
+        self.stdout.write('%-30s %8.3fs' % (label, best))
+        return best
+
+    def bench_parser(self):
+        getsid = re.compile("sid *: *(\d+)")
+        getrev = re.compile("rev *: *(\d+)")
+        getmsg = re.compile("msg *: *\"(.*?)\"")
+        bitsregexp = dict([(key, re.compile("%s *: *(isset|set),(.*?) *;" % key)) for key in RuleParser.BITS_TYPES])
+
+        rfile = write_rules_file(self.rules)
+
+        # Import path before the single pass parser: 3 regexps per line, then
+        # idstools for metadata and one regexp per bits type
+        def legacy():
+            with open(rfile.name) as f:
+                for line in f.readlines():
+                    line = line.decode('utf-8')
+                    if line.startswith('#'):
+                        if "->" in line and "sid" in line and ")" in line:
+                            line = line.lstrip("# ")
+                        else:
+                            continue
+                    match = getsid.search(line)
+                    if not match:
+                        continue
+                    getrev.search(line)
+                    getmsg.search(line)
+                    rule_ids = rule_idstools.parse(line)
+                    if rule_ids is not None:
+                        [meta for meta in rule_ids.metadata if meta.startswith('created_at ') or meta.startswith('updated_at ')]
+                    for ftype in bitsregexp:
+                        bitsregexp[ftype].findall(line)
+
+        def single_pass():
+            with open(rfile.name) as f:
+                for _ in RuleParser().parse_file(f):
+                    pass
+
+        self.stdout.write('Parsing %d rules' % self.rules)
+        legacy_time = self.timeit('regexps + idstools', legacy)
+        parser_time = self.timeit('single pass parser', single_pass)
+        self.stdout.write('Speedup: %.1fx' % (legacy_time / parser_time))
+        rfile.close()
+
+    def bench_parallel(self):
+        per_file = max(self.rules / self.files, 1)
+        rfiles = [write_rules_file(per_file, start_sid=3000000 + i * per_file) for i in xrange(self.files)]
+        filenames = [rfile.name for rfile in rfiles]
+        parser = RuleParser()
+
+        self.stdout.write('Parsing %d files of %d rules' % (self.files, per_file))
+        sequential_time = self.timeit('1 worker', lambda: list(parser.parse_files(filenames, workers=1)))
+        parallel_time = self.timeit('%d workers' % self.workers, lambda: list(parser.parse_files(filenames, workers=self.workers)))
+        self.stdout.write('Speedup: %.1fx' % (sequential_time / parallel_time))
+        for rfile in rfiles:
+            rfile.close()
+
+    def bench_generate(self):
+        ACTION = Transformation.ACTION
+        LATERAL = Transformation.LATERAL
+        TARGET = Transformation.TARGET
+
+        # Generation before transformation plans: rule parsed for each
+        # lateral or target transformation
+        def legacy(ruleset, rules):
+            transformations = RulesetTransformations.load(ruleset)
+            for rule in rules:
+                content = rule.content
+                trans = transformations.get(ACTION, rule.pk, rule.category_id)
+                if trans in (Transformation.A_DROP, Transformation.A_REJECT) and rule.can_drop():
+                    content = rule.apply_transformation(content, key=ACTION, value=trans)
+                trans = transformations.get(LATERAL, rule.pk, rule.category_id)
+                if trans in (Transformation.L_YES, Transformation.L_AUTO) and rule.can_lateral(trans):
+                    content = rule.apply_transformation(content, key=LATERAL, value=trans)
+                trans = transformations.get(TARGET, rule.pk, rule.category_id)
+                if trans in (Transformation.T_SOURCE, Transformation.T_DESTINATION, Transformation.T_AUTO):
+                    content = rule.apply_transformation(content.encode('utf8'), key=TARGET, value=trans)
+
+        def plans(ruleset, rules):
+            transformations = RulesetTransformations.load(ruleset)
+            for rule in rules:
+                rule.transform_content(*transformations.resolve(rule))
+
+        # objects are created in a transaction which is rolled back at the end
+        with transaction.atomic():
+            now = timezone.now()
+            source = Source.objects.create(name='scbench source', method='local', datatype='sigs', created_date=now)
+            category = Category.objects.create(name='scbench category', filename='rules/scbench.rules', source=source)
+            ruleset = Ruleset.objects.create(name='scbench ruleset', created_date=now, updated_date=now)
+            ruleset.sources.add(SourceAtVersion.objects.create(source=source, version='HEAD'))
+            ruleset.categories.add(category)
+            ruleset.set_transformation(key=ACTION, value=Transformation.A_DROP)
+            ruleset.set_transformation(key=LATERAL, value=Transformation.L_YES)
+            ruleset.set_transformation(key=TARGET, value=Transformation.T_AUTO)
+
+            rules = []
+            for line in generate_rules(self.rules, start_sid=90000000):
+                if line.startswith('#'):
+                    continue
+                parsed = RuleParser().parse_line(line)
+                rules.append(Rule(sid=parsed.sid, rev=parsed.rev, msg=parsed.msg, content=parsed.content, category=category))
+            Rule.objects.bulk_create(rules, batch_size=500)
+            rules = list(ruleset.generate())
+
+            self.stdout.write('Generating %d rules' % len(rules))
+            legacy_time = self.timeit('parse per transformation', lambda: legacy(ruleset, rules))
+            plans_time = self.timeit('transformation plans', lambda: plans(ruleset, rules))
+            self.stdout.write('Speedup: %.1fx' % (legacy_time / plans_time))
+            artifacts_dir = tempfile.mkdtemp()
+            try:
+                with override_settings(RULESET_ARTIFACTS_DIRECTORY=artifacts_dir):
+                    self.timeit('Ruleset.to_buffer (generated)', lambda: (ruleset.invalidate_artifact(), ruleset.to_buffer()))
+                    self.timeit('Ruleset.to_buffer (artifact)', ruleset.to_buffer)
+                    # one rule disabled before each run, stored file is patched
+                    disabled = iter(rules)
+                    self.timeit('Ruleset.to_buffer (patched)', lambda: (next(disabled).disable(ruleset), ruleset.to_buffer()))
+            finally:
+                shutil.rmtree(artifacts_dir)
+            transaction.set_rollback(True)
+
+    def bench_validate(self):
+        # suricata is replaced by a stub taking --stub-delay seconds
+        stub_dir = tempfile.mkdtemp()
+        stub = os.path.join(stub_dir, 'suricata')
+        with open(stub, 'w') as f:
+            f.write('#!/bin/sh\nsleep %f\nexit 0\n' % self.stub_delay)
+        os.chmod(stub, 0o755)
+
+        testor = TestRules()
+        rule_buffers = [line for line in generate_rules(self.tests) if not line.startswith('#')]
+        files = (testor.CONFIG_FILE, {'threshold.config': ''}, testor.REFERENCE_CONFIG, testor.CLASSIFICATION_CONFIG)
+
+        # Test before the sandboxes pool: files written in a new directory
+        # for each test, tests run one at a time
+        def legacy():
+            for rule_buffer in rule_buffers:
+                sandbox = TestSandbox(*files)
+                sandbox.run(rule_buffer)
+                sandbox.close()
+
+        def pool(workers):
+            pool = TestSandboxPool(workers, len(rule_buffers), 1)
+            jobs = [pool.submit(rule_buffer, *files) for rule_buffer in rule_buffers]
+            for job in jobs:
+                job.result()
+            pool.close()
+
+        try:
+            with override_settings(SURICATA_BINARY=stub):
+                self.stdout.write('Running %d tests of %.3fs' % (len(rule_buffers), self.stub_delay))
+                legacy_time = self.timeit('new sandbox per test', legacy)
+                self.timeit('pool, 1 worker', lambda: pool(1))
+                pool_time = self.timeit('pool, %d workers' % self.workers, lambda: pool(self.workers))
+                self.stdout.write('Speedup: %.1fx' % (legacy_time / pool_time))
+        finally:
+            shutil.rmtree(stub_dir)
+
+    def bench_esquery(self):
+        # bodies of queries are rendered, ES is not requested
+        queries = (
+            ('top', es_graphs.get_top_query, {'count': 20, 'field': 'alert.signature_id', 'sid': 2000000}),
+            ('sid_by_host', es_graphs.get_sid_by_host_query, {'rule_sid': 2000000, 'alerts_number': 20}),
+            ('timeline', es_graphs.get_timeline_query, {}),
+            ('timeline_by_tags', es_graphs.get_timeline_by_tags_query, {}),
+            ('stats', es_graphs.get_stats_query, {'value': 'eve.total.rate_1m'}),
+            ('rules_per_category', es_graphs.get_rules_per_category, {}),
+            ('alerts_count', es_graphs.get_alerts_count_per_host, {}),
+            ('alerts_trend', es_graphs.get_alerts_trend_per_host, {'start_date': 1530000000000}),
+            ('latest_stats', es_graphs.get_latest_stats_entry, {}),
+            ('ippair_alerts', es_graphs.get_ippair_alerts_count, {}),
+            ('ippair_netinfo_alerts', es_graphs.get_ippair_netinfo_alerts_count, {}),
+            ('alerts_tail', lambda: es_graphs.ALERTS_TAIL, {'target_only': 'AND alert.target.ip:*'}),
+            ('suri_log_tail', lambda: es_graphs.SURICATA_LOGS_TAIL, {'hostname': settings.ELASTICSEARCH_HOSTNAME}),
+            ('top_alerts', lambda: es_graphs.TOP_ALERTS, {'count': 20, 'order': 'desc'}),
+            ('sigs_list', lambda: es_graphs.SIGS_LIST_HITS, {'sids': '[2000000, 2000001]', 'count': 2}),
+            ('poststats', lambda: es_graphs.POSTSTATS_SUMMARY, {'filter': 'rule_filter_1'}),
+        )
+
+        request = HttpRequest()
+        request.GET.update({'hosts': 'probe1,probe2', 'qfilter': 'alert.severity:1'})
+        query = es_query.ESQuery(request)
+
+        # Rendering before compiled templates: template parsed on each query
+        def legacy(tmpl, context):
+            for _ in xrange(self.renders):
+                es_query._query_templates.clear()
+                query._render_template(tmpl(), context)
+
+        def compiled(tmpl, context):
+            for _ in xrange(self.renders):
+                query._render_template(tmpl(), context)
+
+        es_graphs.ES_VERSION = [self.es_version, 0, 0]
+        try:
+            self.stdout.write('Rendering %d queries of each type for ES %d' % (self.renders, self.es_version))
+            for name, tmpl, context in queries:
+                legacy_time = self.timeit('%s (parsed)' % name, lambda: legacy(tmpl, context))
+                compiled_time = self.timeit('%s (compiled)' % name, lambda: compiled(tmpl, context))
+                self.stdout.write('Speedup: %.1fx' % (legacy_time / compiled_time))
+        finally:
+            es_graphs.reset_es_version()
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rules', '0073_filterset_description'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='source',
+            name='imported_version',
+            field=models.CharField(blank=True, max_length=42, null=True),
+        ),
+    ]
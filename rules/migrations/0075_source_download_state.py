@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rules', '0074_source_imported_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='source',
+            name='content_digest',
+            field=models.CharField(blank=True, max_length=64, null=True),
+        ),
+        migrations.AddField(
+            model_name='source',
+            name='http_etag',
+            field=models.CharField(blank=True, max_length=200, null=True),
+        ),
+        migrations.AddField(
+            model_name='source',
+            name='http_last_modified',
+            field=models.CharField(blank=True, max_length=100, null=True),
+        ),
+    ]
@@ -22,16 +22,20 @@ from django.db import models
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes.fields import GenericForeignKey, GenericRelation
 from django.conf import settings
+from django.core.cache import cache
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
 from django.core.exceptions import FieldError, SuspiciousOperation, ValidationError
 from django.core.validators import validate_ipv4_address
-from django.db import transaction
+from django.db import transaction, connections, router
 from django.utils import timezone
 from django.utils.html import mark_safe, format_html, format_html_join
-from django.db.models import Q
+from django.db.models import Q, F, Case, When, Value
 from idstools import rule as rule_idstools
 from enum import Enum, unique
 from copy import deepcopy
-from collections import OrderedDict
+from collections import OrderedDict, namedtuple, defaultdict
+from multiprocessing.pool import ThreadPool
 import requests
 import tempfile
 import tarfile
@@ -40,11 +44,18 @@ import sys
 import os
 import git
 import shutil
+import glob
 import json
+import hashlib
+import struct
+import threading
+import time
+import uuid
 import IPy
 from datetime import date as datetime_date
 
 from rules.tests_rules import TestRules
+from rules.rule_parser import RuleParser, parse_rules_file
 from rules.validators import validate_address_or_network
 from rules.filter_sets import FILTER_SETS
 
@@ -654,6 +665,54 @@ def reset_es_address():
 def get_es_path(path):
     return get_es_address() + path.lstrip('/')
 
+
+def bulk_update(objs, fields, batch_size=None):
+    # Write the given fields of already saved objects with one UPDATE
+    # per batch, using a CASE on the primary key for each field
+    if not objs:
+        return
+    model = objs[0].__class__
+    fields = [model._meta.get_field(name) for name in fields]
+    connection = connections[router.db_for_write(model)]
+    # each object binds its pk and a value in the WHEN of each field, and
+    # its pk in the IN clause
+    max_params = getattr(connection.features, 'max_query_params', None)
+    if max_params is None and connection.vendor == 'sqlite':
+        max_params = 999
+    if max_params:
+        max_batch_size = max(max_params // (2 * len(fields) + 1), 1)
+    else:
+        max_batch_size = len(objs)
+    batch_size = min(batch_size, max_batch_size) if batch_size else max_batch_size
+    with transaction.atomic(using=connection.alias):
+        for i in xrange(0, len(objs), batch_size):
+            batch = objs[i:i + batch_size]
+            updates = {}
+            for field in fields:
+                whens = [When(pk=obj.pk, then=Value(getattr(obj, field.attname), output_field=field)) for obj in batch]
+                updates[field.attname] = Case(*whens, output_field=field)
+            model.objects.filter(pk__in=[obj.pk for obj in batch]).update(**updates)
+
+
+def fetch_source(source, proxy_params=None):
+    # run by Ruleset.update worker threads: exception is returned to be
+    # raised again when the source is imported
+    try:
+        return source.fetch(proxy_params=proxy_params), None
+    except Exception:
+        return None, sys.exc_info()
+
+
+def bulk_delete(objs, batch_size=None):
+    if not objs:
+        return
+    model = objs[0].__class__
+    pks = [obj.pk for obj in objs]
+    batch_size = batch_size or len(pks)
+    with transaction.atomic():
+        for i in xrange(0, len(pks), batch_size):
+            model.objects.filter(pk__in=pks[i:i + batch_size]).delete()
+
 class Source(models.Model):
     FETCH_METHOD = (
         ('http', 'HTTP URL'),
@@ -667,6 +726,9 @@ class Source(models.Model):
         ('other', 'Other content'),
     )
     TMP_DIR = "/tmp/"
+    RELATED_FILES_CACHE_SIZE = 16
+    _related_files = OrderedDict()
+    _related_files_lock = threading.Lock()
 
     name = models.CharField(max_length=100, unique = True)
     created_date = models.DateTimeField('date created')
@@ -680,6 +742,12 @@ class Source(models.Model):
     rules_count = models.IntegerField(default = 0)
     public_source = models.CharField(max_length=100, blank = True, null = True)
     use_iprep = models.BooleanField('Use IP reputation for group signatures', default=True)
+    # git version of the rules files last imported in database
+    imported_version = models.CharField(max_length=42, blank = True, null = True)
+    # state of the last download, used to skip updates when upstream did not change
+    http_etag = models.CharField(max_length=200, blank = True, null = True)
+    http_last_modified = models.CharField(max_length=100, blank = True, null = True)
+    content_digest = models.CharField(max_length=64, blank = True, null = True)
 
     editable = True
     # git repo where we store the physical thing
@@ -706,6 +774,10 @@ class Source(models.Model):
             self.init_flowbits = True
         else:
             self.init_flowbits = False
+        self._loaded_use_iprep = self.use_iprep
+        self._loaded_uri = self.uri
+        self._loaded_download_state = (self.http_etag, self.http_last_modified)
+        self.fetched = None
 
     @staticmethod
     def get_icon(instance=None):
@@ -726,6 +798,23 @@ class Source(models.Model):
         # delete model
         models.Model.delete(self)
 
+    def save(self, *args, **kwargs):
+        # group signatures are built at import so all files must be parsed again
+        if self.use_iprep != self._loaded_use_iprep:
+            self.imported_version = None
+            self.reset_download_state()
+            self._loaded_use_iprep = self.use_iprep
+        if self.uri != self._loaded_uri:
+            self.reset_download_state()
+            self._loaded_uri = self.uri
+        models.Model.save(self, *args, **kwargs)
+        self._loaded_download_state = (self.http_etag, self.http_last_modified)
+
+    def reset_download_state(self):
+        self.http_etag = None
+        self.http_last_modified = None
+        self.content_digest = None
+
     def __unicode__(self):
         return self.name
 
@@ -734,14 +823,38 @@ class Source(models.Model):
         self.updated_rules["deleted"] = list(set(self.updated_rules["deleted"]).union(set(update["deleted"])))
         self.updated_rules["updated"] = list(set(self.updated_rules["updated"]).union(set(update["updated"])))
 
+    def get_changed_files(self):
+        # Files changed since the last import in database, None if all
+        # files need to be parsed
+        if not self.imported_version:
+            return None
+        repo = self.get_git_repo(delete = False)
+        try:
+            diff = repo.commit(self.imported_version).diff(repo.head.commit)
+        except (ValueError, git.exc.BadName, git.exc.BadObject):
+            return None
+        changed = set()
+        for change in diff:
+            changed.update([path for path in (change.a_path, change.b_path) if path])
+        return changed
+
     def get_categories(self):
         source_git_dir = os.path.join(settings.GIT_SOURCES_BASE_DIRECTORY, unicode(self.pk))
         catname = re.compile("(.+)\.rules$")
-        existing_rules_hash = {}
-        for rule in Rule.objects.all().prefetch_related('category'):
-            existing_rules_hash[rule.sid] = rule
-        for f in os.listdir(os.path.join(source_git_dir, 'rules')):
-            if f.endswith('.rules'):
+        filenames = [f for f in os.listdir(os.path.join(source_git_dir, 'rules')) if f.endswith('.rules')]
+        existing_categories = set(Category.objects.filter(source = self).values_list('filename', flat=True))
+        changed_files = self.get_changed_files()
+        if changed_files is not None:
+            # rules of unchanged files are already in database as they are
+            filenames = [f for f in filenames if os.path.join('rules', f) in changed_files or
+                                                 os.path.join('rules', f) not in existing_categories]
+        with transaction.atomic():
+            rules_index = RulesIndex()
+            flowbits = Category.build_flowbits(self)
+            parsed_files = RuleParser().parse_files([os.path.join(source_git_dir, 'rules', f) for f in filenames],
+                                                    workers=settings.RULES_PARSE_WORKERS)
+            for path, parsed_rules in parsed_files:
+                f = os.path.basename(path)
                 match = catname.search(f)
                 name = match.groups()[0]
                 category = Category.objects.filter(source = self, name = name)
@@ -751,11 +864,18 @@ class Source(models.Model):
                                             filename = os.path.join('rules', f))
                 else:
                     category = category[0]
-                category.get_rules(self, existing_rules_hash = existing_rules_hash)
                 # get rules in this category
-        for category in Category.objects.filter(source = self):
-            if not os.path.isfile(os.path.join(source_git_dir, category.filename)):
-                category.delete()
+                category.get_rules(self, rules_index = rules_index, flowbits = flowbits,
+                                   parsed_rules = parsed_rules)
+            # a rule missing from a category file may have moved to a category
+            # parsed afterwards
+            self.updated_rules["deleted"] = [rule for rule in self.updated_rules["deleted"]
+                                             if rules_index.get(rule.pk).category_id == rule.category_id]
+            for category in Category.objects.filter(source = self):
+                if not os.path.isfile(os.path.join(source_git_dir, category.filename)):
+                    category.delete()
+            self.imported_version = self.get_git_repo(delete = False).head.commit.hexsha
+            self.save()
 
     def get_git_repo(self, delete = False):
         # check if git tree is in place
@@ -793,45 +913,59 @@ class Source(models.Model):
             sversion = SourceAtVersion.objects.create(source = self, version = version,
                                                     updated_date = self.updated_date, git_version = version)
 
-    def handle_rules_in_tar(self, f):
+    def extract_rules_tar(self, f):
+        # Members are read in stream mode and checked before being extracted
+        # in a temporary directory so the archive is never loaded in memory.
+        # Return the temporary directory and the path of the rules directory
+        # inside it.
         f.seek(0)
         if (not tarfile.is_tarfile(f.name)):
             raise OSError("Invalid tar file")
 
-        self.updated_date = timezone.now()
-        self.first_run = False
+        f.seek(0)
+        tfile = tarfile.open(fileobj=f, mode='r|*', bufsize=settings.SOURCE_DOWNLOAD_CHUNK_SIZE)
+        extract_dir = tempfile.mkdtemp(dir=self.TMP_DIR)
+        try:
+            rules_dir = None
+            for member in tfile:
+                # only file and dir are allowed
+                if not (member.isfile() or member.isdir()):
+                    raise SuspiciousOperation("Suspect tar file contains non regular file '%s'" % (member.name))
+                if member.name.startswith('/') or '..' in member.name:
+                    raise SuspiciousOperation("Suspect tar file contains invalid path '%s'" % (member.name))
+                # don't allow tar file with file in root dir
+                if member.isfile() and not '/' in member.name:
+                    raise SuspiciousOperation("Suspect tar file contains file in root directory '%s' instead of under 'rules' directory" % (member.name))
+                if member.isdir() and ('/' + member.name).endswith('/rules'):
+                    if rules_dir:
+                        raise SuspiciousOperation("Tar file contains two 'rules' directory instead of one")
+                    tfile.extract(member, path=extract_dir)
+                    rules_dir = member.name
+                if member.isfile() and member.name.split('/')[-2] == 'rules':
+                    tfile.extract(member, path=extract_dir)
+            if rules_dir == None:
+                raise SuspiciousOperation("Tar file does not contain a 'rules' directory")
+        except:
+            shutil.rmtree(extract_dir)
+            raise
+        finally:
+            tfile.close()
+        return extract_dir, os.path.join(extract_dir, rules_dir)
 
-        repo = self.get_git_repo(delete = True)
+    def handle_rules_in_tar(self, f, extracted=None):
+        if extracted is None:
+            extracted = self.extract_rules_tar(f)
+        extract_dir, rules_dir = extracted
 
-        f.seek(0)
-        # extract file
-        tfile = tarfile.open(fileobj=f)
-        dir_list = []
-        rules_dir = None
-        for member in tfile.getmembers():
-            # only file and dir are allowed
-            if not (member.isfile() or member.isdir()):
-                raise SuspiciousOperation("Suspect tar file contains non regular file '%s'" % (member.name))
-            if member.name.startswith('/') or '..' in member.name:
-                raise SuspiciousOperation("Suspect tar file contains invalid path '%s'" % (member.name))
-            # don't allow tar file with file in root dir
-            if member.isfile() and not '/' in member.name:
-                raise SuspiciousOperation("Suspect tar file contains file in root directory '%s' instead of under 'rules' directory" % (member.name))
-            if member.isdir() and ('/' + member.name).endswith('/rules'):
-                if rules_dir:
-                    raise SuspiciousOperation("Tar file contains two 'rules' directory instead of one")
-                dir_list.append(member)
-                rules_dir = member.name
-            if member.isfile() and member.name.split('/')[-2] == 'rules':
-                dir_list.append(member)
-        if rules_dir == None:
-            raise SuspiciousOperation("Tar file does not contain a 'rules' directory")
+        try:
+            self.updated_date = timezone.now()
+            self.first_run = False
 
-        source_git_dir = os.path.join(settings.GIT_SOURCES_BASE_DIRECTORY, unicode(self.pk))
-        tfile.extractall(path=source_git_dir, members = dir_list)
-        if "/" in rules_dir:
-            shutil.move(os.path.join(source_git_dir, rules_dir), os.path.join(source_git_dir, 'rules'))
-            shutil.rmtree(os.path.join(source_git_dir, rules_dir.split('/')[0]))
+            repo = self.get_git_repo(delete = True)
+            source_git_dir = os.path.join(settings.GIT_SOURCES_BASE_DIRECTORY, unicode(self.pk))
+            shutil.move(rules_dir, os.path.join(source_git_dir, 'rules'))
+        finally:
+            shutil.rmtree(extract_dir)
 
         index = repo.index
         if len(index.diff(None)) or self.first_run:
@@ -948,29 +1082,80 @@ class Source(models.Model):
         self.rules_count = len(Rule.objects.filter(category__in = cats))
         self.save()
 
+    def fetch(self, proxy_params=None):
+        # Download and extract upstream content. There is no database access
+        # here so sources can be fetched concurrently before being imported.
+        # Return False if content did not change since last update.
+        if not self.method in ['http', 'local']:
+            raise FieldError("Currently unsupported method")
+        self.fetched = None
+        if self.update_ruleset:
+            f = tempfile.NamedTemporaryFile(dir=self.TMP_DIR)
+            if not self.update_ruleset(f, proxy_params=proxy_params):
+                f.close()
+                return False
+            extracted = None
+            if self.datatype == 'sigs':
+                try:
+                    extracted = self.extract_rules_tar(f)
+                except:
+                    f.close()
+                    raise
+            self.fetched = (f, extracted)
+        return True
+
+    def clean_fetched(self):
+        # remove what was fetched but not imported
+        if self.fetched:
+            f, extracted = self.fetched
+            self.fetched = None
+            f.close()
+            if extracted:
+                shutil.rmtree(extracted[0], ignore_errors=True)
+
+    def save_download_state(self):
+        if (self.http_etag, self.http_last_modified) != self._loaded_download_state:
+            Source.objects.filter(pk=self.pk).update(http_etag=self.http_etag, http_last_modified=self.http_last_modified)
+            self._loaded_download_state = (self.http_etag, self.http_last_modified)
+
     # This method cannot be called twice consecutively
+    def update(self, fetched=None, progress=None):
+        # fetched is the result of a previous call to fetch(). The download
+        # and the progress(percent, message) report are done before the
+        # import transaction, progress may raise to stop the update.
+        if fetched is None:
+            fetched = self.fetch()
+        if not fetched:
+            # upstream content did not change since last update
+            self.save_download_state()
+            return
+        if progress is not None:
+            try:
+                progress(10, 'Importing rules of source "%s"' % self.name)
+            except:
+                self.clean_fetched()
+                raise
+        self._import_fetched()
+
     @transaction.atomic
-    def update(self):
+    def _import_fetched(self):
         # look for categories list: if none, first import
         categories = Category.objects.filter(source = self)
         firstimport = False
         if not categories:
             firstimport = True
-        if not self.method in ['http', 'local']:
-            raise FieldError("Currently unsupported method")
-        if self.update_ruleset:
-            f = tempfile.NamedTemporaryFile(dir=self.TMP_DIR)
-            self.update_ruleset(f)
+        if self.fetched:
+            f, extracted = self.fetched
+            self.fetched = None
             if self.datatype == 'sigs':
-                self.handle_rules_in_tar(f)
+                self.handle_rules_in_tar(f, extracted=extracted)
             elif self.datatype == 'sig':
                 self.handle_rules_file(f)
             elif self.datatype == 'other':
                 self.handle_other_file(f)
         if not self.datatype == 'other' and not firstimport:
             self.create_update()
-        for rule in self.updated_rules["deleted"]:
-            rule.delete()
+        bulk_delete(self.updated_rules["deleted"], batch_size=settings.RULES_DELETE_BATCH_SIZE)
         self.needs_test()
 
     def diff(self):
@@ -981,6 +1166,33 @@ class Source(models.Model):
         hcommit = repo.head.commit
         return hcommit.diff('HEAD~1', create_patch = True)
 
+    def get_related_files(self, version):
+        # Files other than rules exported at version, 50kB at most each, as
+        # sent with rulesets tests. Cached until the source is updated.
+        key = (self.pk, version, self.updated_date)
+        with Source._related_files_lock:
+            related_files = Source._related_files.pop(key, None)
+            if related_files is not None:
+                Source._related_files[key] = related_files
+                return related_files
+
+        tmpdir = tempfile.mkdtemp(dir=self.TMP_DIR)
+        try:
+            self.export_files(tmpdir, version)
+            related_files = {}
+            for root, _, files in os.walk(tmpdir):
+                for f in files:
+                    with open(os.path.join(root, f), 'r') as cf:
+                        related_files[f] = cf.read(50 * 1024)
+        finally:
+            shutil.rmtree(tmpdir)
+
+        with Source._related_files_lock:
+            Source._related_files[key] = related_files
+            while len(Source._related_files) > self.RELATED_FILES_CACHE_SIZE:
+                Source._related_files.popitem(last=False)
+        return related_files
+
     def export_files(self, directory, version):
         source_git_dir = os.path.join(settings.GIT_SOURCES_BASE_DIRECTORY, unicode(self.pk))
         repo = git.Repo(source_git_dir)
@@ -1006,17 +1218,38 @@ class Source(models.Model):
         from django.core.urlresolvers import reverse
         return reverse('source', args=[unicode(self.id)])
 
-    def update_ruleset_http(self, f):
-        proxy_params = get_system_settings().get_proxy_params()
+    def update_ruleset_http(self, f, proxy_params=None):
+        if proxy_params is None:
+            proxy_params = get_system_settings().get_proxy_params()
         hdrs = { 'User-Agent': 'scirius' }
         if self.authkey:
             hdrs['Authorization'] = self.authkey
+        # only send conditional request if the last downloaded content is
+        # in database and in git
+        source_git_dir = os.path.join(settings.GIT_SOURCES_BASE_DIRECTORY, unicode(self.pk))
+        conditional = self.content_digest and os.path.isdir(source_git_dir)
+        if conditional:
+            if self.http_etag:
+                hdrs['If-None-Match'] = self.http_etag
+            if self.http_last_modified:
+                hdrs['If-Modified-Since'] = self.http_last_modified
         try:
             if proxy_params:
-                resp = requests.get(self.uri, proxies = proxy_params, headers = hdrs, verify = self.cert_verif)
+                resp = requests.get(self.uri, proxies = proxy_params, headers = hdrs, verify = self.cert_verif, stream = True)
             else:
-                resp = requests.get(self.uri, headers = hdrs, verify = self.cert_verif)
+                resp = requests.get(self.uri, headers = hdrs, verify = self.cert_verif, stream = True)
             resp.raise_for_status()
+            if conditional and resp.status_code == 304:
+                resp.close()
+                return False
+
+            # content is written by chunks to keep memory usage bounded
+            digest = hashlib.sha256()
+            for chunk in resp.iter_content(chunk_size = settings.SOURCE_DOWNLOAD_CHUNK_SIZE):
+                digest.update(chunk)
+                f.write(chunk)
+            f.flush()
+            resp.close()
         except requests.exceptions.ConnectionError, e:
             if "Name or service not known" in unicode(e):
                 raise IOError("Failure to resolve hostname, please check DNS configuration")
@@ -1032,7 +1265,21 @@ class Source(models.Model):
             raise IOError("Request timeout, server may be down")
         except requests.exceptions.TooManyRedirects:
             raise IOError("Too many redirects, server may be broken")
-        f.write(resp.content)
+        except requests.exceptions.ChunkedEncodingError, e:
+            raise IOError("Download interrupted '%s'" % (e))
+
+        http_etag = resp.headers.get('ETag')
+        http_last_modified = resp.headers.get('Last-Modified')
+        digest = digest.hexdigest()
+        # saved with the source once the content has been handled, or by
+        # save_download_state if content is unchanged
+        self.http_etag = http_etag
+        self.http_last_modified = http_last_modified
+        if conditional and digest == self.content_digest:
+            return False
+
+        self.content_digest = digest
+        return True
 
     def handle_uploaded_file(self, f):
         dest = tempfile.NamedTemporaryFile(dir=self.TMP_DIR)
@@ -1050,8 +1297,7 @@ class Source(models.Model):
         self.handle_uploaded_file(f)
         if not self.datatype == 'other' and not firstimport:
             self.create_update()
-        for rule in self.updated_rules["deleted"]:
-            rule.delete()
+        bulk_delete(self.updated_rules["deleted"], batch_size=settings.RULES_DELETE_BATCH_SIZE)
         self.needs_test()
 
     def needs_test(self):
@@ -1332,14 +1578,21 @@ class Transformable:
         if rule_ids.format().startswith("#"):
             return content
 
+        if not self.transform_parsed_rule(rule_ids, key, value):
+            return content
+        return rule_ids.format().encode("utf-8")
+
+    def transform_parsed_rule(self, rule_ids, key, value):
+        # Apply lateral or target transformation on an idstools rule, return
+        # False if the rule content must be kept as is
         # LATERAL + YES
         if key == Transformation.LATERAL:
             if value == Transformation.L_YES:
                 rule_ids.raw = rule_ids.raw.replace("$EXTERNAL_NET", "any")
-                return rule_ids.format().encode("utf-8")
+                return True
             elif value == Transformation.L_AUTO:
                 if rule_ids.msg.startswith("ET POLICY"):
-                    return content
+                    return False
                 for meta in rule_ids.metadata:
                     # if deployment can be internal then we can relax the constraint
                     # on EXTERNAL_NET to try to catch the lateral movement
@@ -1350,10 +1603,10 @@ class Transformable:
         if key == Transformation.TARGET:
             if value == Transformation.T_SOURCE:
                 self._set_target(rule_ids, target='src_ip')
-                return rule_ids.format().encode("utf-8")
+                return True
             elif value == Transformation.T_DESTINATION:
                 self._set_target(rule_ids, target='dest_ip')
-                return rule_ids.format().encode("utf-8")
+                return True
             elif value == Transformation.T_AUTO:
                 target_client = False
                 for meta in rule_ids.metadata:
@@ -1370,254 +1623,215 @@ class Transformable:
                 if target_client is True:
                     self._apply_target_trans(rule_ids)
 
-        return rule_ids.format().encode("utf-8")
+        return True
 
 
-class Cache:
-    TRANSFORMATIONS = None
+class RulesetTransformations(object):
+    # Transformations of a ruleset: values of rules and categories by key, and
+    # ruleset defaults. It resolves the effective transformation of a rule
+    # without further query.
+    KEYS = (Transformation.ACTION, Transformation.LATERAL, Transformation.TARGET)
+    TYPES = {
+        Transformation.ACTION: (Transformation.ActionTransfoType, Transformation.A_NONE),
+        Transformation.LATERAL: (Transformation.LateralTransfoType, Transformation.L_NO),
+        Transformation.TARGET: (Transformation.TargetTransfoType, Transformation.T_NONE),
+    }
 
     def __init__(self):
-        pass
+        self.rules = defaultdict(dict)
+        self.categories = defaultdict(dict)
+        self.ruleset = {}
 
     @classmethod
-    def enable_cache(cls):
-        if cls.TRANSFORMATIONS is None:
-            # Actions
-            ACTION = Transformation.ACTION
-            A_NONE = Transformation.A_NONE
-            A_FILESTORE = Transformation.A_FILESTORE
-            A_DROP = Transformation.A_DROP
-            A_REJECT = Transformation.A_REJECT
-            A_BYPASS = Transformation.A_BYPASS
+    def load(cls, ruleset=None):
+        # One query per transformation model. Return transformations of
+        # ruleset, or of all rulesets by pk if ruleset is None.
+        rts = RuleTransformation.objects.all()
+        cts = CategoryTransformation.objects.all()
+        rsts = RulesetTransformation.objects.all()
+        if ruleset is not None:
+            rts = rts.filter(ruleset=ruleset)
+            cts = cts.filter(ruleset=ruleset)
+            rsts = rsts.filter(ruleset_transformation=ruleset)
+
+        rulesets = defaultdict(cls)
+        for ruleset_id, pk, key, value in rts.values_list('ruleset_id', 'rule_transformation_id', 'key', 'value').iterator():
+            rulesets[ruleset_id].rules[key][pk] = value
+        for ruleset_id, pk, key, value in cts.values_list('ruleset_id', 'category_transformation_id', 'key', 'value'):
+            rulesets[ruleset_id].categories[key][pk] = value
+        for ruleset_id, key, value in rsts.values_list('ruleset_transformation_id', 'key', 'value'):
+            rulesets[ruleset_id].ruleset[key] = value
+
+        if ruleset is not None:
+            return rulesets.get(ruleset.pk, cls())
+        return dict(rulesets)
+
+    def _get_type(self, key, value, exclude_none=False):
+        if value is None:
+            return None
+        TYPE, NONE = self.TYPES[key]
+        if exclude_none and value == NONE.value:
+            return None
+        try:
+            return TYPE(value)
+        except ValueError:
+            return None
 
-            # Lateral
-            LATERAL = Transformation.LATERAL
-            L_AUTO = Transformation.L_AUTO
-            L_YES = Transformation.L_YES
-            L_NO = Transformation.L_NO
-
-            # Target
-            TARGET = Transformation.TARGET
-            T_AUTO = Transformation.T_AUTO
-            T_SOURCE = Transformation.T_SOURCE
-            T_DST = Transformation.T_DESTINATION
-            T_NONE = Transformation.T_NONE
-
-            rule_str = Rule.__name__.lower()
-            category_str = Category.__name__.lower()
-            ruleset_str = Ruleset.__name__.lower()
-
-            cls.TRANSFORMATIONS = {
-                    ACTION: {
-                        rule_str: {
-                            A_DROP: None, A_REJECT: None, A_FILESTORE: None, A_NONE: None, A_BYPASS: None,
-                        },
-                        category_str: {
-                            A_DROP: None, A_REJECT: None, A_FILESTORE: None, A_NONE: None, A_BYPASS: None,
-                        },
-                        ruleset_str: {
-                            A_DROP: None, A_REJECT: None, A_FILESTORE: None, A_BYPASS: None,
-                        }
-                    },
-                    LATERAL: {
-                        rule_str: {
-                            L_AUTO: None, L_YES: None, L_NO: None,
-                        },
-                        category_str: {
-                            L_AUTO: None, L_YES: None, L_NO: None,
-                        },
-                        ruleset_str: {
-                            L_AUTO: None, L_YES: None,
-                        }
-                    },
-                    TARGET: {
-                        rule_str: {
-                            T_AUTO: None, T_SOURCE: None, T_DST: None, T_NONE: None,
-                        },
-                        category_str: {
-                            T_AUTO: None, T_SOURCE: None, T_DST: None, T_NONE: None,
-                        },
-                        ruleset_str: {
-                            T_AUTO: None, T_SOURCE: None, T_DST: None,
-                        }
-                    }
-                }
-
-            # ##### Rules
-            # Actions
-            drop_rules = Rule.objects.filter(
-                                ruletransformation__key=ACTION.value,
-                                ruletransformation__value=A_DROP.value).values_list('pk', flat=True)
-            reject_rules = Rule.objects.filter(
-                                ruletransformation__key=ACTION.value,
-                                ruletransformation__value=A_REJECT.value).values_list('pk', flat=True)
-            filestore_rules = Rule.objects.filter(
-                                ruletransformation__key=ACTION.value,
-                                ruletransformation__value=A_FILESTORE.value).values_list('pk', flat=True)
-            none_rules = Rule.objects.filter(
-                                ruletransformation__key=ACTION.value,
-                                ruletransformation__value=A_NONE.value).values_list('pk', flat=True)
-            bypass_rules = Rule.objects.filter(
-                                ruletransformation__key=ACTION.value,
-                                ruletransformation__value=A_BYPASS.value).values_list('pk', flat=True)
-            # Lateral
-            rule_l_auto = Rule.objects.filter(
-                                ruletransformation__key=LATERAL.value,
-                                ruletransformation__value=L_AUTO.value).values_list('pk', flat=True)
-            rule_l_yes = Rule.objects.filter(
-                                ruletransformation__key=LATERAL.value,
-                                ruletransformation__value=L_YES.value).values_list('pk', flat=True)
-            rule_l_no = Rule.objects.filter(
-                                ruletransformation__key=LATERAL.value,
-                                ruletransformation__value=L_NO.value).values_list('pk', flat=True)
-
-            # Target
-            rule_t_auto = Rule.objects.filter(
-                                ruletransformation__key=TARGET.value,
-                                ruletransformation__value=T_AUTO.value).values_list('pk', flat=True)
-            rule_t_src = Rule.objects.filter(
-                                ruletransformation__key=TARGET.value,
-                                ruletransformation__value=T_SOURCE.value).values_list('pk', flat=True)
-            rule_t_dst = Rule.objects.filter(
-                                ruletransformation__key=TARGET.value,
-                                ruletransformation__value=T_DST.value).values_list('pk', flat=True)
-            rule_t_none = Rule.objects.filter(
-                                ruletransformation__key=TARGET.value,
-                                ruletransformation__value=T_NONE.value).values_list('pk', flat=True)
-
-            # #### Categories
-            # Actions
-            drop_cats = Category.objects.filter(
-                                categorytransformation__key=ACTION.value,
-                                categorytransformation__value=A_DROP.value).values_list('pk', flat=True)
-            reject_cats = Category.objects.filter(
-                                categorytransformation__key=ACTION.value,
-                                categorytransformation__value=A_REJECT.value).values_list('pk', flat=True)
-            filestore_cats = Category.objects.filter(
-                                categorytransformation__key=ACTION.value,
-                                categorytransformation__value=A_FILESTORE.value).values_list('pk', flat=True)
-            none_cats = Category.objects.filter(
-                                categorytransformation__key=ACTION.value,
-                                categorytransformation__value=A_NONE.value).values_list('pk', flat=True)
-            bypass_cats = Category.objects.filter(
-                                categorytransformation__key=ACTION.value,
-                                categorytransformation__value=A_BYPASS.value).values_list('pk', flat=True)
-
-            # Lateral
-            cat_l_auto = Category.objects.filter(
-                                categorytransformation__key=LATERAL.value,
-                                categorytransformation__value=L_AUTO.value).values_list('pk', flat=True)
-            cat_l_yes = Category.objects.filter(
-                                categorytransformation__key=LATERAL.value,
-                                categorytransformation__value=L_YES.value).values_list('pk', flat=True)
-            cat_l_no = Category.objects.filter(
-                                categorytransformation__key=LATERAL.value,
-                                categorytransformation__value=L_NO.value).values_list('pk', flat=True)
-            # Target
-            cat_t_auto = Category.objects.filter(
-                                categorytransformation__key=TARGET.value,
-                                categorytransformation__value=T_AUTO.value).values_list('pk', flat=True)
-            cat_t_src = Category.objects.filter(
-                                categorytransformation__key=TARGET.value,
-                                categorytransformation__value=T_SOURCE.value).values_list('pk', flat=True)
-            cat_t_dst = Category.objects.filter(
-                                categorytransformation__key=TARGET.value,
-                                categorytransformation__value=T_DST.value).values_list('pk', flat=True)
-            cat_t_none = Category.objects.filter(
-                                categorytransformation__key=TARGET.value,
-                                categorytransformation__value=T_NONE.value).values_list('pk', flat=True)
-
-            # #### Rulesets
-            # Actions
-            drop_rulesets = Ruleset.objects.filter(
-                                rulesettransformation__key=ACTION.value,
-                                rulesettransformation__value=A_DROP.value).values_list('pk', flat=True)
-            reject_rulesets = Ruleset.objects.filter(
-                                rulesettransformation__key=ACTION.value,
-                                rulesettransformation__value=A_REJECT.value).values_list('pk', flat=True)
-            filestore_rulesets = Ruleset.objects.filter(
-                                rulesettransformation__key=ACTION.value,
-                                rulesettransformation__value=A_FILESTORE.value).values_list('pk', flat=True)
-            bypass_rulesets = Ruleset.objects.filter(
-                                rulesettransformation__key=ACTION.value,
-                                rulesettransformation__value=A_BYPASS.value).values_list('pk', flat=True)
-
-            # Lateral
-            ruleset_l_auto = Ruleset.objects.filter(
-                                rulesettransformation__key=LATERAL.value,
-                                rulesettransformation__value=L_AUTO.value).values_list('pk', flat=True)
-            ruleset_l_yes = Ruleset.objects.filter(
-                                rulesettransformation__key=LATERAL.value,
-                                rulesettransformation__value=L_YES.value).values_list('pk', flat=True)
-            # Target
-            ruleset_t_auto = Ruleset.objects.filter(
-                                rulesettransformation__key=TARGET.value,
-                                rulesettransformation__value=T_AUTO.value).values_list('pk', flat=True)
-            ruleset_t_src = Ruleset.objects.filter(
-                                rulesettransformation__key=TARGET.value,
-                                rulesettransformation__value=T_SOURCE.value).values_list('pk', flat=True)
-            ruleset_t_dst = Ruleset.objects.filter(
-                                rulesettransformation__key=TARGET.value,
-                                rulesettransformation__value=T_DST.value).values_list('pk', flat=True)
-
-            # Set rules action cache
-            cls.TRANSFORMATIONS[ACTION][rule_str][A_DROP] = set(drop_rules)
-            cls.TRANSFORMATIONS[ACTION][rule_str][A_REJECT] = set(reject_rules)
-            cls.TRANSFORMATIONS[ACTION][rule_str][A_FILESTORE] = set(filestore_rules)
-            cls.TRANSFORMATIONS[ACTION][rule_str][A_NONE] = set(none_rules)
-            cls.TRANSFORMATIONS[ACTION][rule_str][A_BYPASS] = set(bypass_rules)
-
-            cls.TRANSFORMATIONS[LATERAL][rule_str][L_AUTO] = set(rule_l_auto)
-            cls.TRANSFORMATIONS[LATERAL][rule_str][L_YES] = set(rule_l_yes)
-            cls.TRANSFORMATIONS[LATERAL][rule_str][L_NO] = set(rule_l_no)
-
-            cls.TRANSFORMATIONS[TARGET][rule_str][T_AUTO] = set(rule_t_auto)
-            cls.TRANSFORMATIONS[TARGET][rule_str][T_SOURCE] = set(rule_t_src)
-            cls.TRANSFORMATIONS[TARGET][rule_str][T_DST] = set(rule_t_dst)
-            cls.TRANSFORMATIONS[TARGET][rule_str][T_NONE] = set(rule_t_none)
-
-            # set categories action cache
-            cls.TRANSFORMATIONS[ACTION][category_str][A_DROP] = set(drop_cats)
-            cls.TRANSFORMATIONS[ACTION][category_str][A_REJECT] = set(reject_cats)
-            cls.TRANSFORMATIONS[ACTION][category_str][A_FILESTORE] = set(filestore_cats)
-            cls.TRANSFORMATIONS[ACTION][category_str][A_BYPASS] = set(bypass_cats)
-            cls.TRANSFORMATIONS[ACTION][category_str][A_NONE] = set(none_cats)
-
-            cls.TRANSFORMATIONS[LATERAL][category_str][L_AUTO] = set(cat_l_auto)
-            cls.TRANSFORMATIONS[LATERAL][category_str][L_YES] = set(cat_l_yes)
-            cls.TRANSFORMATIONS[LATERAL][category_str][L_NO] = set(cat_l_no)
-
-            cls.TRANSFORMATIONS[TARGET][category_str][T_AUTO] = set(cat_t_auto)
-            cls.TRANSFORMATIONS[TARGET][category_str][T_SOURCE] = set(cat_t_src)
-            cls.TRANSFORMATIONS[TARGET][category_str][T_DST] = set(cat_t_dst)
-            cls.TRANSFORMATIONS[TARGET][category_str][T_NONE] = set(cat_t_none)
-
-            # set rulesets action cache
-            cls.TRANSFORMATIONS[ACTION][ruleset_str][A_DROP] = set(drop_rulesets)
-            cls.TRANSFORMATIONS[ACTION][ruleset_str][A_REJECT] = set(reject_rulesets)
-            cls.TRANSFORMATIONS[ACTION][ruleset_str][A_FILESTORE] = set(filestore_rulesets)
-            cls.TRANSFORMATIONS[ACTION][ruleset_str][A_BYPASS] = set(bypass_rulesets)
-
-            cls.TRANSFORMATIONS[LATERAL][ruleset_str][L_AUTO] = set(ruleset_l_auto)
-            cls.TRANSFORMATIONS[LATERAL][ruleset_str][L_YES] = set(ruleset_l_yes)
-
-            cls.TRANSFORMATIONS[TARGET][ruleset_str][T_AUTO] = set(ruleset_t_auto)
-            cls.TRANSFORMATIONS[TARGET][ruleset_str][T_SOURCE] = set(ruleset_t_src)
-            cls.TRANSFORMATIONS[TARGET][ruleset_str][T_DST] = set(ruleset_t_dst)
+    def is_rule_transformed(self, sid, key, value):
+        return self.rules[key.value].get(sid) == value.value
 
-        else:
-            raise Exception("Rule cache has not been closed")
+    def is_category_transformed(self, category_id, key, value):
+        return self.categories[key.value].get(category_id) == value.value
+
+    def get_ruleset(self, key):
+        return self._get_type(key, self.ruleset.get(key.value), exclude_none=True)
+
+    def get_category(self, key, category_id, override=False):
+        trans = self._get_type(key, self.categories[key.value].get(category_id))
+        if trans is None and override:
+            trans = self.get_ruleset(key)
+        return trans
+
+    def get(self, key, sid, category_id, override=True):
+        trans = self._get_type(key, self.rules[key.value].get(sid))
+        if trans is None and override:
+            trans = self.get_category(key, category_id, override=True)
+        return trans
+
+    def resolve(self, rule):
+        # action, lateral and target of the rule
+        return [self.get(key, rule.pk, rule.category_id) for key in self.KEYS]
+
+
+class TransformationsCache(object):
+    # Process wide cache of the transformations of all rulesets, thread safe.
+    # Any transformation change invalidates it in the current process and
+    # changes a version shared with other processes through the Django cache,
+    # which is checked every TRANSFORMATIONS_CACHE_CHECK_INTERVAL seconds.
+    # Until a transaction changing transformations is committed, its thread
+    # reads transformations from the database.
+    VERSION_KEY = 'rules_transformations_version'
+
+    _lock = threading.Lock()
+    _local = threading.local()
+    _rulesets = None
+    _generation = 0
+    _version = None
+    _checked = 0
 
     @classmethod
-    def disable_cache(cls):
-        if cls.TRANSFORMATIONS is not None:
-            del cls.TRANSFORMATIONS
-            cls.TRANSFORMATIONS = None
-        else:
-            raise Exception("%s cache has not been open" % cls.__name__)
+    def _check_version(cls):
+        now = time.time()
+        if now - cls._checked < settings.TRANSFORMATIONS_CACHE_CHECK_INTERVAL:
+            return
+        version = cache.get(cls.VERSION_KEY)
+        with cls._lock:
+            cls._checked = now
+            if version != cls._version:
+                cls._version = version
+                cls._rulesets = None
+                cls._generation += 1
+
+    @classmethod
+    def _in_transaction(cls):
+        # True if the changes of this thread are not committed yet: the
+        # callback registered by changed() is cleared once they are
+        committed = getattr(cls._local, 'committed', None)
+        if committed is None:
+            return False
+        if transaction.get_connection(router.db_for_write(RuleTransformation)).in_atomic_block:
+            return True
+        # transaction ended without the callback being run: rolled back
+        cls._local.committed = None
+        cls.invalidate()
+        return False
+
+    @classmethod
+    def get(cls, ruleset):
+        if cls._in_transaction():
+            return RulesetTransformations.load(ruleset)
+
+        cls._check_version()
+        with cls._lock:
+            rulesets = cls._rulesets
+            generation = cls._generation
+        if rulesets is None:
+            rulesets = RulesetTransformations.load()
+            with cls._lock:
+                # don't keep transformations invalidated during the load
+                if generation == cls._generation:
+                    cls._rulesets = rulesets
+        if ruleset.pk not in rulesets:
+            return RulesetTransformations()
+        return rulesets[ruleset.pk]
+
+    @classmethod
+    def invalidate(cls):
+        version = uuid.uuid4().hex
+        with cls._lock:
+            cls._rulesets = None
+            cls._generation += 1
+            cls._version = version
+        cache.set(cls.VERSION_KEY, version, None)
+
+    @classmethod
+    def changed(cls):
+        # To be called when transformations are changed
+        cls.invalidate()
+        if cls._in_transaction():
+            return
+
+        conn = transaction.get_connection(router.db_for_write(RuleTransformation))
+        if not conn.in_atomic_block:
+            return
+
+        def committed():
+            cls._local.committed = None
+            # transformations may have been loaded by other threads before the commit
+            cls.invalidate()
+
+        cls._local.committed = committed
+        transaction.on_commit(committed, using=conn.alias)
+
+
+IndexedRule = namedtuple('IndexedRule', ('rev', 'category_id', 'source_id', 'group'))
+
+
+class RulesIndex(object):
+    # Compact view of all existing rules used during sources update: only
+    # what is needed to know if a rule is new, changed or unchanged is
+    # kept in memory and Rule instances are loaded for changed sids only
+    def __init__(self):
+        self.rules = {}
+        self.categories = {}
+        rules = Rule.objects.values_list('sid', 'rev', 'category_id', 'category__source_id', 'group')
+        for sid, rev, category_id, source_id, group in rules.iterator():
+            self.add(sid, rev, category_id, source_id, group)
+
+    def get(self, sid):
+        return self.rules.get(sid)
+
+    def add(self, sid, rev, category_id, source_id, group):
+        previous = self.rules.get(sid)
+        if previous is not None and previous.category_id != category_id:
+            self.categories[previous.category_id].discard(sid)
+        self.rules[sid] = IndexedRule(rev, category_id, source_id, group)
+        self.categories.setdefault(category_id, set()).add(sid)
 
+    def category_sids(self, category_id):
+        return set(self.categories.get(category_id, ()))
 
-class Category(models.Model, Transformable, Cache):
+    @staticmethod
+    def load(sids):
+        sids = list(sids)
+        batch_size = settings.RULES_UPDATE_BATCH_SIZE
+        rules = {}
+        for i in xrange(0, len(sids), batch_size):
+            rules.update(Rule.objects.select_related('category').in_bulk(sids[i:i + batch_size]))
+        return rules
+
+
+class Category(models.Model, Transformable):
     name = models.CharField(max_length=100)
     filename = models.CharField(max_length=200)
     descr = models.CharField(max_length=400, blank = True)
@@ -1630,10 +1844,6 @@ class Category(models.Model, Transformable, Cache):
     def __unicode__(self):
         return self.name
 
-    def __init__(self, *args, **kwargs):
-        models.Model.__init__(self, *args, **kwargs)
-        Cache.__init__(self)
-
     @staticmethod
     def get_icon():
         return 'fa-list-alt'
@@ -1688,7 +1898,7 @@ class Category(models.Model, Transformable, Cache):
                     if rule_base_msg == existing_rules_hash[rule.sid].msg:
                         rules_update["updated"].append(existing_rules_hash[rule.sid])
             else:
-                rules_unchanged.append(sigs_groups[rule_base_msg])
+                rules_unchanged.append(sigs_groups[rule_base_msg].pk)
         else:
             creation_date = timezone.now()
             state = True
@@ -1734,26 +1944,8 @@ class Category(models.Model, Transformable, Cache):
             self.parse_group_signature(group_rule, rule)
             sigs_groups[group_rule.msg] = group_rule
 
-    def get_rules(self, source, existing_rules_hash=None):
-        # parse file
-        # return an object with updates
-        getsid = re.compile("sid *: *(\d+)")
-        getrev = re.compile("rev *: *(\d+)")
-        getmsg = re.compile("msg *: *\"(.*?)\"")
-        source_git_dir = os.path.join(settings.GIT_SOURCES_BASE_DIRECTORY, unicode(self.source.pk))
-        rfile = open(os.path.join(source_git_dir, self.filename))
-
-        rules_update = {"added": [], "deleted": [], "updated": []}
-        rules_unchanged = []
-
-        if existing_rules_hash == None:
-            existing_rules_hash = {}
-            for rule in Rule.objects.all().prefetch_related('category'):
-                existing_rules_hash[rule.sid] = rule
-        rules_list = []
-        for rule in Rule.objects.filter(category = self):
-            rules_list.append(rule)
-
+    @staticmethod
+    def build_flowbits(source):
         flowbits = { 'added': {'flowbit': [], 'through_set': [], 'through_isset': [] }}
         existing_flowbits = Flowbit.objects.all().order_by('-pk')
         if len(existing_flowbits):
@@ -1764,6 +1956,25 @@ class Category(models.Model, Transformable, Cache):
             flowbits[key] = {}
             for flowb in Flowbit.objects.filter(source=source, type=key):
                 flowbits[key][flowb.name] = flowb
+        flowbits['graph'] = FlowbitGraph(source=source)
+        return flowbits
+
+    def get_rules(self, source, rules_index=None, flowbits=None, parsed_rules=None):
+        # parse file
+        # return an object with updates
+        if parsed_rules is None:
+            source_git_dir = os.path.join(settings.GIT_SOURCES_BASE_DIRECTORY, unicode(self.source.pk))
+            parsed_rules = parse_rules_file(os.path.join(source_git_dir, self.filename))
+
+        rules_update = {"added": [], "deleted": [], "updated": []}
+        rules_unchanged = []
+        rules_changed = []
+
+        if rules_index is None:
+            rules_index = RulesIndex()
+        if flowbits is None:
+            flowbits = self.build_flowbits(source)
+        rules_list = rules_index.category_sids(self.pk)
 
         creation_date = timezone.now()
 
@@ -1771,85 +1982,81 @@ class Category(models.Model, Transformable, Cache):
         if source.use_iprep:
             rules_groups = self.build_sigs_group()
 
+        # only load full instances for rules that are going to be modified
+        modified_sids = []
+        for parsed in parsed_rules:
+            indexed = rules_index.get(parsed.sid)
+            if indexed is None:
+                continue
+            if source.use_iprep and Rule.GROUPSNAMEREGEXP.match(parsed.msg):
+                modified_sids.append(parsed.sid)
+            elif indexed.source_id == source.pk and (parsed.rev == None or indexed.rev < parsed.rev or indexed.group is True):
+                modified_sids.append(parsed.sid)
+        existing_rules = rules_index.load(modified_sids)
+
         with transaction.atomic():
             duplicate_source = set()
             duplicate_sids = set()
 
-            for line in rfile.readlines():
-                line = line.decode('utf-8')
-                state = True
-                if line.startswith('#'):
-                    # check if it is a commented signature
-                    if "->" in line and "sid" in line and ")" in line:
-                        line = line.lstrip("# ")
-                        state = False
-                    else:
-                        continue
-                match = getsid.search(line)
-                if not match:
-                    continue
-                sid = match.groups()[0]
-                match = getrev.search(line)
-                if match:
-                    rev = int(match.groups()[0])
-                else:
-                    rev = None
-                match = getmsg.search(line)
-                if not match:
-                    msg = ""
-                else:
-                    msg = match.groups()[0]
+            for parsed in parsed_rules:
+                sid = parsed.sid
+                rev = parsed.rev
+                msg = parsed.msg
+                line = parsed.content
 
                 if source.use_iprep and Rule.GROUPSNAMEREGEXP.match(msg):
-                    self.add_group_signature(rules_groups, line, existing_rules_hash, source, flowbits, rules_update, rules_unchanged)
+                    self.add_group_signature(rules_groups, line, existing_rules, source, flowbits, rules_update, rules_unchanged)
                 else:
-                    if existing_rules_hash.has_key(int(sid)):
+                    indexed = rules_index.get(sid)
+                    if indexed is not None:
                         # FIXME update references if needed
-                        rule = existing_rules_hash[int(sid)]
-                        if rule.category.source != source:
-                            source_name = rule.category.source.name
-                            duplicate_source.add(source_name)
-                            duplicate_sids.add(sid)
+                        if indexed.source_id != source.pk:
+                            duplicate_source.add(indexed.source_id)
+                            duplicate_sids.add(unicode(sid))
                             if len(duplicate_sids) == 20:
                                 break
                             continue
-                        if rev == None or rule.rev < rev or rule.group is True:
+                        if rev == None or indexed.rev < rev or indexed.group is True:
+                            rule = existing_rules[sid]
                             rule.content = line
                             if rev == None:
                                 rule.rev = 0
                             else:
                                 rule.rev = rev
-                            if rule.category != self:
+                            if rule.category_id != self.pk:
                                 rule.category = self
                             rule.msg = msg
                             rules_update["updated"].append(rule)
                             rule.updated_date = creation_date
-                            rule.parse_metadata()
-                            rule.save()
-                            rule.parse_flowbits(source, flowbits)
+                            rule.parse_metadata(metadata = parsed.metadata)
+                            rules_changed.append(rule)
+                            rule.parse_flowbits(source, flowbits, bits = parsed.bits)
+                            rules_index.add(sid, rule.rev, self.pk, source.pk, rule.group)
                         else:
-                            rules_unchanged.append(rule)
+                            rules_unchanged.append(sid)
                     else:
                         if rev == None:
                             rev = 0
                         rule = Rule(category = self, sid = sid,
                                             rev = rev, content = line, msg = msg,
-                                            state_in_source = state, state = state, imported_date = creation_date, updated_date = creation_date)
-                        rule.parse_metadata()
+                                            state_in_source = parsed.state, state = parsed.state, imported_date = creation_date, updated_date = creation_date)
+                        rule.parse_metadata(metadata = parsed.metadata)
                         rules_update["added"].append(rule)
-                        rule.parse_flowbits(source, flowbits, addition = True)
+                        rule.parse_flowbits(source, flowbits, addition = True, bits = parsed.bits)
 
             if len(duplicate_sids):
                 sids = sorted(duplicate_sids)
                 if len(sids) == 20:
                     sids += '...'
                 sids = ', '.join(sids)
-                source_name = ', '.join(sorted(duplicate_source))
+                source_name = ', '.join(sorted(Source.objects.filter(pk__in=duplicate_source).values_list('name', flat=True)))
 
                 raise ValidationError('The source contains conflicting SID (%s) with other sources (%s)' % (sids, source_name))
 
             if len(rules_update["added"]):
-                Rule.objects.bulk_create(rules_update["added"])
+                Rule.objects.bulk_create(rules_update["added"], batch_size=settings.RULES_UPDATE_BATCH_SIZE)
+            if len(rules_changed):
+                bulk_update(rules_changed, Rule.IMPORT_FIELDS, batch_size=settings.RULES_UPDATE_BATCH_SIZE)
             if len(rules_groups):
                 for rule in rules_groups:
                     # If IP list is empty it will be deleted because it has not
@@ -1865,9 +2072,14 @@ class Category(models.Model, Transformable, Cache):
                 Flowbit.set.through.objects.bulk_create(flowbits["added"]["through_set"])
             if len(flowbits["added"]["through_isset"]):
                 Flowbit.isset.through.objects.bulk_create(flowbits["added"]["through_isset"])
-            rules_update["deleted"] = list(set(rules_list) -
-                                      set(rules_update["added"]).union(set(rules_update["updated"])) -
-                                      set(rules_unchanged))
+            # flowbits state is kept for the next categories of the update
+            for key in flowbits['added']:
+                flowbits['added'][key] = []
+            for rule in rules_update["added"]:
+                rules_index.add(rule.sid, rule.rev, self.pk, source.pk, rule.group)
+            deleted_sids = rules_list - set([rule.pk for rule in rules_update["added"]]) - \
+                           set([rule.pk for rule in rules_update["updated"]]) - set(rules_unchanged)
+            rules_update["deleted"] = rules_index.load(deleted_sids).values()
             source.aggregate_update(rules_update)
 
     def get_absolute_url(self):
@@ -1901,11 +2113,7 @@ class Category(models.Model, Transformable, Cache):
             )
 
     def is_transformed(self, ruleset, key=Transformation.ACTION, value=Transformation.A_DROP):
-        if Category.TRANSFORMATIONS is None:
-            return (self.pk in ruleset.get_transformed_categories(key=key, value=value).values_list('pk', flat=True))
-
-        category_str = Category.__name__.lower()
-        return (self.pk in Category.TRANSFORMATIONS[key][category_str][value])
+        return TransformationsCache.get(ruleset).is_category_transformed(self.pk, key, value)
 
     def suppress_transformation(self, ruleset, key):
         CategoryTransformation.objects.filter(
@@ -1929,50 +2137,9 @@ class Category(models.Model, Transformable, Cache):
         ruleset.needs_test()
 
     def get_transformation(self, ruleset, key=Transformation.ACTION, override=False):
-        NONE = None
-        TYPE = None
-
-        if key == Transformation.ACTION:
-            NONE = Transformation.A_NONE
-            TYPE = Transformation.ActionTransfoType
-        elif key == Transformation.LATERAL:
-            NONE = Transformation.L_NO
-            TYPE = Transformation.LateralTransfoType
-        elif key == Transformation.TARGET:
-            NONE = Transformation.T_NONE
-            TYPE = Transformation.TargetTransfoType
-        else:
+        if key not in RulesetTransformations.KEYS:
             raise Exception("Key '%s' is unknown" % key)
-
-        if Category.TRANSFORMATIONS is None:
-            ct = CategoryTransformation.objects.filter(
-                                    key=key.value,
-                                    ruleset=ruleset,
-                                    category_transformation=self)
-            if len(ct) > 0:
-                return TYPE(ct[0].value)
-
-            if override:
-                rt = RulesetTransformation.objects.filter(
-                                    key=key.value,
-                                    ruleset_transformation=ruleset)
-                if len(rt) > 0:
-                    return TYPE(rt[0].value)
-
-        else:
-            category_str = Category.__name__.lower()
-            ruleset_str = Ruleset.__name__.lower()
-
-            for trans, tsets in Category.TRANSFORMATIONS[key][category_str].iteritems():
-                if self.pk in tsets:  # DROP / REJECT / FILESTORE / NONE
-                    return trans
-
-            if override:
-                for trans, tsets in Rule.TRANSFORMATIONS[key][ruleset_str].iteritems():
-                    if self.category.pk in tsets:
-                        return trans
-
-        return None
+        return TransformationsCache.get(ruleset).get_category(key, self.pk, override=override)
 
     @staticmethod
     def get_transformation_choices(key=Transformation.ACTION):
@@ -2009,7 +2176,7 @@ class Category(models.Model, Transformable, Cache):
         return tuple(sorted(allowed_choices))
 
 
-class Rule(models.Model, Transformable, Cache):
+class Rule(models.Model, Transformable):
     GROUP_BY_CHOICES= (('by_src', 'by_src'),('by_dst', 'by_dst'))
     sid = models.IntegerField(primary_key=True)
     category = models.ForeignKey(Category)
@@ -2028,22 +2195,16 @@ class Rule(models.Model, Transformable, Cache):
 
     hits = 0
 
-    BITSREGEXP = {'flowbits': re.compile("flowbits *: *(isset|set),(.*?) *;"),
-                  'hostbits': re.compile("hostbits *: *(isset|set),(.*?) *;"),
-                  'xbits': re.compile("xbits *: *(isset|set),(.*?) *;"),
-                 }
-
     IPSREGEXP = {'src': re.compile('^\S+ +\S+ (.*) +\S+ +\->'), 'dest': re.compile('\-> (.*) +\S+$')}
 
     GROUPSNAMEREGEXP = re.compile('^(.*) +group +\d+$')
 
+    # Fields modified when a rule is updated by a source import
+    IMPORT_FIELDS = ('category', 'msg', 'rev', 'content', 'updated_date', 'created', 'updated')
+
     def __unicode__(self):
         return unicode(self.sid) + ":" + self.msg
 
-    def __init__(self, *args, **kwargs):
-        models.Model.__init__(self, *args, **kwargs)
-        Cache.__init__(self)
-
     @staticmethod
     def get_icon():
         return 'pficon-security'
@@ -2052,36 +2213,38 @@ class Rule(models.Model, Transformable, Cache):
         from django.core.urlresolvers import reverse
         return reverse('rule', args=[unicode(self.sid)])
 
-    def parse_flowbits(self, source, flowbits, addition = False):
-        for ftype in self.BITSREGEXP:
-            match = self.BITSREGEXP[ftype].findall(self.content)
-            if match:
-                rule_flowbits = []
-                for flowinst in match:
-                    # avoid flowbit duplicate
-                    if not flowinst[1] in rule_flowbits:
-                        rule_flowbits.append(flowinst[1])
-                    else:
-                        continue
-                    # create Flowbit if needed
-                    if not flowinst[1] in flowbits[ftype].keys():
-                        elt = Flowbit(type = ftype, name = flowinst[1],
-                                      source = source)
-                        flowbits['last_pk'] += 1
-                        elt.id = flowbits['last_pk']
-                        flowbits[ftype][flowinst[1]] = elt
-                        flowbits['added']['flowbit'].append(elt)
-                    else:
-                        elt = flowbits[ftype][flowinst[1]]
-
-                    if flowinst[0] == "isset":
-                        if addition or not self.checker.filter(isset=self):
-                            through_elt = Flowbit.isset.through(flowbit=elt, rule=self)
-                            flowbits['added']['through_isset'].append(through_elt)
-                    else:
-                        if addition or not self.setter.filter(set=self):
-                            through_elt = Flowbit.set.through(flowbit=elt, rule=self)
-                            flowbits['added']['through_set'].append(through_elt)
+    def parse_flowbits(self, source, flowbits, addition = False, bits = None):
+        if bits is None:
+            bits = RuleParser().parse_bits(self.content)
+        rule_flowbits = []
+        for ftype, operation, name in bits:
+            # avoid flowbit duplicate
+            if not (ftype, name) in rule_flowbits:
+                rule_flowbits.append((ftype, name))
+            else:
+                continue
+            # create Flowbit if needed
+            if not name in flowbits[ftype]:
+                elt = Flowbit(type = ftype, name = name,
+                              source = source)
+                flowbits['last_pk'] += 1
+                elt.id = flowbits['last_pk']
+                flowbits[ftype][name] = elt
+                flowbits['added']['flowbit'].append(elt)
+            else:
+                elt = flowbits[ftype][name]
+
+            graph = flowbits['graph']
+            if operation == "isset":
+                if addition or not graph.is_checker(elt.pk, self.pk):
+                    through_elt = Flowbit.isset.through(flowbit=elt, rule=self)
+                    flowbits['added']['through_isset'].append(through_elt)
+                    graph.add_checker(elt.pk, self.pk)
+            else:
+                if addition or not graph.is_setter(elt.pk, self.pk):
+                    through_elt = Flowbit.set.through(flowbit=elt, rule=self)
+                    flowbits['added']['through_set'].append(through_elt)
+                    graph.add_setter(elt.pk, self.pk)
 
     def parse_metadata_time(self, sfield):
         sdate = sfield.split(' ')[1]
@@ -2095,14 +2258,10 @@ class Rule(models.Model, Transformable, Cache):
 
         return None
 
-    def parse_metadata(self):
-        try:
-            rule_ids = rule_idstools.parse(self.content)
-        except:
-            return
-        if rule_ids is None:
-            return
-        for meta in rule_ids.metadata:
+    def parse_metadata(self, metadata = None):
+        if metadata is None:
+            metadata = RuleParser().parse_metadata(self.content)
+        for meta in metadata:
             if meta.startswith('created_at '):
                 self.created = self.parse_metadata_time(meta)
             if meta.startswith('updated_at '):
@@ -2118,23 +2277,24 @@ class Rule(models.Model, Transformable, Cache):
     # flowbit dependency:
     # if we disable a rule that is the last one set a flag then we must disable all the 
     # dependant rules
-    def get_dependant_rules(self, ruleset):
-        # get list of flowbit we are setting
-        flowbits_list = Flowbit.objects.filter(set = self).prefetch_related('set', 'isset')
-        dependant_rules = []
-        for flowbit in flowbits_list:
-            set_count = 0
-            for rule in flowbit.set.all():
-                if rule == self:
-                    continue
-                if rule.is_active(ruleset):
-                    set_count += 1
-            if set_count == 0:
-                dependant_rules.extend(list(flowbit.isset.all()))
-                # we need to recurse if ever we did disable in a chain of signatures
-                for drule in flowbit.isset.all():
-                    dependant_rules.extend(drule.get_dependant_rules(ruleset))
-        return dependant_rules
+    def get_dependant_rules(self, ruleset, flowbit_graph = None):
+        # callers handling many rules share a full graph, a single rule only
+        # loads its own flowbits chains
+        if flowbit_graph is None:
+            flowbit_graph = FlowbitGraph(sid = self.pk)
+        # rules that could be reached if no other rule sets the flowbits
+        if not flowbit_graph.dependant_sids(self.pk):
+            return []
+
+        SUPPRESSED = Transformation.SUPPRESSED
+        S_SUPPRESSED = Transformation.S_SUPPRESSED
+        suppressed = ruleset.get_transformed_rules(key=SUPPRESSED, value=S_SUPPRESSED).values('pk')
+        active_setters = Rule.objects.filter(setter__isnull=False, state=True, category__in=ruleset.categories.all())
+        active_setters = set(active_setters.exclude(pk__in=suppressed).values_list('pk', flat=True).distinct())
+
+        sids = flowbit_graph.dependant_sids(self.pk, active_setters)
+        rules = RulesIndex.load(sids)
+        return [rules[sid] for sid in sids if sid in rules]
 
     def get_actions(self):
         uas = UserAction.objects.filter(
@@ -2149,9 +2309,9 @@ class Rule(models.Model, Transformable, Cache):
                 user_action_objects__object_id=self.pk).order_by('-date')
         return uas
 
-    def enable(self, ruleset, user = None, comment = None):
+    def enable(self, ruleset, user = None, comment = None, flowbit_graph = None):
         enable_rules = [self]
-        enable_rules.extend(self.get_dependant_rules(ruleset))
+        enable_rules.extend(self.get_dependant_rules(ruleset, flowbit_graph = flowbit_graph))
         ruleset.enable_rules(enable_rules)
         if user:
             UserAction.create(
@@ -2163,9 +2323,9 @@ class Rule(models.Model, Transformable, Cache):
             )
         return
 
-    def disable(self, ruleset, user = None, comment = None):
+    def disable(self, ruleset, user = None, comment = None, flowbit_graph = None):
         disable_rules = [self]
-        disable_rules.extend(self.get_dependant_rules(ruleset))
+        disable_rules.extend(self.get_dependant_rules(ruleset, flowbit_graph = flowbit_graph))
         ruleset.disable_rules(disable_rules)
         if user:
             UserAction.create(
@@ -2179,12 +2339,9 @@ class Rule(models.Model, Transformable, Cache):
 
     def test(self, ruleset):
         try:
-            self.enable_cache()
             test = ruleset.test_rule_buffer(self.generate_content(ruleset), single = True)
         except:
             return False
-        finally:
-            self.disable_cache()
         return test
 
     def toggle_availability(self):
@@ -2244,69 +2401,12 @@ class Rule(models.Model, Transformable, Cache):
         return (rule_ids is not None)
 
     def is_transformed(self, ruleset, key=Transformation.ACTION, value=Transformation.A_DROP):
-        if Rule.TRANSFORMATIONS is None:
-            return (self in ruleset.get_transformed_rules(key=key, value=value).values_list('pk', flat=True))
-
-        rule_str = Rule.__name__.lower()
-        return (self.pk in Rule.TRANSFORMATIONS[key][rule_str][value])
+        return TransformationsCache.get(ruleset).is_rule_transformed(self.pk, key, value)
 
     def get_transformation(self, ruleset, key=Transformation.ACTION, override=False):
-        NONE = None
-        TYPE = None
-
-        if key == Transformation.ACTION:
-            NONE = Transformation.A_NONE
-            TYPE = Transformation.ActionTransfoType
-        elif key == Transformation.LATERAL:
-            NONE = Transformation.L_NO
-            TYPE = Transformation.LateralTransfoType
-        elif key == Transformation.TARGET:
-            NONE = Transformation.T_NONE
-            TYPE = Transformation.TargetTransfoType
-        else:
+        if key not in RulesetTransformations.KEYS:
             raise Exception("Key '%s' is unknown" % key)
-
-        if Rule.TRANSFORMATIONS is None:
-            rt = RuleTransformation.objects.filter(
-                                key=key.value,
-                                ruleset=ruleset,
-                                rule_transformation=self).all()
-            if len(rt) > 0:
-                return TYPE(rt[0].value)
-
-            if override:
-                ct = CategoryTransformation.objects.filter(
-                                        key=key.value,
-                                        ruleset=ruleset,
-                                        category_transformation=self.category).all()
-                if len(ct) > 0:
-                    return TYPE(ct[0].value)
-
-                rt = RulesetTransformation.objects.filter(
-                                    key=key.value,
-                                    ruleset_transformation=ruleset)
-                if len(rt) > 0:
-                    return TYPE(rt[0].value)
-
-        else:
-            rule_str = Rule.__name__.lower()
-            category_str = Category.__name__.lower()
-            ruleset_str = Ruleset.__name__.lower()
-
-            for trans, tsets in Rule.TRANSFORMATIONS[key][rule_str].iteritems():
-                if self.pk in tsets:
-                    return trans
-
-            if override:
-                for trans, tsets in Rule.TRANSFORMATIONS[key][category_str].iteritems():
-                    if self.category.pk in tsets:
-                        return trans
-
-                for trans, tsets in Rule.TRANSFORMATIONS[key][ruleset_str].iteritems():
-                    if ruleset.pk in tsets:
-                        return trans
-
-        return None
+        return TransformationsCache.get(ruleset).get(key, self.pk, self.category_id, override=override)
 
     def remove_transformations(self, ruleset, key):
         RuleTransformation.objects.filter(
@@ -2314,7 +2414,7 @@ class Rule(models.Model, Transformable, Cache):
                 rule_transformation=self,
                 key=key.value).delete()
 
-        ruleset.needs_test()
+        ruleset.needs_test(rules=[self])
         ruleset.save()
 
     def set_transformation(self, ruleset, key=Transformation.ACTION, value=Transformation.A_DROP):
@@ -2327,47 +2427,56 @@ class Rule(models.Model, Transformable, Cache):
                 value=value.value)
         r.save()
 
-        ruleset.needs_test()
+        ruleset.needs_test(rules=[self])
         ruleset.save()
 
     def generate_content(self, ruleset):
+        # explicitely set prio on transformation here
+        action = self.get_transformation(key=Transformation.ACTION, ruleset=ruleset, override=True)
+        lateral = self.get_transformation(key=Transformation.LATERAL, ruleset=ruleset, override=True)
+        target = self.get_transformation(key=Transformation.TARGET, ruleset=ruleset, override=True)
+        return self.transform_content(action, lateral, target)
+
+    def transform_content(self, action=None, lateral=None, target=None):
+        # Apply the resolved transformations to the rule content. Rule is
+        # parsed once with idstools for both lateral and target.
         content = self.content
 
-        # explicitely set prio on transformation here
         # Action
-        ACTION = Transformation.ACTION
         A_DROP = Transformation.A_DROP
         A_FILESTORE = Transformation.A_FILESTORE
         A_REJECT = Transformation.A_REJECT
         A_BYPASS = Transformation.A_BYPASS
 
-        trans = self.get_transformation(key=ACTION, ruleset=ruleset, override=True)
-        if (trans in (A_DROP, A_REJECT) and self.can_drop()) or \
-                (trans == A_FILESTORE and self.can_filestore()) or \
-                (trans == A_BYPASS):
-            content = self.apply_transformation(content, key=Transformation.ACTION, value=trans)
-
-        # Lateral
-        LATERAL = Transformation.LATERAL
-        L_AUTO = Transformation.L_AUTO
-        L_YES = Transformation.L_YES
+        if (action in (A_DROP, A_REJECT) and self.can_drop()) or \
+                (action == A_FILESTORE and self.can_filestore()) or \
+                (action == A_BYPASS):
+            content = self.apply_transformation(content, key=Transformation.ACTION, value=action)
 
-        trans = self.get_transformation(key=LATERAL, ruleset=ruleset, override=True)
-        if trans in (L_YES, L_AUTO) and self.can_lateral(trans):
-            content = self.apply_transformation(content, key=Transformation.LATERAL, value=trans)
+        if lateral not in (Transformation.L_YES, Transformation.L_AUTO):
+            lateral = None
+        if target not in (Transformation.T_SOURCE, Transformation.T_DESTINATION, Transformation.T_AUTO):
+            target = None
 
-        # Target
-        TARGET = Transformation.TARGET
-        T_SOURCE = Transformation.T_SOURCE
-        T_DESTINATION = Transformation.T_DESTINATION
-        T_AUTO = Transformation.T_AUTO
+        if lateral is not None or target is not None:
+            try:
+                rule_ids = rule_idstools.parse(content)
+            except:
+                rule_ids = None
 
-        trans = self.get_transformation(key=TARGET, ruleset=ruleset, override=True)
-        if trans in (T_SOURCE, T_DESTINATION, T_AUTO):
-            c = content
-            if isinstance(content, unicode):
-                c = content.encode('utf8')
-            content = self.apply_transformation(c, key=Transformation.TARGET, value=trans)
+            # Workaround: ref #674
+            # Cannot transform, idstools cannot parse it
+            # don't work on commented rules
+            if rule_ids is not None and not rule_ids.format().startswith("#"):
+                # Lateral
+                if lateral is not None and 'outbound' not in rule_ids['msg'].lower() and '$EXTERNAL_NET' in rule_ids.raw:
+                    if self.transform_parsed_rule(rule_ids, Transformation.LATERAL, lateral):
+                        content = rule_ids.format()
+
+                # Target
+                if target is not None:
+                    if self.transform_parsed_rule(rule_ids, Transformation.TARGET, target):
+                        content = rule_ids.format()
 
         if isinstance(content, str):
             content = content.decode('utf8')
@@ -2457,6 +2566,86 @@ class Flowbit(models.Model):
     source = models.ForeignKey(Source)
 
 
+class FlowbitGraph(object):
+    # In memory view of the flowbits links: sids of the rules setting and
+    # checking each flowbit, and flowbits set by each sid. It is built once
+    # per operation so walking dependencies does not hit the database.
+    # With sid, only the flowbits chains starting at that rule are loaded.
+    def __init__(self, source = None, sid = None):
+        self.setters = defaultdict(set)
+        self.checkers = defaultdict(set)
+        self.sets = defaultdict(set)
+        if sid is not None:
+            self._load_chains(sid)
+            return
+
+        set_links = Flowbit.set.through.objects.all()
+        isset_links = Flowbit.isset.through.objects.all()
+        if source is not None:
+            set_links = set_links.filter(flowbit__source=source)
+            isset_links = isset_links.filter(flowbit__source=source)
+        for flowbit_id, sid in set_links.values_list('flowbit_id', 'rule_id').iterator():
+            self.add_setter(flowbit_id, sid)
+        for flowbit_id, sid in isset_links.values_list('flowbit_id', 'rule_id').iterator():
+            self.add_checker(flowbit_id, sid)
+
+    def _load_chains(self, sid):
+        # One level of the chains at a time: the flowbits set by the current
+        # sids, then all the setters and checkers of these flowbits
+        loaded_sids = set()
+        loaded_flowbits = set()
+        sids = set([sid])
+        while sids:
+            loaded_sids |= sids
+            flowbits = Flowbit.set.through.objects.filter(rule_id__in=sids).values_list('flowbit_id', flat=True)
+            flowbits = set(flowbits) - loaded_flowbits
+            if not flowbits:
+                break
+            loaded_flowbits |= flowbits
+
+            set_links = Flowbit.set.through.objects.filter(flowbit_id__in=flowbits)
+            for flowbit_id, setter in set_links.values_list('flowbit_id', 'rule_id'):
+                self.add_setter(flowbit_id, setter)
+            isset_links = Flowbit.isset.through.objects.filter(flowbit_id__in=flowbits)
+            sids = set()
+            for flowbit_id, checker in isset_links.values_list('flowbit_id', 'rule_id'):
+                self.add_checker(flowbit_id, checker)
+                sids.add(checker)
+            sids -= loaded_sids
+
+    def add_setter(self, flowbit_id, sid):
+        self.setters[flowbit_id].add(sid)
+        self.sets[sid].add(flowbit_id)
+
+    def add_checker(self, flowbit_id, sid):
+        self.checkers[flowbit_id].add(sid)
+
+    def is_setter(self, flowbit_id, sid):
+        return sid in self.setters.get(flowbit_id, ())
+
+    def is_checker(self, flowbit_id, sid):
+        return sid in self.checkers.get(flowbit_id, ())
+
+    def dependant_sids(self, sid, active_setters = frozenset()):
+        # Sids of the rules checking a flowbit set by sid and by no other rule
+        # in active_setters, followed recursively. Each sid is visited once so
+        # cyclic flowbits chains terminate.
+        dependant = []
+        visited = set([sid])
+        stack = [sid]
+        while stack:
+            current = stack.pop()
+            for flowbit_id in sorted(self.sets.get(current, ())):
+                if any(setter != current and setter in active_setters for setter in self.setters[flowbit_id]):
+                    continue
+                for checker in sorted(self.checkers.get(flowbit_id, ())):
+                    if checker not in visited:
+                        visited.add(checker)
+                        dependant.append(checker)
+                        stack.append(checker)
+        return dependant
+
+
 # we should use django reversion to keep track of this one
 # even if fixing HEAD may be complicated
 class Ruleset(models.Model, Transformable):
@@ -2470,6 +2659,13 @@ class Ruleset(models.Model, Transformable):
     rules_count = models.IntegerField(default=0)
 
     editable = True
+    # Number of rules of the rulesets by artifact state, see artifact_state
+    RULES_COUNTS_CACHE_SIZE = 64
+    # Records of the artifact offsets file: sid, position and length of the
+    # rule content in the rules file
+    ARTIFACT_RECORD = struct.Struct(b'>QQI')
+    _rules_counts = OrderedDict()
+    _rules_counts_lock = threading.Lock()
 
     # List of Source that can be used in the ruleset
     # It can be a specific version or HEAD if we want to use
@@ -2669,12 +2865,38 @@ class Ruleset(models.Model, Transformable):
 
     def update(self):
         update_errors = []
-        sourcesatversion = self.sources.all()
-        for sourcesat in sourcesatversion:
+        sourcesatversion = self.sources.select_related('source')
+        sources = [sourcesat.source for sourcesat in sourcesatversion]
+
+        # Download and extraction of the sources are done concurrently,
+        # import in database is then done sequentially
+        fetched = [None] * len(sources)
+        workers = min(settings.SOURCES_UPDATE_WORKERS, len(sources))
+        if workers > 1:
+            # fetched once here as threads must not access the database
+            proxy_params = get_system_settings().get_proxy_params() or {}
+            pool = ThreadPool(processes=workers)
             try:
-                sourcesat.source.update()
-            except IOError as e:
-                update_errors.append('Source "%s" update failed:\n%s' % (sourcesat.source.name, e.message))
+                fetched = pool.map(lambda source: fetch_source(source, proxy_params), sources)
+            finally:
+                pool.close()
+                pool.join()
+
+        try:
+            for source, result in zip(sources, fetched):
+                try:
+                    if result is None:
+                        source.update()
+                    else:
+                        is_fetched, exc_info = result
+                        if exc_info:
+                            raise exc_info[0], exc_info[1], exc_info[2]
+                        source.update(fetched=is_fetched)
+                except IOError as e:
+                    update_errors.append('Source "%s" update failed:\n%s' % (source.name, e.message))
+        finally:
+            for source in sources:
+                source.clean_fetched()
 
         # Update timestamp if at least one source update was successful
         if len(sourcesatversion) != 0 and len(sourcesatversion) != len(update_errors):
@@ -2685,25 +2907,47 @@ class Ruleset(models.Model, Transformable):
         if len(update_errors):
             raise IOError('\n'.join(update_errors))
 
+    def get_selected_rules(self):
+        # Active rules of the selected categories, before suppression
+        sources = self.sources.values('source')
+        return Rule.objects.filter(category__ruleset=self, category__source__in=sources, state=True)
+
     def generate(self):
         # TODO: manage other types
+        SUPPRESSED = Transformation.SUPPRESSED
         S_SUPPRESSED = Transformation.S_SUPPRESSED
 
-        sources = self.sources.values_list('source', flat=True)
-        rules = Rule.objects.select_related('category')
-        rules = rules.filter(category__source__pk__in=sources, category__in=self.categories.all(), state=True)
-        rules = rules.exclude(ruletransformation__value=S_SUPPRESSED.value)
+        suppressed = RuleTransformation.objects.filter(ruleset=self, key=SUPPRESSED.value, value=S_SUPPRESSED.value)
+        rules = self.get_selected_rules().select_related('category')
+        rules = rules.exclude(pk__in=suppressed.values('rule_transformation'))
         return rules
 
+    @staticmethod
+    def get_rules_counts():
+        # Number of rules of all rulesets, by pk, in one query
+        SUPPRESSED = Transformation.SUPPRESSED
+        S_SUPPRESSED = Transformation.S_SUPPRESSED
+
+        selected = Q(categories__rule__state=True, categories__source__sourceatversion__ruleset=F('pk'))
+        suppressed = selected & Q(categories__rule__ruletransformation__ruleset=F('pk'),
+                                  categories__rule__ruletransformation__key=SUPPRESSED.value,
+                                  categories__rule__ruletransformation__value=S_SUPPRESSED.value)
+        counts = Ruleset.objects.values_list('pk').annotate(
+            selected=models.Count(Case(When(selected, then='categories__rule')), distinct=True),
+            suppressed=models.Count(Case(When(suppressed, then='categories__rule')), distinct=True))
+        return dict((pk, selected - suppressed) for pk, selected, suppressed in counts)
+
+    def get_threshold_buffer(self):
+        thresholds = ["%s\n" % (threshold) for threshold in Threshold.objects.filter(ruleset = self).select_related('rule')]
+
+        from scirius.utils import get_middleware_module
+        thresholds.extend(get_middleware_module('common').get_processing_filter_thresholds(self))
+        return ''.join(thresholds)
+
     def generate_threshold(self, directory):
         thresholdfile = os.path.join(directory, 'threshold.config')
         with open(thresholdfile, 'w') as f:
-            for threshold in Threshold.objects.filter(ruleset = self):
-                f.write("%s\n" % (threshold))
-
-            from scirius.utils import get_middleware_module
-            for threshold in get_middleware_module('common').get_processing_filter_thresholds(self):
-                f.write(threshold)
+            f.write(self.get_threshold_buffer())
 
     def copy(self, name):
         orig_ruleset_pk = self.pk
@@ -2763,52 +3007,321 @@ class Ruleset(models.Model, Transformable):
                     sdiff[sourceat.name] = srcdiff
         return sdiff
 
-    def to_buffer(self):
-        rules = self.generate()
-        self.rules_count = len(rules)
-        file_content = "# Rules file for %s generated by Scirius at %s\n" % (self.name, unicode(timezone.now()))
+    def artifact_state(self):
+        # State the rules file depends on, computed without generating it.
+        # 'base' covers what requires a full generation when it changes,
+        # rules transformations and suppressions can be patched. Rules only
+        # change when their source is updated, so the number of rules is
+        # only counted again when sources, categories or suppressions change.
+        SUPPRESSED = Transformation.SUPPRESSED
+        S_SUPPRESSED = Transformation.S_SUPPRESSED
 
-        if len(rules) > 0:
+        digest = hashlib.sha256()
+
+        def feed(*values):
+            digest.update(repr(values).encode('utf-8'))
+            digest.update(b'\n')
+
+        feed(self.pk, self.name)
+        feed(sorted(self.sources.values_list('source_id', 'version', 'updated_date', 'source__updated_date')))
+        feed(sorted(self.categories.values_list('pk', flat=True)))
+
+        transformations = RulesetTransformations.load(self)
+        values = transformations.categories
+        feed(sorted((key, sorted(values[key].items())) for key in values))
+        feed(sorted(transformations.ruleset.items()))
+        feed(list(Threshold.objects.filter(ruleset=self).order_by('pk').values_list(
+            'pk', 'threshold_type', 'type', 'gid', 'rule_id', 'track_by', 'net', 'count', 'seconds')))
+        base = digest.hexdigest()
+
+        rules_transformations = []
+        for key in RulesetTransformations.KEYS:
+            for sid, value in transformations.rules[key.value].iteritems():
+                rules_transformations.append((key.value, sid, value))
+        rules_transformations.sort()
+        suppressed = transformations.rules[SUPPRESSED.value]
+        suppressed = sorted(sid for sid, value in suppressed.iteritems() if value == S_SUPPRESSED.value)
+
+        key = (self.pk, base, hashlib.sha256(repr(suppressed)).hexdigest())
+        with Ruleset._rules_counts_lock:
+            rules_count = Ruleset._rules_counts.pop(key, None)
+            if rules_count is not None:
+                Ruleset._rules_counts[key] = rules_count
+        if rules_count is None:
+            rules_count = self.generate().count()
+            with Ruleset._rules_counts_lock:
+                Ruleset._rules_counts[key] = rules_count
+                while len(Ruleset._rules_counts) > self.RULES_COUNTS_CACHE_SIZE:
+                    Ruleset._rules_counts.popitem(last=False)
+
+        digest.update(repr((rules_transformations, suppressed, rules_count)).encode('utf-8'))
+        return {
+            'fingerprint': digest.hexdigest(),
+            'base': base,
+            'rules': rules_transformations,
+            'suppressed': suppressed,
+            'rules_count': rules_count,
+            'transformations': transformations,
+        }
+
+    def _artifact_path(self, fingerprint='*', ext='rules'):
+        return os.path.join(settings.RULESET_ARTIFACTS_DIRECTORY, '%s-%s.%s' % (self.pk, fingerprint, ext))
+
+    def invalidate_artifact(self, keep=None):
+        # With keep, only files older than the kept ones are removed: files
+        # stored meanwhile by a concurrent generation are left in place.
+        keep = keep or ()
+        keep_mtime = None
+        if keep:
+            try:
+                keep_mtime = min(os.path.getmtime(path) for path in keep)
+            except OSError:
+                # already replaced by a concurrent generation
+                return
+        for path in glob.glob(self._artifact_path(ext='*')):
+            if path in keep:
+                continue
             try:
-                Rule.enable_cache()
+                if keep_mtime is None or os.path.getmtime(path) < keep_mtime:
+                    os.unlink(path)
+            except OSError:
+                pass
 
-                rules_content = []
-                for rule in rules:
-                    c = rule.generate_content(self)
-                    if c:
-                        rules_content.append(c)
-                file_content += "\n".join(rules_content)
-            finally:
-                Rule.disable_cache()
+    def _load_artifact_index(self, state):
+        # State of the last generated rules file and paths of its files, if
+        # it can be patched to match state
+        paths = glob.glob(self._artifact_path(ext='json'))
+        if not paths:
+            return None
+        index_path = max(paths, key=os.path.getmtime)
+        try:
+            with open(index_path, 'rb') as f:
+                index = json.loads(f.read().decode('utf-8'))
+        except (IOError, OSError, ValueError):
+            return None
+        if index.get('base') != state['base']:
+            return None
+        fingerprint = os.path.basename(index_path)[len('%s-' % self.pk):-len('.json')]
+        index['path'] = self._artifact_path(fingerprint)
+        index['offsets_path'] = self._artifact_path(fingerprint, ext='idx')
+        return index
+
+    def _find_artifact_record(self, offsets_file, sid):
+        # Binary search of the record of sid, records are sorted by sid
+        size = self.ARTIFACT_RECORD.size
+        low = 0
+        high = os.fstat(offsets_file.fileno()).st_size // size
+        while low < high:
+            middle = (low + high) // 2
+            offsets_file.seek(middle * size)
+            record = self.ARTIFACT_RECORD.unpack(offsets_file.read(size))
+            if record[0] == sid:
+                return record
+            if record[0] < sid:
+                low = middle + 1
+            else:
+                high = middle
+        return None
 
-        return file_content
+    def _patch_artifact(self, index, state):
+        # Only rules with changed transformations or suppression are
+        # generated again, they are looked up in the offsets file of the
+        # last rules file. Flowbit dependants of enabled or disabled rules
+        # have their own suppression changes.
+        old_rules = set(tuple(rt) for rt in index['rules'])
+        changed = set(sid for _, sid, _ in old_rules.symmetric_difference(state['rules']))
+        changed.update(set(index['suppressed']).symmetric_difference(state['suppressed']))
+        if len(changed) > settings.RULESET_ARTIFACT_PATCH_MAX_RULES:
+            return None
+
+        try:
+            rules_file = open(index['path'], 'rb')
+        except IOError:
+            return None
+        try:
+            offsets_file = open(index['offsets_path'], 'rb')
+        except IOError:
+            rules_file.close()
+            return None
+
+        try:
+            removed = len([sid for sid in changed if self._find_artifact_record(offsets_file, sid) is not None])
+            changed_entries = {}
+            if changed:
+                transformations = state['transformations']
+                for rule in self.generate().filter(pk__in=changed):
+                    changed_entries[rule.pk] = rule.transform_content(*transformations.resolve(rule)) or ''
+        except:
+            rules_file.close()
+            offsets_file.close()
+            raise
+        if index['rules_count'] - removed + len(changed_entries) != state['rules_count']:
+            rules_file.close()
+            offsets_file.close()
+            return None
+        return self._patched_entries(rules_file, offsets_file, changed, changed_entries)
+
+    def _patched_entries(self, rules_file, offsets_file, changed, changed_entries):
+        # Merge of the unchanged rules, read in order from the last rules
+        # file, with the changed ones
+        size = self.ARTIFACT_RECORD.size
+        pending = sorted(changed_entries.items(), reverse=True)
+        position = 0
+        try:
+            offsets_file.seek(0)
+            for data in iter(lambda: offsets_file.read(size * 1024), b''):
+                for start in xrange(0, len(data), size):
+                    sid, offset, length = self.ARTIFACT_RECORD.unpack_from(data, start)
+                    while pending and pending[-1][0] < sid:
+                        yield pending.pop()
+                    if sid in changed:
+                        continue
+                    # contents are stored in order, only separators are skipped
+                    rules_file.read(offset - position)
+                    yield sid, rules_file.read(length)
+                    position = offset + length
+            while pending:
+                yield pending.pop()
+        finally:
+            rules_file.close()
+            offsets_file.close()
+
+    def _generate_entries(self, transformations):
+        # server side cursor, rules are not all loaded in memory
+        for rule in self.generate().order_by('pk').iterator():
+            yield rule.pk, rule.transform_content(*transformations.resolve(rule)) or ''
+
+    def _generate_artifact(self, state, entries=None):
+        # Write the rules file and its index, yielding the rules file by
+        # chunks. entries are the content of the rules by sid, in sid order,
+        # they are generated from the database if not given. The index is
+        # made of the state of the rules file and of an offsets file.
+        if entries is None:
+            entries = self._generate_entries(state['transformations'])
+        if not os.path.isdir(settings.RULESET_ARTIFACTS_DIRECTORY):
+            try:
+                os.makedirs(settings.RULESET_ARTIFACTS_DIRECTORY)
+            except OSError:
+                # created by a concurrent process
+                pass
+
+        path = self._artifact_path(state['fingerprint'])
+        index_path = self._artifact_path(state['fingerprint'], ext='json')
+        offsets_path = self._artifact_path(state['fingerprint'], ext='idx')
+        files = [tempfile.NamedTemporaryFile(dir=settings.RULESET_ARTIFACTS_DIRECTORY, delete=False) for _ in xrange(3)]
+        rules_file, index_file, offsets_file = files
+        complete = False
+        try:
+            header = ("# Rules file for %s generated by Scirius at %s\n" % (self.name, unicode(timezone.now()))).encode('utf-8')
+            chunk = [header]
+            size = len(header)
+            offset = size
+            separator = b''
+            rules_count = 0
+            for sid, content in entries:
+                rules_count += 1
+                if isinstance(content, unicode):
+                    content = content.encode('utf-8')
+                if content:
+                    chunk.append(separator)
+                    offset += len(separator)
+                    separator = b'\n'
+                offsets_file.write(self.ARTIFACT_RECORD.pack(sid, offset, len(content)))
+                if not content:
+                    continue
+                chunk.append(content)
+                offset += len(content)
+                size += len(content) + 1
+                if size >= settings.RULESET_EXPORT_CHUNK_SIZE:
+                    data = b''.join(chunk)
+                    rules_file.write(data)
+                    yield data
+                    chunk = []
+                    size = 0
+            data = b''.join(chunk)
+            if data:
+                rules_file.write(data)
+                yield data
+            index_file.write(json.dumps({
+                'base': state['base'],
+                'rules': state['rules'],
+                'suppressed': state['suppressed'],
+                'rules_count': rules_count,
+            }).encode('utf-8'))
+
+            for f in files:
+                f.close()
+            os.rename(offsets_file.name, offsets_path)
+            os.rename(index_file.name, index_path)
+            os.rename(rules_file.name, path)
+            complete = True
+        finally:
+            if not complete:
+                # error or generator not consumed until its end
+                for f in files:
+                    f.close()
+                    os.unlink(f.name)
+
+        self.rules_count = rules_count
+        self.invalidate_artifact(keep=(path, index_path, offsets_path))
+
+    def iter_buffer(self):
+        # The rules file is stored on disk, named by its fingerprint, and
+        # read as long as the fingerprint does not change. An index of the
+        # rules content by sid is stored with it, to patch the file when
+        # only a few rules change. Otherwise rules are streamed from the
+        # database so memory usage does not depend on the ruleset size.
+        state = self.artifact_state()
+        try:
+            f = open(self._artifact_path(state['fingerprint']), 'rb')
+        except IOError:
+            pass
+        else:
+            self.rules_count = state['rules_count']
+            with f:
+                for data in iter(lambda: f.read(settings.RULESET_EXPORT_CHUNK_SIZE), b''):
+                    yield data
+            return
+
+        entries = None
+        index = self._load_artifact_index(state)
+        if index is not None:
+            entries = self._patch_artifact(index, state)
+        for data in self._generate_artifact(state, entries):
+            yield data
+
+    def to_buffer(self):
+        return b''.join(self.iter_buffer()).decode('utf-8')
 
     def number_of_rules(self):
-        rules = self.generate()
-        self.rules_count = len(rules)
+        self.rules_count = self.generate().count()
         self.save()
         result = {'rules_count': self.rules_count}
         return result
 
+    def get_related_files(self):
+        related_files = {}
+        for sourceat in self.sources.select_related('source'):
+            related_files.update(sourceat.source.get_related_files(sourceat.version))
+        related_files['threshold.config'] = self.get_threshold_buffer()[:50 * 1024]
+        return related_files
+
     def test_rule_buffer(self, rule_buffer, single = False):
         testor = TestRules()
-        tmpdir = tempfile.mkdtemp()
-        self.export_files(tmpdir)
-        related_files = {}
-        for root, _, files in os.walk(tmpdir):
-            for f in files:
-                fullpath = os.path.join(root, f)
-                with open(fullpath, 'r') as cf:
-                    related_files[f] = cf.read( 50 * 1024)
-        shutil.rmtree(tmpdir)
+        related_files = self.get_related_files()
         if single:
             return testor.rule(rule_buffer, related_files = related_files)
         else:
             return testor.rules(rule_buffer, related_files = related_files)
 
-    def test(self):
+    def test(self, progress=None):
+        # progress(percent, message) is called before each step
         self.need_test = False
+        if progress is not None:
+            progress(10, 'Generating rules of ruleset "%s"' % self.name)
         rule_buffer = self.to_buffer()
+        if progress is not None:
+            progress(50, 'Testing rules of ruleset "%s"' % self.name)
         result = self.test_rule_buffer(rule_buffer)
         result['rules_count'] = self.rules_count
         self.validity = result['status']
@@ -2835,7 +3348,8 @@ class Ruleset(models.Model, Transformable):
                 rts.append(rt)
 
         RuleTransformation.objects.bulk_create(rts)
-        self.needs_test()
+        TransformationsCache.changed()
+        self.needs_test(rules=rules)
 
     def enable_rules(self, rules):
         SUPPRESSED = Transformation.SUPPRESSED
@@ -2846,11 +3360,20 @@ class Ruleset(models.Model, Transformable):
                         rule_transformation__in=rules,
                         key=SUPPRESSED.value,
                         value=S_SUPPRESSED.value).delete()
-        self.needs_test()
+        self.needs_test(rules=rules)
 
-    def needs_test(self):
+    def needs_test(self, rules=None):
+        # rules: only the transformations or suppression of these rules
+        # changed, stored rules file can then be patched
         self.need_test = True
         self.save()
+        if rules is None:
+            self.invalidate_artifact()
+
+
+@receiver(post_delete, sender=Ruleset)
+def delete_ruleset_artifact(sender, instance, **kwargs):
+    instance.invalidate_artifact()
 
 
 class RuleTransformation(Transformation):
@@ -2876,6 +3399,16 @@ class RulesetTransformation(Transformation):
         unique_together = ('ruleset_transformation', 'key')
 
 
+@receiver(post_save, sender=RuleTransformation)
+@receiver(post_delete, sender=RuleTransformation)
+@receiver(post_save, sender=CategoryTransformation)
+@receiver(post_delete, sender=CategoryTransformation)
+@receiver(post_save, sender=RulesetTransformation)
+@receiver(post_delete, sender=RulesetTransformation)
+def invalidate_transformations(sender, **kwargs):
+    TransformationsCache.changed()
+
+
 class Threshold(models.Model):
     THRESHOLD_TYPES = (('threshold', 'threshold'), ('suppress', 'suppress'))
     THRESHOLD_TYPE_TYPES = (('limit', 'limit'), ('threshold', 'threshold'), ('both', 'both'))
@@ -3056,6 +3589,125 @@ class RuleProcessingFilterDef(models.Model):
         op = self.OPERATOR_DISPLAY.get(self.operator, self.operator)
         return '%s %s %s' % (self.key, op, self.value)
 
+class JobCancelled(Exception):
+    pass
+
+
+class Job(models.Model):
+    # Long operation (source update, ruleset test, push) run out of the HTTP
+    # request by a JobRunner. Functions of the jobs are registered in
+    # rules.jobs.JOBS, they get the job and its params as arguments.
+    PENDING = 'pending'
+    RUNNING = 'running'
+    SUCCESS = 'success'
+    FAILURE = 'failure'
+    CANCELLED = 'cancelled'
+    STATUS = ((PENDING, 'Pending'), (RUNNING, 'Running'), (SUCCESS, 'Success'),
+              (FAILURE, 'Failure'), (CANCELLED, 'Cancelled'))
+
+    name = models.CharField(max_length=100)
+    # Store params and result as JSON documents
+    params = models.TextField(default='{}')
+    result = models.TextField(blank=True, null=True)
+    status = models.CharField(max_length=10, choices=STATUS, default=PENDING)
+    progress = models.IntegerField(default=0)
+    message = models.TextField(blank=True, default='')
+    cancel_requested = models.BooleanField(default=False)
+    # host:pid of the process running the job
+    worker = models.CharField(max_length=200, blank=True, default='')
+    user = models.ForeignKey(User, on_delete=models.SET_NULL, blank=True, null=True)
+    created_date = models.DateTimeField('date created', default=timezone.now)
+    started_date = models.DateTimeField('date started', blank=True, null=True)
+    ended_date = models.DateTimeField('date ended', blank=True, null=True)
+
+    class Meta:
+        ordering = ('-created_date', '-pk')
+
+    def __unicode__(self):
+        return '%s (%s)' % (self.name, self.status)
+
+    @classmethod
+    def submit(cls, name, user=None, **params):
+        from rules.jobs import JOBS, get_job_runner
+        if name not in JOBS:
+            raise ValueError('Unknown job "%s"' % name)
+        if user is not None and not user.is_authenticated():
+            user = None
+        job = cls.objects.create(name=name, user=user, params=json.dumps(params))
+        # workers can't see the job until it is committed
+        transaction.on_commit(get_job_runner().wake)
+        return job
+
+    def get_params(self):
+        return json.loads(self.params)
+
+    def get_result(self):
+        if self.result is None:
+            return None
+        return json.loads(self.result)
+
+    def claim(self, worker):
+        # a job is run once, whatever the number of runners
+        now = timezone.now()
+        claimed = Job.objects.filter(pk=self.pk, status=self.PENDING).update(status=self.RUNNING, started_date=now, worker=worker)
+        if claimed:
+            self.status = self.RUNNING
+            self.started_date = now
+            self.worker = worker
+        return claimed == 1
+
+    def set_progress(self, progress, message=None):
+        # To be called by job functions, raises JobCancelled if cancellation
+        # was asked
+        fields = {'progress': progress}
+        if message is not None:
+            fields['message'] = message
+            self.message = message
+        self.progress = progress
+        Job.objects.filter(pk=self.pk).update(**fields)
+        if Job.objects.filter(pk=self.pk, cancel_requested=True).exists():
+            raise JobCancelled()
+
+    def requeue(self):
+        # Puts back a job whose worker died, unless it was being cancelled.
+        # Returns False if another runner already did it.
+        running = Job.objects.filter(pk=self.pk, status=self.RUNNING, worker=self.worker)
+        if self.cancel_requested:
+            return running.update(status=self.CANCELLED, message='Cancelled', ended_date=timezone.now()) == 1
+        return running.update(status=self.PENDING, worker='', started_date=None, progress=0,
+                              message='Requeued after an interruption') == 1
+
+    def cancel(self):
+        # Pending jobs are cancelled at once, running ones at their next
+        # progress report
+        Job.objects.filter(pk=self.pk, status=self.PENDING).update(status=self.CANCELLED, cancel_requested=True,
+                                                                   message='Cancelled', ended_date=timezone.now())
+        Job.objects.filter(pk=self.pk, status=self.RUNNING).update(cancel_requested=True)
+        self.refresh_from_db()
+
+    def _end(self, status, message=None, result=None):
+        self.status = status
+        self.ended_date = timezone.now()
+        if message is not None:
+            self.message = message
+        if result is not None:
+            self.result = json.dumps(result)
+        if status == self.SUCCESS:
+            self.progress = 100
+        self.save(update_fields=['status', 'ended_date', 'message', 'result', 'progress'])
+
+    def run(self):
+        from rules.jobs import get_job_function
+        try:
+            result = get_job_function(self.name)(self, **self.get_params())
+        except JobCancelled:
+            self._end(self.CANCELLED, 'Cancelled')
+        except Exception as e:
+            self._end(self.FAILURE, unicode(e))
+        else:
+            self._end(self.SUCCESS, result=result)
+
+
 def dependencies_check(obj):
     if obj == Source:
         return
@@ -3073,17 +3725,20 @@ def dependencies_check(obj):
     if len(Ruleset.objects.all()) == 0:
             return "You need first to create a ruleset."
 
-def export_iprep_files(target_dir):
-    group_rules = Rule.objects.filter(group = True)
-    cat_map = {}
-    with open(target_dir + "/" + "scirius-categories.txt", 'w') as rfile:
-        index = 1
-        for rule in group_rules:
-            rfile.write('%s,%d,%s\n' % (index, rule.sid, rule.msg))
-            cat_map[index] = rule
-            index = index + 1
-    with open(target_dir + "/" + "scirius-iprep.list", 'w') as rfile:
-        for cate in cat_map:
-            iprep_group = cat_map[cate].sid
-            for IP in cat_map[cate].group_ips_list.split(','):
-                rfile.write('%s,%d,100\n' % (IP, cate))
+def get_iprep_files():
+    # Content of the ip reputation files by name, exported from the group rules
+    categories = []
+    iprep = []
+    for index, rule in enumerate(Rule.objects.filter(group=True).order_by('pk'), 1):
+        categories.append('%s,%d,%s\n' % (index, rule.sid, rule.msg))
+        for IP in rule.group_ips_list.split(','):
+            iprep.append('%s,%d,100\n' % (IP, index))
+    return {'scirius-categories.txt': ''.join(categories), 'scirius-iprep.list': ''.join(iprep)}
+
+
+def export_iprep_files(target_dir, iprep_files=None):
+    if iprep_files is None:
+        iprep_files = get_iprep_files()
+    for name, content in iprep_files.iteritems():
+        with open(os.path.join(target_dir, name), 'w') as rfile:
+            rfile.write(content.encode('utf-8'))
@@ -3,10 +3,12 @@ from suripyg import SuriHTMLFormat
 from time import time
 import urllib2
 import socket
+import copy
 
 from django.conf import settings
 from django.utils import timezone
 from django.db import models
+from django.http import StreamingHttpResponse
 from collections import OrderedDict
 import json
 
@@ -19,6 +21,7 @@ from rest_framework.decorators import detail_route, list_route
 from django_filters.rest_framework import DjangoFilterBackend
 from rest_framework.filters import OrderingFilter, SearchFilter
 from rest_framework.response import Response
+from rest_framework.request import Request
 from rest_framework.exceptions import APIException, ParseError
 from rest_framework.routers import DefaultRouter, url
 from rest_framework import status
@@ -34,10 +37,12 @@ from django.contrib.auth.models import User
 
 from rules.models import Rule, Category, Ruleset, RuleTransformation, CategoryTransformation, RulesetTransformation, \
         Source, SourceAtVersion, SourceUpdate, UserAction, UserActionObject, Transformation, SystemSettings, get_system_settings, \
-        FilterSet
+        FilterSet, Job
 from rules.views import get_public_sources, fetch_public_sources, extract_rule_references
 from rules.rest_processing import RuleProcessingFilterViewSet
+from rules.rule_validator import RuleValidator
 from rules.es_data import ESData
+from rules.es_query import ESMultiSearch, get_es_query_cache, es_logger
 
 from rules.es_graphs import ESStats, ESRulesStats, ESSidByHosts, ESFieldStats, \
         ESTimeline, ESMetricsTimeline, ESHealth, ESIndicesStats, ESRulesPerCategory, ESAlertsCount, \
@@ -56,6 +61,11 @@ class ServiceUnavailableException(APIException):
     default_code = 'internal_error'
 
 
+def is_async_request(request):
+    value = request.query_params.get('async', 'false')
+    return bool(value) and value.lower() not in ('false', '0')
+
+
 class ModelSerializer(serializers.ModelSerializer):
     def field_changed(self, field):
         if field not in self._validated_data:
@@ -134,6 +144,21 @@ class RulesetViewSet(viewsets.ModelViewSet):
         HTTP/1.1 200 OK
         {"pk":9,"name":"MyCreatedRuleset","descr":"","created_date":"2018-05-04T16:10:43.698843+02:00","updated_date":"2018-05-04T16:10:43.698852+02:00","need_test":true,"validity":true,"errors":"\\"\\"","rules_count":204,"sources":[1],"categories":[27]}
 
+    Number of rules of all rulesets:\n
+        curl -k https://x.x.x.x/rest/rules/ruleset/rules_count/ -H 'Authorization: Token <token>' -H 'Content-Type: application/json'  -X GET
+
+    Return:\n
+        HTTP/1.1 200 OK
+        {"9":204,"12":0}
+
+    Export ruleset rules file:\n
+        curl -k https://x.x.x.x/rest/rules/ruleset/<pk-ruleset>/export/ -H 'Authorization: Token <token>' -X GET
+
+    Return:\n
+        HTTP/1.1 200 OK
+        # Rules file for MyCreatedRuleset generated by Scirius at 2018-05-04 16:10:43.698843+00:00
+        alert ...
+
     ==== POST ====\n
     Create a ruleset:\n
         curl -k https://x.x.x.x/rest/rules/ruleset/ -H 'Authorization: Token <token>' -H 'Content-Type: application/json'  -X POST -d '{"name": "SonicRuleset", "sources": [pk-source1, ..., pk-sourceN], "categories": [pk-category1, ..., pk-categoryN]}'
@@ -149,6 +174,13 @@ class RulesetViewSet(viewsets.ModelViewSet):
         HTTP/1.1 200 OK
         {"copy":"ok"}
 
+    Test a ruleset, in a background job with async=true:\n
+        curl -k https://x.x.x.x/rest/rules/ruleset/<pk-ruleset>/test/\\?async=true -H 'Authorization: Token <token>' -H 'Content-Type: application/json'  -X POST
+
+    Return:\n
+        HTTP/1.1 200 OK
+        {"job":42,"status":"pending"}
+
     ==== PATCH ====\n
     Patch a ruleset:\n
         curl -k https://x.x.x.x/rest/rules/ruleset/<pk-ruleset>/ -H 'Authorization: Token <token>' -H 'Content-Type: application/json'  -X PATCH -d '{"name": "PatchedSonicRuleset", "categories": [pk-category1, ..., pk-categoryN]}'
@@ -302,6 +334,25 @@ class RulesetViewSet(viewsets.ModelViewSet):
         ruleset = self.get_object()
         return Response(ruleset.number_of_rules())
 
+    @list_route(methods=['get'], url_path='rules_count', url_name='rules-counts')
+    def rules_counts(self, request):
+        return Response(Ruleset.get_rules_counts())
+
+    @detail_route(methods=['get'])
+    def export(self, request, pk):
+        ruleset = self.get_object()
+        response = StreamingHttpResponse(ruleset.iter_buffer(), content_type='text/plain')
+        response['Content-Disposition'] = 'attachment; filename=scirius.rules'
+        return response
+
+    @detail_route(methods=['post'])
+    def test(self, request, pk):
+        ruleset = self.get_object()
+        if is_async_request(request):
+            job = Job.submit('test_ruleset', user=request.user, ruleset=ruleset.pk)
+            return Response({'job': job.pk, 'status': job.status})
+        return Response(ruleset.test())
+
 
 class CategoryChangeSerializer(serializers.Serializer):
     ruleset = serializers.PrimaryKeyRelatedField(queryset=Ruleset.objects.all(), write_only=True)
@@ -378,6 +429,11 @@ class RuleChangeSerializer(serializers.Serializer):
     comment = serializers.CharField(required=False, allow_blank=True, write_only=True)
 
 
+class RuleValidateSerializer(serializers.Serializer):
+    sids = serializers.ListField(child=serializers.IntegerField(), write_only=True)
+    rulesets = serializers.PrimaryKeyRelatedField(queryset=Ruleset.objects.all(), many=True, required=False, write_only=True)
+
+
 class HitTimelineEntry(serializers.Serializer):
     date = serializers.IntegerField(read_only=True)
     hits = serializers.IntegerField(read_only=True)
@@ -647,6 +703,13 @@ class RuleViewSet(SciriusReadOnlyModelViewSet):
         HTTP/1.1 200 OK
         {"comment":"ok"}
 
+    Validate rules in rulesets, all rulesets if "rulesets" is not set:\n
+        curl -k https://x.x.x.x/rest/rules/rule/validate/ -H 'Authorization: Token <token>' -H 'Content-Type: application/json' -X POST -d '{"sids": [2404150, 2404151], "rulesets": [1]}'
+
+    Return:\n
+        HTTP/1.1 200 OK
+        {"1":{"2404150":{"status":true,"errors":""},"2404151":{"status":false,"errors":[{"error_code":39,"message":"error parsing signature","sid":2404151}],"warnings":[],"iter":0}}}
+
     Toggle availabililty:\n
         curl -v -k https://x.x.x.x/rest/rules/rule/<sid-rule>/toggle_availability/ -H 'Authorization: Token <token>' -H 'Content-Type: application/json' -X POST -d '{"comment": "toggle rule"}'
 
@@ -713,65 +776,60 @@ class RuleViewSet(SciriusReadOnlyModelViewSet):
                 raise serializers.ValidationError({'filters': ['Wrong filter value "%s" for key "%s".' % (value_str, key_str)]})
 
         res = {}
-        try:
-            Rule.enable_cache()
-
-            for ruleset in Ruleset.objects.all():
-                trans_rules = RuleTransformation.objects.filter(ruleset=ruleset, **params)
-                trans_cats = CategoryTransformation.objects.filter(ruleset=ruleset, **params)
-                trans_rulesets = RulesetTransformation.objects.filter(ruleset_transformation=ruleset, **params)
-
-                all_rules = set()
-                key = Transformation.Type(key_str)
-                value = None
-
-                if key == Transformation.ACTION:
-                    value = Transformation.ActionTransfoType(value_str)
-                elif key == Transformation.LATERAL:
-                    value = Transformation.LateralTransfoType(value_str)
-                elif key == Transformation.TARGET:
-                    value = Transformation.TargetTransfoType(value_str)
-
-                if ruleset.pk not in res:
-                    res[ruleset.pk] = {'name': ruleset.name,
-                                       'transformation': {'transfo_key': key_str, 'transfo_value': value_str},
-                                       'rules': []
-                                       }
-
-                for trans in trans_rules:
-                    all_rules.add(trans.rule_transformation.pk)
-
-                for trans in trans_cats:
-                    category = trans.category_transformation
-                    for rule in category.rule_set.all():
-                        rule_trans_value = rule.get_transformation(ruleset, key=key)
-                        if rule_trans_value is None or rule_trans_value == value:
-                            all_rules.add(rule.sid)
-
-                if trans_rulesets:
-                    for category in ruleset.categories.all():
-                        trans_cat = CategoryTransformation.objects.filter(ruleset=ruleset, category_transformation=category)
-
-                        if len(trans_cat) == 0:
+        for ruleset in Ruleset.objects.all():
+            trans_rules = RuleTransformation.objects.filter(ruleset=ruleset, **params)
+            trans_cats = CategoryTransformation.objects.filter(ruleset=ruleset, **params)
+            trans_rulesets = RulesetTransformation.objects.filter(ruleset_transformation=ruleset, **params)
+
+            all_rules = set()
+            key = Transformation.Type(key_str)
+            value = None
+
+            if key == Transformation.ACTION:
+                value = Transformation.ActionTransfoType(value_str)
+            elif key == Transformation.LATERAL:
+                value = Transformation.LateralTransfoType(value_str)
+            elif key == Transformation.TARGET:
+                value = Transformation.TargetTransfoType(value_str)
+
+            if ruleset.pk not in res:
+                res[ruleset.pk] = {'name': ruleset.name,
+                                   'transformation': {'transfo_key': key_str, 'transfo_value': value_str},
+                                   'rules': []
+                                   }
+
+            for trans in trans_rules:
+                all_rules.add(trans.rule_transformation.pk)
+
+            for trans in trans_cats:
+                category = trans.category_transformation
+                for rule in category.rule_set.all():
+                    rule_trans_value = rule.get_transformation(ruleset, key=key)
+                    if rule_trans_value is None or rule_trans_value == value:
+                        all_rules.add(rule.sid)
+
+            if trans_rulesets:
+                for category in ruleset.categories.all():
+                    trans_cat = CategoryTransformation.objects.filter(ruleset=ruleset, category_transformation=category)
+
+                    if len(trans_cat) == 0:
+                        for rule in category.rule_set.all():
+                            rule_trans_value = rule.get_transformation(ruleset, key=key)
+                            if rule_trans_value is None or rule_trans_value == value:
+                                all_rules.add(rule.sid)
+                    else:
+                        for trans in trans_cat:
                             for rule in category.rule_set.all():
                                 rule_trans_value = rule.get_transformation(ruleset, key=key)
-                                if rule_trans_value is None or rule_trans_value == value:
-                                    all_rules.add(rule.sid)
-                        else:
-                            for trans in trans_cat:
-                                for rule in category.rule_set.all():
-                                    rule_trans_value = rule.get_transformation(ruleset, key=key)
-                                    if trans.key == key and trans.value == value:
-                                        if rule_trans_value is None or rule_trans_value == value:
-                                            all_rules.add(rule.sid)
-                                    else:
-                                        if rule_trans_value == value:
-                                            all_rules.add(rule.sid)
-
-                res[ruleset.pk]['rules'] = list(all_rules)
-                res[ruleset.pk]['rules_count'] = len(all_rules)
-        finally:
-            Rule.disable_cache()
+                                if trans.key == key and trans.value == value:
+                                    if rule_trans_value is None or rule_trans_value == value:
+                                        all_rules.add(rule.sid)
+                                else:
+                                    if rule_trans_value == value:
+                                        all_rules.add(rule.sid)
+
+            res[ruleset.pk]['rules'] = list(all_rules)
+            res[ruleset.pk]['rules_count'] = len(all_rules)
 
         return Response(res)
 
@@ -859,6 +917,8 @@ class RuleViewSet(SciriusReadOnlyModelViewSet):
     def get_serializer_class(self):
         if self.action in ('enable', 'disable'):
             return RuleChangeSerializer
+        if self.action == 'validate':
+            return RuleValidateSerializer
         return RuleSerializer
 
     @detail_route(methods=['get'])
@@ -870,7 +930,7 @@ class RuleViewSet(SciriusReadOnlyModelViewSet):
             res[ruleset.pk] = {}
             res[ruleset.pk]['name'] = ruleset.name
             res[ruleset.pk]['active'] = rule.is_active(ruleset)
-            res[ruleset.pk]['valid'] = rule.test(ruleset)
+            res[ruleset.pk]['valid'] = RuleValidator(ruleset).validate([rule])[rule.pk]
 
             res[ruleset.pk]['transformations'] = {}
             for key in (Transformation.ACTION, Transformation.LATERAL, Transformation.TARGET):
@@ -879,6 +939,17 @@ class RuleViewSet(SciriusReadOnlyModelViewSet):
 
         return Response(res)
 
+    @list_route(methods=['post'])
+    def validate(self, request):
+        serializer = RuleValidateSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        rulesets = serializer.validated_data.get('rulesets') or Ruleset.objects.all()
+
+        res = {}
+        for ruleset in rulesets:
+            res[ruleset.pk] = RuleValidator(ruleset).validate_sids(serializer.validated_data['sids'])
+        return Response(res)
+
     def _scirius_hit(self, r):
         timeline = []
         for entry in r['timeline']['buckets']:
@@ -901,7 +972,7 @@ class RuleViewSet(SciriusReadOnlyModelViewSet):
         }
 
     def _add_hits(self, request, data):
-        sids = ','.join([unicode(rule['sid']) for rule in data])
+        sids = [rule['sid'] for rule in data]
 
         try:
             result = ESSigsListHits(request).get(sids)
@@ -1454,21 +1525,22 @@ class BaseSourceViewSet(viewsets.ModelViewSet):
         # Do not need to copy 'request.data' and pop 'comment'
         # because we are not using serializer there
         comment = request.data.get('comment', None)
-        is_async_str = request.query_params.get('async', 'false')
-        is_async = lambda value: bool(value) and value.lower() not in ('false', '0')
-        async_ = is_async(is_async_str)
+        async_ = is_async_request(request)
 
         source = self.get_object()
         comment_serializer = CommentSerializer(data={'comment': comment})
         comment_serializer.is_valid(raise_exception=True)
 
+        comment = comment_serializer.validated_data['comment']
+        if async_ is True and not hasattr(Probe.common, 'update_source_rest'):
+            # the user action is recorded by the job once the update succeeded
+            job = Job.submit('update_source', user=request.user, source=source.pk, comment=comment)
+            return Response({'job': job.pk, 'status': job.status})
+
         try:
             msg = 'ok'
             if async_ is True:
-                if hasattr(Probe.common, 'update_source_rest'):
-                    Probe.common.update_source_rest(request, source)
-                else:
-                    raise ServiceUnavailableException()
+                Probe.common.update_source_rest(request, source)
             else:
                 source.update()
         except Exception as errors:
@@ -1485,7 +1557,7 @@ class BaseSourceViewSet(viewsets.ModelViewSet):
 
         UserAction.create(
                 action_type='update_source',
-                comment=comment_serializer.validated_data['comment'],
+                comment=comment,
                 user=request.user,
                 source=source
         )
@@ -1617,6 +1689,10 @@ class PublicSourceViewSet(BaseSourceViewSet):
         HTTP/1.1 200 OK
         {"update":"ok"}
 
+    Return with async=true, when updated in a background job:\n
+        HTTP/1.1 200 OK
+        {"job":42,"status":"pending"}
+
     Test public source:\n
         curl -k https://x.x.x.x/rest/rules/public_source/<pk-public-source>/test/ -H 'Authorization: Token <token>' -H 'Content-Type: application/json'  -X POST
 
@@ -1685,6 +1761,10 @@ class SourceViewSet(BaseSourceViewSet):
         HTTP/1.1 200 OK
         {"update":"ok"}
 
+    Return with async=true, when updated in a background job:\n
+        HTTP/1.1 200 OK
+        {"job":42,"status":"pending"}
+
     Test custom source:\n
         curl -k https://x.x.x.x/rest/rules/source/<pk-source>/test/ -H 'Authorization: Token <token>' -H 'Content-Type: application/json'  -X POST
 
@@ -1774,6 +1854,75 @@ class UserActionDateOrderingFilter(OrderingFilter):
         return queryset.order_by(*ordering)
 
 
+class JobSerializer(serializers.ModelSerializer):
+    params = serializers.SerializerMethodField()
+    result = serializers.SerializerMethodField()
+    username = serializers.SerializerMethodField()
+
+    class Meta:
+        model = Job
+        fields = ('pk', 'name', 'params', 'status', 'progress', 'message', 'result', 'cancel_requested',
+                  'user', 'username', 'created_date', 'started_date', 'ended_date')
+
+    def get_params(self, instance):
+        return instance.get_params()
+
+    def get_result(self, instance):
+        return instance.get_result()
+
+    def get_username(self, instance):
+        return instance.user.username if instance.user else None
+
+
+class JobViewSet(SciriusReadOnlyModelViewSet):
+    """
+    =============================================================================================================================================================
+    ==== GET ====\n
+    Show a background job, non-staff users only see their own jobs:\n
+        curl -k https://x.x.x.x/rest/rules/job/<pk-job>/ -H 'Authorization: Token <token>' -H 'Content-Type: application/json' -X GET
+
+    Return:\n
+        HTTP/1.1 200 OK
+        {"pk":42,"name":"update_source","params":{"source":1},"status":"running","progress":0,"message":"Updating source \\"ETOpen Ruleset\\"","result":null,
+        "cancel_requested":false,"user":1,"username":"scirius","created_date":"2018-05-14T16:13:24.711372+02:00","started_date":"2018-05-14T16:13:24.802110+02:00","ended_date":null}
+
+    Filtering by status:\n
+        curl -k "https://x.x.x.x/rest/rules/job/?status=running" -H 'Authorization: Token <token>' -H 'Content-Type: application/json' -X GET
+
+    ==== POST ====\n
+    Cancel a job, running jobs stop at their next progress report:\n
+        curl -k https://x.x.x.x/rest/rules/job/<pk-job>/cancel/ -H 'Authorization: Token <token>' -H 'Content-Type: application/json' -X POST
+
+    Return:\n
+        HTTP/1.1 200 OK
+        {"cancel":"ok"}
+
+    =============================================================================================================================================================
+    """
+
+    queryset = Job.objects.select_related('user')
+    serializer_class = JobSerializer
+    ordering = ('-pk',)
+    ordering_fields = ('pk', 'name', 'status', 'created_date')
+    filter_fields = ('name', 'status')
+    filter_backends = (filters.DjangoFilterBackend, OrderingFilter)
+
+    def get_queryset(self):
+        # non-staff users only see their own jobs
+        queryset = super(JobViewSet, self).get_queryset()
+        if not getattr(self.request.user, 'is_staff', False):
+            queryset = queryset.filter(user=self.request.user)
+        return queryset
+
+    @detail_route(methods=['post'])
+    def cancel(self, request, pk):
+        job = self.get_object()
+        if job.status not in (Job.PENDING, Job.RUNNING):
+            raise serializers.ValidationError({'cancel': ['Job is %s' % job.status]})
+        job.cancel()
+        return Response({'cancel': 'ok'})
+
+
 class UserActionViewSet(SciriusReadOnlyModelViewSet):
     """
     =============================================================================================================================================================
@@ -1980,6 +2129,11 @@ class ESSigsListViewSet(ESBaseViewSet):
         errors = {}
         if sids is None:
             errors['sids'] = ['This field is required.']
+        else:
+            try:
+                sids = [int(sid) for sid in unicode(sids).split(',')]
+            except ValueError:
+                errors['sids'] = ['A comma separated list of integers is required.']
 
         if 'hosts' not in request.GET:
             errors['hosts'] = ['This field is required.']
@@ -2419,6 +2573,126 @@ class ESSuriLogTailViewSet(ESBaseViewSet):
         return Response(ESSuriLogTail(request).get())
 
 
+class ESQueryCacheViewSet(APIView):
+    """
+    =============================================================================================================================================================
+    ==== GET ====\n
+    Show metrics of the cache of ES aggregations responses, size is in bytes:\n
+        curl -k https://x.x.x.x/rest/rules/es/query_cache/ -H 'Authorization: Token <token>' -H 'Content-Type: application/json' -X GET
+
+    Return:\n
+        HTTP/1.1 200 OK
+        {"hits":12,"misses":5,"evictions":0,"entries":5,"size":48213,"max_size":33554432}
+
+    =============================================================================================================================================================
+    """
+    permission_classes = (IsAdminUser,)
+
+    def get(self, request, format=None):
+        return Response(get_es_query_cache().stats())
+
+
+class ESMultiViewSet(APIView):
+    """
+    =============================================================================================================================================================
+    ==== POST ====\n
+    Run the queries of several ES widgets in one call, their searches are sent to Elasticsearch as a single multi search request.
+    widget: rules, rule, top_rules, sigs_list, poststats_summary, field_stats, filter_ip, timeline, rules_per_category, alerts_count, latest_stats, ip_pair_alerts, ip_pair_network_alerts, alerts_tail, suri_log_tail
+    params: GET parameters of the widget, parameters of the URL are shared by all widgets
+
+    Show timeline and alerts count:\n
+        curl -k https://x.x.x.x/rest/rules/es/multi/\?hosts\=ProbeMain\&from_date\=1537264545477 -H 'Authorization: Token <token>' -H 'Content-Type: application/json' -X POST -d '{"timeline": {"widget": "timeline"}, "count": {"widget": "alerts_count", "params": {"prev": 1}}}'
+
+    Return:\n
+        HTTP/1.1 200 OK
+        {"timeline":{"ProbeMain":{"entries":[{"count":2,"time":1530620640000}]},"from_date":1528184544572,"interval":25920000},"count":{"prev_doc_count":0,"doc_count":2}}
+
+    Failure of a widget, or a widget denied to the user, is reported in its result:\n
+        {"timeline":{...},"count":{"error":"ES request failed, ..."}}
+
+    =============================================================================================================================================================
+    """
+
+    # widgets are read only, their own permissions are checked for each query
+    permission_classes = (IsAuthenticated,)
+    WIDGETS = {
+        'rules': ESRulesViewSet,
+        'rule': ESRuleViewSet,
+        'top_rules': ESTopRulesViewSet,
+        'sigs_list': ESSigsListViewSet,
+        'poststats_summary': ESPostStatsViewSet,
+        'field_stats': ESFieldStatsViewSet,
+        'filter_ip': ESFilterIPViewSet,
+        'timeline': ESTimelineViewSet,
+        'rules_per_category': ESRulesPerCategoryViewSet,
+        'alerts_count': ESAlertsCountViewSet,
+        'latest_stats': ESLatestStatsViewSet,
+        'ip_pair_alerts': ESIPPairAlertsViewSet,
+        'ip_pair_network_alerts': ESIPPairNetworkAlertsViewSet,
+        'alerts_tail': ESAlertsTailViewSet,
+        'suri_log_tail': ESSuriLogTailViewSet,
+    }
+
+    def _widget_request(self, request, params):
+        # the django request of the widget, a GET with its own parameters
+        widget_request = copy.copy(request._request)
+        widget_request.method = 'GET'
+        widget_request.GET = request._request.GET.copy()
+        for key, value in params.iteritems():
+            widget_request.GET[key] = unicode(value)
+        return widget_request
+
+    def _widget_error(self, e):
+        if isinstance(e, ESError):
+            return {'error': 'ES request failed, %s' % unicode(e)}
+        if isinstance(e, APIException):
+            return {'error': e.detail}
+        es_logger.exception('Widget query failed')
+        return {'error': 'Widget query failed, %s' % unicode(e)}
+
+    def post(self, request, format=None):
+        if not isinstance(request.data, dict) or not request.data:
+            raise serializers.ValidationError({'queries': ['A dictionary of widget queries is required.']})
+
+        errors = {}
+        queries = {}
+        for name, query in request.data.iteritems():
+            if not isinstance(query, dict) or query.get('widget') not in self.WIDGETS:
+                errors[name] = ['Invalid widget, must be one of %s.' % ', '.join(sorted(self.WIDGETS.keys()))]
+            elif not isinstance(query.get('params', {}), dict):
+                errors[name] = ['params must be a dictionary.']
+            else:
+                queries[name] = query
+
+        if len(errors) > 0:
+            raise serializers.ValidationError(errors)
+
+        multi_search = ESMultiSearch()
+        indexes = {}
+        results = {}
+        for name, query in queries.iteritems():
+            view = self.WIDGETS[query['widget']]()
+            widget_request = self._widget_request(request, query.get('params', {}))
+            # permissions of the widget view, as if it was called directly
+            view.request = Request(widget_request)
+            view.request.user = request.user
+            view.request.auth = request.auth
+            try:
+                view.check_permissions(view.request)
+            except APIException as e:
+                results[name] = self._widget_error(e)
+                continue
+            indexes[name] = multi_search.add(view._get, widget_request)
+        multi_search.run()
+
+        for name, index in indexes.iteritems():
+            try:
+                results[name] = multi_search.result(index).data
+            except Exception as e:
+                results[name] = self._widget_error(e)
+        return Response(results)
+
+
 class ESDeleteLogsViewSet(APIView):
     """
     =============================================================================================================================================================
@@ -2682,6 +2956,8 @@ def get_custom_urls():
     urls.append(url(r'rules/es/ip_pair_network_alerts/$', ESIPPairNetworkAlertsViewSet.as_view(), name='es_ip_pair_network_alerts'))
     urls.append(url(r'rules/es/alerts_tail/$', ESAlertsTailViewSet.as_view(), name='es_alerts_tail'))
     urls.append(url(r'rules/es/suri_log_tail/$', ESSuriLogTailViewSet.as_view(), name='es_suri_log_tail'))
+    urls.append(url(r'rules/es/multi/$', ESMultiViewSet.as_view(), name='es_multi'))
+    urls.append(url(r'rules/es/query_cache/$', ESQueryCacheViewSet.as_view(), name='es_query_cache'))
     urls.append(url(r'rules/es/delete_logs/$', ESDeleteLogsViewSet.as_view(), name='es_delete_logs'))
     urls.append(url(r'rules/scirius_context/$', SciriusContextAPIView.as_view(), name='scirius_context'))
 
@@ -2698,6 +2974,7 @@ router.register('rules/transformation/ruleset', RulesetTransformationViewSet)
 router.register('rules/transformation/category', CategoryTransformationViewSet)
 router.register('rules/transformation/rule', RuleTransformationViewSet)
 router.register('rules/history', UserActionViewSet)
+router.register('rules/job', JobViewSet)
 router.register('rules/changelog/source', ChangelogViewSet)
 router.register('rules/system_settings', SystemSettingsViewSet)
 router.register('rules/processing-filter', RuleProcessingFilterViewSet)
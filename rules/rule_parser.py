@@ -0,0 +1,135 @@
+"""
+Copyright(C) 2018 Stamus Networks
+
+This file is part of Scirius.
+
+Scirius is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Scirius is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Scirius.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from __future__ import unicode_literals
+from collections import namedtuple
+from itertools import izip
+from multiprocessing import Pool
+
+
+# metadata and bits are tuples so parsed rules are cheap to send back from
+# parser processes
+ParsedRule = namedtuple('ParsedRule', ('sid', 'rev', 'msg', 'state', 'content', 'metadata', 'bits'))
+
+
+class RuleParser(object):
+    # Single pass parser used at import time: options are split once and
+    # only sid, rev, msg, metadata and bits are extracted from them.
+    BITS_TYPES = ('flowbits', 'hostbits', 'xbits')
+    BITS_OPERATIONS = ('set', 'isset')
+    # only the metadata used by Rule.parse_metadata are kept
+    METADATA_KEYS = ('created_at ', 'updated_at ')
+
+    def split_options(self, content):
+        start = content.find('(')
+        end = content.rfind(')')
+        if start == -1 or end < start:
+            return
+        chunk = ''
+        for part in content[start + 1:end].split(';'):
+            # escaped semicolon: option continues in next part
+            if part.endswith('\\'):
+                chunk += part + ';'
+                continue
+            option = (chunk + part).strip()
+            chunk = ''
+            if not option:
+                continue
+            name, _, value = option.partition(':')
+            yield name.strip(), value.strip()
+
+    def parse_options(self, content):
+        sid = None
+        rev = None
+        msg = None
+        metadata = []
+        bits = []
+        for name, value in self.split_options(content):
+            if name == 'sid':
+                if sid is None and value.isdigit():
+                    sid = int(value)
+            elif name == 'rev':
+                if rev is None and value.isdigit():
+                    rev = int(value)
+            elif name == 'msg':
+                if msg is None and value.startswith('"'):
+                    msg = value[1:].split('"', 1)[0]
+            elif name == 'metadata':
+                for meta in value.split(','):
+                    meta = meta.strip()
+                    if meta.startswith(self.METADATA_KEYS):
+                        metadata.append(meta)
+            elif name in self.BITS_TYPES:
+                operation, _, bit = value.partition(',')
+                if operation in self.BITS_OPERATIONS and bit:
+                    bits.append((name, operation, bit.rstrip()))
+        return sid, rev, msg, tuple(metadata), tuple(bits)
+
+    def parse_bits(self, content):
+        return self.parse_options(content)[4]
+
+    def parse_metadata(self, content):
+        return self.parse_options(content)[3]
+
+    def parse_line(self, line):
+        state = True
+        if line.startswith('#'):
+            # check if it is a commented signature
+            if "->" in line and "sid" in line and ")" in line:
+                line = line.lstrip("# ")
+                state = False
+            else:
+                return None
+        sid, rev, msg, metadata, bits = self.parse_options(line)
+        if sid is None:
+            return None
+        return ParsedRule(sid, rev, msg or '', state, line, metadata, bits)
+
+    def parse_file(self, rfile):
+        for line in rfile:
+            if isinstance(line, str):
+                line = line.decode('utf-8')
+            rule = self.parse_line(line)
+            if rule is not None:
+                yield rule
+
+    def parse_files(self, filenames, workers=1):
+        # Yields (filename, rules) in order, one file at a time so that the
+        # rules of a file can be imported before the next one is parsed.
+        # Parsing is CPU bound and independent for each file, so with
+        # workers > 1 the next files are parsed by a pool of processes
+        # meanwhile.
+        filenames = list(filenames)
+        if workers > 1 and len(filenames) > 1:
+            pool = Pool(processes=min(workers, len(filenames)))
+            try:
+                for item in izip(filenames, pool.imap(parse_rules_file, filenames)):
+                    yield item
+            finally:
+                # also stops the pool when the import fails
+                pool.terminate()
+                pool.join()
+        else:
+            for filename in filenames:
+                yield filename, parse_rules_file(filename)
+
+
+def parse_rules_file(filename):
+    with open(filename) as rfile:
+        return list(RuleParser().parse_file(rfile))
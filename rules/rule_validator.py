@@ -0,0 +1,154 @@
+"""
+Copyright(C) 2018 Stamus Networks
+
+This file is part of Scirius.
+
+Scirius is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Scirius is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Scirius.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from __future__ import unicode_literals
+import hashlib
+
+from django.conf import settings
+from django.core.cache import cache
+
+from rules.models import Rule, TransformationsCache
+from rules.tests_rules import TestRules
+
+
+class RuleValidator(object):
+    # Validates many rules of a ruleset with a single suricata run. Only when
+    # the run fails, rules are split in halves which are tested concurrently
+    # until errors are attributed to single rules. Results are cached by sid,
+    # rev, resolved transformations and files related to the ruleset.
+    CACHE_PREFIX = 'rule_validation'
+    # sqlite limits the number of parameters of a query
+    QUERY_BATCH_SIZE = 500
+
+    def __init__(self, ruleset):
+        self.ruleset = ruleset
+        self.testor = TestRules()
+        self.transformations = TransformationsCache.get(ruleset)
+        self._related_files = None
+        self._files_digest = None
+
+    @property
+    def related_files(self):
+        if self._related_files is None:
+            self._related_files = self.ruleset.get_related_files()
+        return self._related_files
+
+    @property
+    def files_digest(self):
+        if self._files_digest is None:
+            digest = hashlib.sha1()
+            for name, content in sorted(self.related_files.items()):
+                digest.update(name.encode('utf-8') + b'\0')
+                if isinstance(content, unicode):
+                    content = content.encode('utf-8')
+                digest.update(content + b'\0')
+            self._files_digest = digest.hexdigest()
+        return self._files_digest
+
+    def _cache_key(self, rule, transformations):
+        values = [trans.value if trans is not None else '' for trans in transformations]
+        key = '%s:%s:%s:%s' % (rule.pk, rule.rev, ','.join(values), self.files_digest)
+        return '%s:%s' % (self.CACHE_PREFIX, hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+    def _test_rule(self, content):
+        # same result as Rule.test
+        try:
+            return self.testor.rule(content, related_files=self.related_files)
+        except:
+            return False
+
+    def _valid_result(self, content):
+        # result of the single rule test of a rule which passed in a group
+        _, warnings = self.testor.resolve_variables(content, self.testor.CONFIG_FILE)
+        if not warnings:
+            return {'status': True, 'errors': ''}
+        return self.testor._escape_result({'status': True, 'errors': [], 'warnings': warnings, 'iter': 0})
+
+    def _submit(self, sids, contents):
+        rule_buffer = '\n'.join(contents[sid] for sid in sids)
+        rule_buffer, _ = self.testor.resolve_variables(rule_buffer, self.testor.CONFIG_FILE)
+        return self.testor.submit_rule_buffer(rule_buffer, related_files=self.related_files)
+
+    def _bisect(self, sids, contents):
+        results = {}
+        groups = [sids]
+        while groups:
+            # all groups of a level run concurrently in the tests pool
+            jobs = [(group, self._submit(group, contents)) for group in groups if len(group) > 1]
+            for group in groups:
+                if len(group) == 1:
+                    results[group[0]] = self._test_rule(contents[group[0]])
+
+            groups = []
+            for group, job in jobs:
+                try:
+                    status = job.result()['status']
+                except:
+                    for sid in group:
+                        results[sid] = False
+                    continue
+
+                if status:
+                    for sid in group:
+                        results[sid] = self._valid_result(contents[sid])
+                else:
+                    half = len(group) / 2
+                    groups.append(group[:half])
+                    groups.append(group[half:])
+        return results
+
+    def validate(self, rules):
+        # Returns the result of Rule.test for each rule, by sid
+        rules = list(rules)
+        try:
+            self.files_digest
+        except:
+            # as Rule.test, when sources can't be exported
+            return dict((rule.pk, False) for rule in rules)
+
+        results = {}
+        contents = {}
+        keys = {}
+        for rule in rules:
+            transformations = self.transformations.resolve(rule)
+            keys[rule.pk] = self._cache_key(rule, transformations)
+            contents[rule.pk] = rule.transform_content(*transformations) or ''
+
+        cached = cache.get_many(keys.values())
+        pending = []
+        for sid, key in keys.iteritems():
+            if key in cached:
+                results[sid] = cached[key]
+            else:
+                pending.append(sid)
+
+        if pending:
+            tested = self._bisect(sorted(pending), contents)
+            results.update(tested)
+            # failures to run suricata are not cached
+            cache.set_many(dict((keys[sid], res) for sid, res in tested.iteritems() if res is not False),
+                           settings.RULES_VALIDATION_CACHE_TIMEOUT)
+        return results
+
+    def validate_sids(self, sids):
+        rules = []
+        sids = list(sids)
+        for i in xrange(0, len(sids), self.QUERY_BATCH_SIZE):
+            rules.extend(Rule.objects.filter(pk__in=sids[i:i + self.QUERY_BATCH_SIZE]))
+        return self.validate(rules)
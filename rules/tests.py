@@ -22,19 +22,44 @@ from __future__ import unicode_literals
 import json
 from django.contrib.auth.models import User
 from django.core.urlresolvers import reverse
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection, connections, transaction
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ValidationError, SuspiciousOperation
 from django.utils import timezone
 from django.http import HttpRequest
 from rest_framework import status, mixins
+from rest_framework.permissions import IsAdminUser
 from rest_framework.test import APITestCase
 
 from models import Category, Rule, Ruleset, Source, SourceAtVersion, Transformation, RuleTransformation, \
-    RulesetTransformation, SourceUpdate, SystemSettings, UserAction, RuleProcessingFilter, RuleProcessingFilterDef
-from rest_api import router
+    RulesetTransformation, SourceUpdate, SystemSettings, UserAction, RuleProcessingFilter, RuleProcessingFilterDef, \
+    Flowbit, FlowbitGraph, RulesetTransformations, TransformationsCache, Threshold, Job, JobCancelled, get_es_address, reset_es_address, bulk_update
+from rest_api import router, ESMultiViewSet
+from rule_parser import RuleParser
+from tests_rules import TestRules, TestSandboxPool, TestResultsCache, get_test_results_cache
+from rule_validator import RuleValidator
+from jobs import JOBS, JobRunner
+from es_query import ESQuery, ESMultiSearch, ESQueryCache, get_es_transport, get_es_query_cache, get_query_template
+from es_graphs import ESError, ESTimeline, ESAlertsCount, ESHealth, ESRulesStats, get_es_major_version, \
+    reset_es_version, get_top_query, es_delete_alerts_by_sid_v5, ESSigsListHits
 
 from copy import deepcopy
 import tempfile
-from shutil import rmtree
+import tarfile
+import hashlib
+import gzip
+import os
+import threading
+import socket
+import resource
+import time
+import BaseHTTPServer
+import SocketServer
+from shutil import rmtree, copyfileobj
 from StringIO import StringIO
 import itertools
 from importlib import import_module
@@ -195,6 +220,1170 @@ deployment Datacenter, tag Metasploit, signature_severity Critical, created_at 2
         content = self.rule_target_destination_transfo.apply_lateral_target_transfo(self.rule_target_destination_transfo.content, Transformation.TARGET, Transformation.T_DESTINATION)
         self.assertEqual(content.endswith('target:dest_ip;)'), True)
 
+    def _legacy_content(self, rule, action, lateral, target):
+        # content built by applying each transformation on the result of the previous one
+        content = rule.content
+        if (action == Transformation.A_DROP and rule.can_drop()) or action == Transformation.A_BYPASS:
+            content = rule.apply_transformation(content, key=Transformation.ACTION, value=action)
+        if lateral in (Transformation.L_YES, Transformation.L_AUTO) and rule.can_lateral(lateral):
+            content = rule.apply_transformation(content, key=Transformation.LATERAL, value=lateral)
+        if target in (Transformation.T_SOURCE, Transformation.T_DESTINATION, Transformation.T_AUTO):
+            content = rule.apply_transformation(content.encode('utf8'), key=Transformation.TARGET, value=target)
+        if isinstance(content, str):
+            content = content.decode('utf8')
+        return content
+
+    def test_006_ruleset_buffer(self):
+        ruleset = Ruleset.objects.create(name='test ruleset', descr='descr', created_date=timezone.now(), updated_date=timezone.now())
+        ruleset.sources.add(self.source_at_version)
+        ruleset.categories.add(self.category)
+        other = Ruleset.objects.create(name='other ruleset', descr='descr', created_date=timezone.now(), updated_date=timezone.now())
+
+        ruleset.set_transformation(key=Transformation.ACTION, value=Transformation.A_DROP)
+        ruleset.set_transformation(key=Transformation.LATERAL, value=Transformation.L_AUTO)
+        ruleset.set_transformation(key=Transformation.TARGET, value=Transformation.T_AUTO)
+        self.rule_lateral_yes.set_transformation(ruleset, key=Transformation.LATERAL, value=Transformation.L_YES)
+        self.rule_target_source_transfo.set_transformation(ruleset, key=Transformation.TARGET, value=Transformation.T_SOURCE)
+        self.rule_target_destination_transfo.set_transformation(ruleset, key=Transformation.ACTION, value=Transformation.A_BYPASS)
+        # transformations of other rulesets must not be used
+        self.rule_target_auto_transfo.set_transformation(other, key=Transformation.ACTION, value=Transformation.A_BYPASS)
+
+        transformations = RulesetTransformations.load(ruleset)
+        lines = ruleset.to_buffer().split('\n')[1:]
+        expected = []
+        for rule in Rule.objects.filter(state=True).order_by('pk'):
+            action, lateral, target = transformations.resolve(rule)
+            self.assertEqual(rule.generate_content(ruleset), self._legacy_content(rule, action, lateral, target))
+            expected.append(self._legacy_content(rule, action, lateral, target))
+
+        self.assertEqual(sorted(lines), sorted(expected))
+        self.assertIn(self._legacy_content(self.rule_lateral_yes, Transformation.A_DROP, Transformation.L_YES, Transformation.T_AUTO), lines)
+        self.assertEqual(transformations.resolve(self.rule_target_auto_transfo),
+                         [Transformation.A_DROP, Transformation.L_AUTO, Transformation.T_AUTO])
+        self.assertEqual(transformations.resolve(self.rule_target_destination_transfo),
+                         [Transformation.A_BYPASS, Transformation.L_AUTO, Transformation.T_AUTO])
+
+
+class TransformationsCacheTestCase(TransactionTestCase):
+    def setUp(self):
+        TransformationsCache.invalidate()
+        self.source = Source.objects.create(name='test source', created_date=timezone.now(), method='local', datatype='sig')
+        self.category = Category.objects.create(name='test category', filename='test', source=self.source)
+        self.rule = Rule.objects.create(sid=1, category=self.category, msg='test rule', content='alert ip any any -> any any (msg:"test rule"; sid:1; rev:1;)')
+        self.rulesets = [Ruleset.objects.create(name='ruleset %d' % i, descr='descr', created_date=timezone.now(), updated_date=timezone.now()) for i in xrange(2)]
+        self.rule.set_transformation(self.rulesets[0], key=Transformation.ACTION, value=Transformation.A_DROP)
+
+    def tearDown(self):
+        TransformationsCache.invalidate()
+
+    def test_001_ruleset_keyed(self):
+        self.assertEqual(self.rule.get_transformation(self.rulesets[0], key=Transformation.ACTION), Transformation.A_DROP)
+        self.assertEqual(self.rule.get_transformation(self.rulesets[1], key=Transformation.ACTION), None)
+        self.assertTrue(self.rule.is_transformed(self.rulesets[0], key=Transformation.ACTION, value=Transformation.A_DROP))
+        self.assertFalse(self.rule.is_transformed(self.rulesets[1], key=Transformation.ACTION, value=Transformation.A_DROP))
+
+    def test_002_cached(self):
+        with self.settings(TRANSFORMATIONS_CACHE_CHECK_INTERVAL=3600):
+            self.rule.get_transformation(self.rulesets[0])
+            with self.assertNumQueries(0):
+                for ruleset in self.rulesets:
+                    for key in (Transformation.ACTION, Transformation.LATERAL, Transformation.TARGET):
+                        self.rule.get_transformation(ruleset, key=key, override=True)
+                        self.category.get_transformation(ruleset, key=key, override=True)
+                    self.rule.is_transformed(ruleset)
+                    self.category.is_transformed(ruleset)
+
+    def test_003_invalidation(self):
+        with self.settings(TRANSFORMATIONS_CACHE_CHECK_INTERVAL=3600):
+            self.rule.set_transformation(self.rulesets[0], key=Transformation.ACTION, value=Transformation.A_REJECT)
+            self.assertEqual(self.rule.get_transformation(self.rulesets[0]), Transformation.A_REJECT)
+
+            self.rule.remove_transformations(self.rulesets[0], Transformation.ACTION)
+            self.category.toggle_transformation(self.rulesets[1], key=Transformation.TARGET, value=Transformation.T_SOURCE)
+            self.assertEqual(self.rule.get_transformation(self.rulesets[0]), None)
+            self.assertEqual(self.rule.get_transformation(self.rulesets[1], key=Transformation.TARGET, override=True), Transformation.T_SOURCE)
+
+            self.rulesets[0].set_transformation(key=Transformation.LATERAL, value=Transformation.L_YES)
+            self.assertEqual(self.rule.get_transformation(self.rulesets[0], key=Transformation.LATERAL, override=True), Transformation.L_YES)
+
+            self.rulesets[0].disable_rules([self.rule])
+            self.assertTrue(self.rule.is_transformed(self.rulesets[0], key=Transformation.SUPPRESSED, value=Transformation.S_SUPPRESSED))
+
+    def test_004_other_process(self):
+        with self.settings(TRANSFORMATIONS_CACHE_CHECK_INTERVAL=0):
+            self.rule.get_transformation(self.rulesets[0])
+            # change made without signal, then version changed by another process
+            RuleTransformation.objects.update(value=Transformation.A_REJECT.value)
+            cache.set(TransformationsCache.VERSION_KEY, 'other process')
+            self.assertEqual(self.rule.get_transformation(self.rulesets[0]), Transformation.A_REJECT)
+
+    def test_005_rollback(self):
+        self.rule.get_transformation(self.rulesets[0])
+        try:
+            with transaction.atomic():
+                self.rule.set_transformation(self.rulesets[0], key=Transformation.ACTION, value=Transformation.A_REJECT)
+                self.assertEqual(self.rule.get_transformation(self.rulesets[0]), Transformation.A_REJECT)
+                raise ValueError()
+        except ValueError:
+            pass
+        self.assertEqual(self.rule.get_transformation(self.rulesets[0]), Transformation.A_DROP)
+
+    def test_006_threads(self):
+        errors = []
+        # in memory test database can only be used through the main connection,
+        # which must not run queries of several threads at once
+        conn = connections['default']
+        conn.allow_thread_sharing = True
+        db_lock = threading.Lock()
+        load = RulesetTransformations.load.__func__
+
+        def locked_load(cls, ruleset=None):
+            with db_lock:
+                return load(cls, ruleset)
+        RulesetTransformations.load = classmethod(locked_load)
+
+        def worker():
+            connections['default'] = conn
+            try:
+                for i in xrange(20):
+                    if i % 5 == 0:
+                        TransformationsCache.invalidate()
+                    if self.rule.get_transformation(self.rulesets[0]) != Transformation.A_DROP:
+                        errors.append('wrong transformation')
+            except Exception as e:
+                errors.append(e)
+
+        try:
+            with self.settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}):
+                threads = [threading.Thread(target=worker) for _ in xrange(8)]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+        finally:
+            conn.allow_thread_sharing = False
+            RulesetTransformations.load = classmethod(load)
+        self.assertEqual(errors, [])
+
+    def test_007_commit(self):
+        with self.settings(TRANSFORMATIONS_CACHE_CHECK_INTERVAL=3600):
+            with transaction.atomic():
+                self.rule.set_transformation(self.rulesets[0], key=Transformation.ACTION, value=Transformation.A_REJECT)
+                # uncommitted changes are read from the database
+                with self.assertNumQueries(3):
+                    self.assertEqual(self.rule.get_transformation(self.rulesets[0]), Transformation.A_REJECT)
+            self.assertEqual(self.rule.get_transformation(self.rulesets[0]), Transformation.A_REJECT)
+            with self.assertNumQueries(0):
+                self.assertEqual(self.rule.get_transformation(self.rulesets[0]), Transformation.A_REJECT)
+
+
+class RuleParserTestCase(TestCase):
+    def setUp(self):
+        self.tmpdirname = tempfile.mkdtemp()
+        self.parser = RuleParser()
+
+    def tearDown(self):
+        rmtree(self.tmpdirname)
+
+    def test_001_parse_line(self):
+        rule = self.parser.parse_line(RULE_CONTENT)
+        self.assertEqual(rule.sid, 2100498)
+        self.assertEqual(rule.rev, 7)
+        self.assertEqual(rule.msg, 'Unicode test rule éàç')  # ignore_utf8_check: 233 224 231
+        self.assertEqual(rule.state, True)
+        self.assertEqual(rule.content, RULE_CONTENT)
+        self.assertEqual(rule.metadata, ('created_at 2010_09_23', 'updated_at 2010_09_23'))
+
+    def test_002_parse_commented_line(self):
+        self.assertEqual(self.parser.parse_line('# This is a comment\n'), None)
+        rule = self.parser.parse_line('# ' + RULE_CONTENT)
+        self.assertEqual(rule.state, False)
+        self.assertEqual(rule.content, RULE_CONTENT)
+
+    def test_003_parse_bits(self):
+        content = 'alert tcp any any -> any any (msg:"bits\\; test"; flowbits:set,foo; flowbits:isset, bar ; \
+flowbits:isnotset,baz; xbits:set,ctx,track ip_src; flowbits:noalert; sid:1; rev:1;)'
+        rule = self.parser.parse_line(content)
+        self.assertEqual(rule.msg, 'bits\\; test')
+        self.assertEqual(rule.bits, (
+            ('flowbits', 'set', 'foo'),
+            ('flowbits', 'isset', ' bar'),
+            ('xbits', 'set', 'ctx,track ip_src')
+        ))
+
+    def test_004_import_flowbits(self):
+        source = Source.objects.create(name='flowbits source', method='local', datatype='sig', created_date=timezone.now())
+        content = 'alert tcp any any -> any any (msg:"setter"; flowbits:set,et.test; flowbits:noalert; sid:1; rev:1;)\n\
+alert tcp any any -> any any (msg:"checker"; flowbits:isset,et.test; sid:2; rev:1;)\n'
+
+        f = tempfile.NamedTemporaryFile(dir=self.tmpdirname)
+        f.write(content)
+        f.seek(0)
+        with self.settings(GIT_SOURCES_BASE_DIRECTORY=self.tmpdirname):
+            source.handle_rules_file(f)
+
+        flowbit = Flowbit.objects.get(source=source, name='et.test')
+        self.assertEqual(list(flowbit.set.values_list('sid', flat=True)), [1])
+        self.assertEqual(list(flowbit.isset.values_list('sid', flat=True)), [2])
+
+    def test_005_parse_files(self):
+        filenames = []
+        for sid in (1, 2, 3):
+            filenames.append(os.path.join(self.tmpdirname, '%d.rules' % sid))
+            with open(filenames[-1], 'w') as f:
+                f.write('alert tcp any any -> any any (msg:"file %d"; sid:%d; rev:1;)\n' % (sid, sid))
+
+        # files are parsed one at a time, as they are consumed
+        parsed = self.parser.parse_files(filenames)
+        self.assertEqual(next(parsed)[0], filenames[0])
+        os.unlink(filenames[2])
+        self.assertEqual(next(parsed)[0], filenames[1])
+        self.assertRaises(IOError, next, parsed)
+
+        with open(filenames[2], 'w') as f:
+            f.write('alert tcp any any -> any any (msg:"file 3"; sid:3; rev:1;)\n')
+        parsed = [(filename, [rule.sid for rule in rules]) for filename, rules in self.parser.parse_files(filenames, workers=2)]
+        self.assertEqual(parsed, [(filenames[0], [1]), (filenames[1], [2]), (filenames[2], [3])])
+
+
+class SourceBulkUpdateTestCase(TestCase):
+    RULE = 'alert tcp any any -> any any (msg:"bulk rule %d"; content:"rev %d"; sid:%d; rev:%d;)\n'
+
+    def setUp(self):
+        self.tmpdirname = tempfile.mkdtemp()
+        self.source = Source.objects.create(name='bulk source', method='local', datatype='sig', created_date=timezone.now())
+
+    def tearDown(self):
+        rmtree(self.tmpdirname)
+
+    def _upload(self, rules, firstimport):
+        content = ''.join([self.RULE % (sid, rev, sid, rev) for sid, rev in rules])
+        source = Source.objects.get(pk=self.source.pk)
+        with self.settings(GIT_SOURCES_BASE_DIRECTORY=self.tmpdirname):
+            source.new_uploaded_file(SimpleUploadedFile('sigs.rules', content.encode('utf-8')), firstimport)
+
+    def test_001_update_and_delete(self):
+        self._upload([(sid, 1) for sid in range(1, 11)], True)
+        self.assertEqual(Rule.objects.count(), 10)
+
+        with CaptureQueriesContext(connection) as queries:
+            self._upload([(sid, 2) for sid in range(1, 6)] + [(sid, 1) for sid in range(6, 9)] + [(11, 1)], False)
+
+        updates = [query for query in queries.captured_queries if query['sql'].startswith('UPDATE "rules_rule"')]
+        self.assertEqual(len(updates), 1)
+
+        self.assertEqual(sorted(Rule.objects.values_list('sid', flat=True)), range(1, 9) + [11])
+        for rule in Rule.objects.filter(sid__in=range(1, 6)):
+            self.assertEqual(rule.rev, 2)
+            self.assertIn('content:"rev 2"', rule.content)
+        self.assertEqual(Rule.objects.get(sid=6).rev, 1)
+
+        update = SourceUpdate.objects.get(source=self.source)
+        self.assertEqual(update.diff()['stats'], {'added': 1, 'updated': 5, 'deleted': 2})
+
+    def test_002_bulk_update_params(self):
+        # 15 parameters by rule: 66 rules by UPDATE fit in the 999 variables of sqlite
+        self._upload([(sid, 1) for sid in range(1, 101)], True)
+        rules = list(Rule.objects.order_by('sid'))
+        for rule in rules:
+            rule.rev = 2
+        with CaptureQueriesContext(connection) as queries:
+            bulk_update(rules, Rule.IMPORT_FIELDS)
+        self.assertEqual(len([query for query in queries if query['sql'].startswith('UPDATE')]), 2)
+        self.assertEqual(Rule.objects.filter(rev=2).count(), 100)
+
+
+class RulesTarMixin(object):
+    RULE = 'alert tcp any any -> any any (msg:"index rule %d"; sid:%d; rev:%d;)\n'
+
+    def _build_tar(self, categories):
+        f = tempfile.NamedTemporaryFile(dir=self.tmpdirname)
+        tar = tarfile.open(fileobj=f, mode='w:gz')
+        info = tarfile.TarInfo('archive/rules')
+        info.type = tarfile.DIRTYPE
+        tar.addfile(info)
+        for name, rules in categories.iteritems():
+            content = ''.join([self.RULE % (rule[0], rule[0], rule[1]) if isinstance(rule, tuple) else rule for rule in rules]).encode('utf-8')
+            info = tarfile.TarInfo('archive/rules/%s.rules' % name)
+            info.size = len(content)
+            tar.addfile(info, StringIO(content))
+        tar.close()
+        f.flush()
+        return f
+
+
+class ZeroFile(object):
+    def __init__(self, size):
+        self.size = size
+
+    def read(self, size=-1):
+        if size < 0 or size > self.size:
+            size = self.size
+        self.size -= size
+        return b'\0' * size
+
+
+class LocalHTTPHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.server.requests.append((self.path, self.headers.dict))
+        if self.server.delay:
+            time.sleep(self.server.delay)
+        if self.path not in self.server.files:
+            self.send_error(404)
+            return
+        content = self.server.files[self.path]
+        if isinstance(content, file):
+            # large files are sent from disk without etag
+            content.seek(0, os.SEEK_END)
+            self.send_response(200)
+            self.send_header('Content-Length', unicode(content.tell()))
+            self.end_headers()
+            content.seek(0)
+            copyfileobj(content, self.wfile)
+            return
+        etag = '"%s"' % hashlib.md5(content).hexdigest()
+        if self.server.use_etag and self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        if self.server.use_etag:
+            self.send_header('ETag', etag)
+        self.send_header('Content-Length', unicode(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+
+class LocalHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, use_etag=True):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), LocalHTTPHandler)
+        self.files = {}
+        self.requests = []
+        self.use_etag = use_etag
+        self.delay = 0
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def url(self, path):
+        return 'http://127.0.0.1:%d%s' % (self.server_address[1], path)
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class FakeESHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # keep-alive connections
+    protocol_version = 'HTTP/1.1'
+
+    def _handle(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else None
+        self.server.requests.append((self.command, self.path, body, self.client_address, self.headers.dict))
+        if self.server.delay:
+            time.sleep(self.server.delay)
+        code, data = self.server.handler(self.command, self.path.split('?')[0], body)
+        content = json.dumps(data)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            buf = StringIO()
+            with gzip.GzipFile(fileobj=buf, mode='wb') as f:
+                f.write(content)
+            content = buf.getvalue()
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', unicode(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    do_GET = do_POST = do_DELETE = _handle
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeESServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    # Answers ES queries with the responses set by path, or with a handler
+    # function (method, path, body) -> (status, data)
+    daemon_threads = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), FakeESHandler)
+        self.responses = {}
+        self.requests = []
+        self.delay = 0
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def handler(self, method, path, body):
+        if path not in self.responses:
+            return 404, {'error': 'no such index'}
+        return 200, self.responses[path]
+
+    def handle_error(self, request, client_address):
+        # client closed the connection after a timeout
+        pass
+
+    def url(self, path):
+        return 'http://127.0.0.1:%d%s' % (self.server_address[1], path)
+
+    def stop(self):
+        # kept alive connections would block the server threads
+        get_es_transport().close()
+        self.shutdown()
+        self.server_close()
+
+
+class SourceRulesIndexTestCase(RulesTarMixin, TestCase):
+    def setUp(self):
+        self.tmpdirname = tempfile.mkdtemp()
+        self.source = Source.objects.create(name='index source', method='local', datatype='sigs', created_date=timezone.now())
+
+    def tearDown(self):
+        rmtree(self.tmpdirname)
+
+    def _import(self, source, categories):
+        with self.settings(GIT_SOURCES_BASE_DIRECTORY=self.tmpdirname):
+            source.handle_rules_in_tar(self._build_tar(categories))
+        return source
+
+    def test_001_category_move(self):
+        self._import(self.source, {'first': [(1, 1), (2, 1)], 'second': [(3, 1)]})
+        self.assertEqual(Rule.objects.count(), 3)
+
+        source = self._import(Source.objects.get(pk=self.source.pk), {'first': [(1, 1)], 'second': [(2, 2), (3, 1)]})
+        self.assertEqual(source.updated_rules['deleted'], [])
+        self.assertEqual([rule.sid for rule in source.updated_rules['updated']], [2])
+        rule = Rule.objects.get(sid=2)
+        self.assertEqual(rule.category.name, 'second')
+        self.assertEqual(rule.rev, 2)
+
+    def test_002_duplicate_sid(self):
+        self._import(self.source, {'first': [(1, 1)]})
+        other = Source.objects.create(name='other source', method='local', datatype='sigs', created_date=timezone.now())
+        with self.assertRaisesRegexp(ValidationError, r'conflicting SID \(1\) with other sources \(index source\)'):
+            self._import(other, {'other': [(1, 1)]})
+
+    def test_003_parallel_parsing(self):
+        categories = dict([('cat%d' % i, [(i * 10 + j, 1) for j in range(10)]) for i in range(4)])
+        with self.settings(RULES_PARSE_WORKERS=2):
+            source = self._import(self.source, categories)
+        self.assertEqual(Category.objects.filter(source=self.source).count(), 4)
+        self.assertEqual(Rule.objects.count(), 40)
+        self.assertEqual(len(source.updated_rules['added']), 40)
+
+    def test_004_incremental_update(self):
+        self._import(self.source, {'first': [(1, 1)], 'second': [(2, 1)]})
+        Rule.objects.filter(sid=1).update(rev=0)
+
+        source = self._import(Source.objects.get(pk=self.source.pk), {'first': [(1, 1)], 'second': [(2, 2)]})
+        self.assertEqual([rule.sid for rule in source.updated_rules['updated']], [2])
+        self.assertEqual(Rule.objects.get(sid=1).rev, 0)
+
+        # switching iprep mode requires a full parsing
+        source = Source.objects.get(pk=self.source.pk)
+        source.use_iprep = False
+        source.save()
+        self.assertEqual(source.imported_version, None)
+        source = self._import(Source.objects.get(pk=self.source.pk), {'first': [(1, 1)], 'second': [(2, 2)]})
+        self.assertEqual([rule.sid for rule in source.updated_rules['updated']], [1])
+        self.assertEqual(Rule.objects.get(sid=1).rev, 1)
+
+    def test_005_import_progress(self):
+        reports = []
+
+        def progress(percent, message):
+            # reported out of the import transaction
+            reports.append((percent, len(connection.savepoint_ids)))
+            raise JobCancelled()
+
+        categories = {'first': [(1, 1)], 'second': [(2, 1)]}
+        source = Source.objects.get(pk=self.source.pk)
+        source.fetched = (self._build_tar(categories), None)
+        # the test itself runs in a transaction
+        depth = len(connection.savepoint_ids)
+        with self.settings(GIT_SOURCES_BASE_DIRECTORY=self.tmpdirname):
+            with self.assertRaises(JobCancelled):
+                source.update(fetched=True, progress=progress)
+        # stopped before the database is changed
+        self.assertEqual(reports, [(10, depth)])
+        self.assertEqual(source.fetched, None)
+        self.assertEqual(Rule.objects.count(), 0)
+        self._import(Source.objects.get(pk=self.source.pk), categories)
+        self.assertEqual(Rule.objects.count(), 2)
+
+
+class SourceDownloadTestCase(RulesTarMixin, TestCase):
+    def setUp(self):
+        self.tmpdirname = tempfile.mkdtemp()
+        self.server = LocalHTTPServer()
+        self.server.files['/rules.tar.gz'] = self._tar_content({'first': [(1, 1)]})
+        self.source = Source.objects.create(name='http source', method='http', datatype='sigs',
+                                            uri=self.server.url('/rules.tar.gz'), created_date=timezone.now())
+
+    def tearDown(self):
+        self.server.stop()
+        rmtree(self.tmpdirname)
+
+    def _update(self):
+        source = Source.objects.get(pk=self.source.pk)
+        with self.settings(GIT_SOURCES_BASE_DIRECTORY=self.tmpdirname):
+            source.update()
+        return source
+
+    def _assert_no_import(self):
+        with CaptureQueriesContext(connection) as queries:
+            source = self._update()
+        for query in queries.captured_queries:
+            self.assertTrue(query['sql'].startswith(('SELECT', 'SAVEPOINT', 'RELEASE')), query['sql'])
+            self.assertNotIn('rules_rule', query['sql'])
+        return source
+
+    def _tar_content(self, categories):
+        f = self._build_tar(categories)
+        f.seek(0)
+        content = f.read()
+        f.close()
+        return content
+
+    def test_001_not_modified(self):
+        self._update()
+        self.assertEqual(Rule.objects.count(), 1)
+        self.assertNotIn('if-none-match', self.server.requests[0][1])
+
+        source = Source.objects.get(pk=self.source.pk)
+        self.assertEqual(source.content_digest, hashlib.sha256(self.server.files['/rules.tar.gz']).hexdigest())
+        self.assertTrue(source.http_etag)
+
+        source = self._assert_no_import()
+        self.assertEqual(self.server.requests[1][1]['if-none-match'], source.http_etag)
+        self.assertEqual(SourceAtVersion.objects.get(source=source).version, 'HEAD')
+        self.assertEqual(source.updated_rules, {'added': [], 'deleted': [], 'updated': []})
+
+    def test_002_same_content(self):
+        self.server.use_etag = False
+        self._update()
+        source = self._assert_no_import()
+        self.assertEqual(source.updated_rules, {'added': [], 'deleted': [], 'updated': []})
+
+        self.server.files['/rules.tar.gz'] = self._tar_content({'first': [(1, 2)]})
+        source = self._update()
+        self.assertEqual([rule.sid for rule in source.updated_rules['updated']], [1])
+        self.assertEqual(Rule.objects.get(sid=1).rev, 2)
+
+    def test_003_missing_git_dir(self):
+        self._update()
+        rmtree(os.path.join(self.tmpdirname, unicode(self.source.pk)))
+        self._update()
+        self.assertNotIn('if-none-match', self.server.requests[1][1])
+        self.assertEqual(Rule.objects.count(), 1)
+
+    def test_004_large_archive(self):
+        # archive with a big file outside of the rules directory: it must go
+        # through the download and the extraction without being kept in memory
+        blob_size = 128 * 1024 * 1024
+        archive = tempfile.TemporaryFile(dir=self.tmpdirname)
+        tar = tarfile.open(fileobj=archive, mode='w')
+        info = tarfile.TarInfo('archive/rules')
+        info.type = tarfile.DIRTYPE
+        tar.addfile(info)
+        content = self.RULE % (1, 1, 1)
+        info = tarfile.TarInfo('archive/rules/first.rules')
+        info.size = len(content)
+        tar.addfile(info, StringIO(content))
+        info = tarfile.TarInfo('archive/doc/blob.bin')
+        info.size = blob_size
+        tar.addfile(info, ZeroFile(blob_size))
+        tar.close()
+        self.server.files['/rules.tar.gz'] = archive
+
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        source = self._update()
+        # ru_maxrss is in kilobytes
+        self.assertLess(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - maxrss, blob_size / 1024 / 4)
+        self.assertEqual(Rule.objects.count(), 1)
+        self.assertEqual(os.listdir(os.path.join(self.tmpdirname, unicode(source.pk))), ['.git', 'rules'])
+        archive.close()
+
+    def test_005_invalid_archive(self):
+        archive = tempfile.NamedTemporaryFile(dir=self.tmpdirname)
+        tar = tarfile.open(fileobj=archive, mode='w:gz')
+        info = tarfile.TarInfo('archive/rules')
+        info.type = tarfile.DIRTYPE
+        tar.addfile(info)
+        info = tarfile.TarInfo('archive/rules/link.rules')
+        info.type = tarfile.SYMTYPE
+        info.linkname = '/etc/passwd'
+        tar.addfile(info)
+        tar.close()
+        archive.seek(0)
+        self.server.files['/rules.tar.gz'] = archive.read()
+
+        with self.assertRaisesRegexp(SuspiciousOperation, 'non regular file'):
+            self._update()
+        self.assertFalse(os.path.exists(os.path.join(self.tmpdirname, unicode(self.source.pk), 'rules')))
+        archive.close()
+
+
+class FlowbitGraphTestCase(RulesTarMixin, TestCase):
+    BITS_RULE = 'alert tcp any any -> any any (msg:"flowbit rule %d"; %ssid:%d; rev:%d;)\n'
+
+    def setUp(self):
+        self.tmpdirname = tempfile.mkdtemp()
+        self.source = Source.objects.create(name='flowbit source', method='local', datatype='sigs', created_date=timezone.now())
+        self.ruleset = Ruleset.objects.create(name='test ruleset', descr='descr', created_date=timezone.now(), updated_date=timezone.now())
+
+    def tearDown(self):
+        rmtree(self.tmpdirname)
+
+    def _rule(self, sid, bits, rev=1):
+        return self.BITS_RULE % (sid, ''.join(['flowbits:%s,%s; ' % bit for bit in bits]), sid, rev)
+
+    def _import(self, rules):
+        source = Source.objects.get(pk=self.source.pk)
+        with self.settings(GIT_SOURCES_BASE_DIRECTORY=self.tmpdirname):
+            source.handle_rules_in_tar(self._build_tar({'first': rules}))
+        return source
+
+    def _import_chain(self):
+        # 3 and 4 build a cycle on flowbits B and C
+        self._import([self._rule(1, [('set', 'A')]),
+                      self._rule(2, [('isset', 'A'), ('set', 'B')]),
+                      self._rule(3, [('isset', 'B'), ('set', 'C')]),
+                      self._rule(4, [('isset', 'C'), ('set', 'B')])])
+        self.ruleset.categories.add(Category.objects.get(source=self.source))
+
+    def test_001_import_links(self):
+        self._import_chain()
+        self.assertEqual(Flowbit.objects.count(), 3)
+        self.assertEqual(Flowbit.set.through.objects.count(), 4)
+        self.assertEqual(Flowbit.isset.through.objects.count(), 3)
+
+        self._import([self._rule(1, [('set', 'A')]),
+                      self._rule(2, [('isset', 'A'), ('isset', 'D'), ('set', 'B')], rev=2),
+                      self._rule(3, [('isset', 'B'), ('set', 'C')], rev=2),
+                      self._rule(4, [('isset', 'C'), ('set', 'B')])])
+        self.assertEqual(Flowbit.set.through.objects.count(), 4)
+        self.assertEqual(Flowbit.isset.through.objects.count(), 4)
+        self.assertEqual(Flowbit.objects.get(isset=2, name='D').type, 'flowbits')
+
+    def test_002_cycle(self):
+        self._import_chain()
+        graph = FlowbitGraph()
+        self.assertEqual(graph.dependant_sids(1), [2, 3, 4])
+        self.assertEqual(graph.dependant_sids(3), [4])
+
+    def test_003_dependant_rules(self):
+        self._import_chain()
+        graph = FlowbitGraph()
+        rule = Rule.objects.get(pk=1)
+        with self.assertNumQueries(2):
+            rules = rule.get_dependant_rules(self.ruleset, flowbit_graph=graph)
+        # 4 also sets B
+        self.assertEqual([rule.pk for rule in rules], [2])
+
+        Rule.objects.get(pk=4).disable(self.ruleset)
+        rules = Rule.objects.get(pk=1).get_dependant_rules(self.ruleset, flowbit_graph=graph)
+        self.assertEqual([rule.pk for rule in rules], [2, 3, 4])
+
+        Rule.objects.get(pk=1).disable(self.ruleset, flowbit_graph=graph)
+        suppressed = self.ruleset.get_transformed_rules(key=Transformation.SUPPRESSED, value=Transformation.S_SUPPRESSED)
+        self.assertEqual(sorted(suppressed.values_list('pk', flat=True)), [1, 2, 3, 4])
+
+    def test_004_rule_graph(self):
+        self._import_chain()
+        self._import([self._rule(5, [('set', 'E')]),
+                      self._rule(6, [('isset', 'E')])])
+        full_graph = FlowbitGraph()
+        for sid in xrange(1, 7):
+            graph = FlowbitGraph(sid=sid)
+            self.assertEqual(graph.dependant_sids(sid), full_graph.dependant_sids(sid))
+            self.assertEqual(graph.dependant_sids(sid, set([4])), full_graph.dependant_sids(sid, set([4])))
+
+        # only the flowbits chains of the rule are loaded, 3 queries per level
+        with self.assertNumQueries(10):
+            graph = FlowbitGraph(sid=1)
+        self.assertEqual(sorted(graph.setters.keys()), sorted(Flowbit.objects.exclude(name='E').values_list('pk', flat=True)))
+
+        # a rule setting no flowbit only needs a single query
+        rule = Rule.objects.get(pk=6)
+        with self.assertNumQueries(1):
+            self.assertEqual(rule.get_dependant_rules(self.ruleset), [])
+
+
+class RulesetUpdateTestCase(RulesTarMixin, TestCase):
+    DELAY = 0.5
+
+    def setUp(self):
+        self.tmpdirname = tempfile.mkdtemp()
+        self.server = LocalHTTPServer()
+        self.server.delay = self.DELAY
+        self.ruleset = Ruleset.objects.create(name='test ruleset', descr='descr', created_date=timezone.now(), updated_date=timezone.now())
+        self.sources = []
+        for i in xrange(4):
+            path = '/source%d.tar.gz' % i
+            f = self._build_tar({'cat%d' % i: [(i * 10 + j, 1) for j in xrange(5)]})
+            f.seek(0)
+            self.server.files[path] = f.read()
+            f.close()
+            source = Source.objects.create(name='source %d' % i, method='http', datatype='sigs',
+                                           uri=self.server.url(path), created_date=timezone.now())
+            self.ruleset.sources.add(SourceAtVersion.objects.create(source=source, version='HEAD'))
+            self.sources.append(source)
+
+    def tearDown(self):
+        self.server.stop()
+        rmtree(self.tmpdirname)
+
+    def _update(self):
+        start = time.time()
+        with self.settings(GIT_SOURCES_BASE_DIRECTORY=self.tmpdirname, SOURCES_UPDATE_WORKERS=4):
+            self.ruleset.update()
+        return time.time() - start
+
+    def test_001_concurrent_update(self):
+        duration = self._update()
+        self.assertLess(duration, self.DELAY * len(self.sources))
+        self.assertEqual(Category.objects.count(), 4)
+        self.assertEqual(Rule.objects.count(), 20)
+        self.assertTrue(Ruleset.objects.get(pk=self.ruleset.pk).need_test)
+
+    def test_002_update_errors(self):
+        del self.server.files['/source2.tar.gz']
+        with self.assertRaises(IOError) as ctx:
+            self._update()
+        self.assertEqual(ctx.exception.message.split('\n')[0], 'Source "source 2" update failed:')
+        self.assertIn('URL not found on server', ctx.exception.message)
+        self.assertEqual(Category.objects.count(), 3)
+        self.assertEqual(Rule.objects.count(), 15)
+        self.assertTrue(Ruleset.objects.get(pk=self.ruleset.pk).need_test)
+
+    def test_003_invalid_source(self):
+        # other errors stop the update at the failing source
+        self.server.files['/source1.tar.gz'] = b'not a tar file'
+        tmp_dirs = set(os.listdir(Source.TMP_DIR))
+        with self.assertRaisesRegexp(OSError, 'Invalid tar file'):
+            self._update()
+        self.assertEqual(Category.objects.get().source, self.sources[0])
+        self.assertEqual(set(os.listdir(Source.TMP_DIR)), tmp_dirs)
+
+
+class RulesetArtifactTestCase(TestCase):
+    RULE = 'alert tcp $HOME_NET any -> $EXTERNAL_NET any (msg:"artifact rule %d"; sid:%d; rev:1;)'
+
+    def setUp(self):
+        self.tmpdirname = tempfile.mkdtemp()
+        self.settings_override = self.settings(RULESET_ARTIFACTS_DIRECTORY=self.tmpdirname)
+        self.settings_override.enable()
+
+        self.source = Source.objects.create(name='artifact source', method='local', datatype='sigs', created_date=timezone.now())
+        self.category = Category.objects.create(name='artifact category', filename='test', source=self.source)
+        for sid in xrange(1, 4):
+            Rule.objects.create(sid=sid, category=self.category, msg='artifact rule %d' % sid, content=self.RULE % (sid, sid))
+        self.ruleset = Ruleset.objects.create(name='artifact ruleset', created_date=timezone.now(), updated_date=timezone.now())
+        self.ruleset.sources.add(SourceAtVersion.objects.create(source=self.source, version='HEAD'))
+        self.ruleset.categories.add(self.category)
+
+    def tearDown(self):
+        self.settings_override.disable()
+        rmtree(self.tmpdirname)
+
+    def _to_buffer(self, generated):
+        calls = []
+        generate_artifact = self.ruleset._generate_artifact
+
+        # full generations, patched rules files are given their entries
+        def counted(state, entries=None):
+            if entries is None:
+                calls.append(1)
+            return generate_artifact(state, entries)
+        self.ruleset._generate_artifact = counted
+        try:
+            content = self.ruleset.to_buffer()
+        finally:
+            del self.ruleset._generate_artifact
+        self.assertEqual(len(calls), int(generated))
+        return content
+
+    def test_001_reuse(self):
+        content = self._to_buffer(generated=True)
+        self.assertEqual(self._to_buffer(generated=False), content)
+        self.assertEqual(self.ruleset.rules_count, 3)
+        # rules file, its index and its offsets
+        self.assertEqual(len(os.listdir(self.tmpdirname)), 3)
+
+    def test_002_invalidation(self):
+        content = self._to_buffer(generated=True)
+
+        self.ruleset.set_transformation(key=Transformation.ACTION, value=Transformation.A_DROP)
+        content = self._to_buffer(generated=True)
+        self.assertIn('drop tcp', content)
+
+        self.ruleset.categories.remove(self.category)
+        self.assertEqual(self._to_buffer(generated=True).count('\n'), 1)
+        self.ruleset.categories.add(self.category)
+
+        Threshold.objects.create(ruleset=self.ruleset, rule=Rule.objects.get(pk=1), net='10.0.0.0/8')
+        self._to_buffer(generated=True)
+        self._to_buffer(generated=False)
+
+        # changes not notified through needs_test are caught by the fingerprint
+        SourceAtVersion.objects.filter(source=self.source).update(version='42')
+        self._to_buffer(generated=True)
+        # rules are changed by source updates
+        Rule.objects.filter(pk=3).update(content=self.RULE.replace('rev:1', 'rev:2') % (3, 3), updated_date=timezone.now())
+        Source.objects.filter(pk=self.source.pk).update(updated_date=timezone.now())
+        self.assertIn('rev:2', self._to_buffer(generated=True))
+        self.assertEqual(len(os.listdir(self.tmpdirname)), 3)
+
+    def test_003_delete(self):
+        self._to_buffer(generated=True)
+        self.ruleset.delete()
+        self.assertEqual(os.listdir(self.tmpdirname), [])
+
+    def _body(self, content):
+        return content.split('\n', 1)[1]
+
+    def test_004_state_rules_count(self):
+        self.ruleset.artifact_state()
+        # rules are not counted again while the state does not change
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.ruleset.artifact_state()['rules_count'], 3)
+        self.assertFalse([query for query in queries if 'FROM "rules_rule"' in query['sql']])
+
+        self.ruleset.disable_rules([Rule.objects.get(pk=1)])
+        self.assertEqual(self.ruleset.artifact_state()['rules_count'], 2)
+
+    def test_005_concurrent_cleanup(self):
+        self._to_buffer(generated=True)
+        kept = sorted(os.listdir(self.tmpdirname))
+        # stored by a concurrent generation after this one
+        newer = self.ruleset._artifact_path('newer')
+        open(newer, 'w').close()
+        os.utime(newer, (time.time() + 10, time.time() + 10))
+        self.ruleset.invalidate_artifact(keep=[os.path.join(self.tmpdirname, path) for path in kept])
+        self.assertEqual(sorted(os.listdir(self.tmpdirname)), sorted(kept + [os.path.basename(newer)]))
+
+        # older files are removed
+        self.ruleset.invalidate_artifact(keep=[newer])
+        self.assertEqual(os.listdir(self.tmpdirname), [os.path.basename(newer)])
+
+    def test_006_patch(self):
+        self._to_buffer(generated=True)
+
+        Rule.objects.get(pk=2).disable(self.ruleset)
+        content = self._to_buffer(generated=False)
+        self.assertNotIn('artifact rule 2"', content)
+        self.assertEqual(self.ruleset.rules_count, 2)
+
+        Rule.objects.get(pk=3).set_transformation(self.ruleset, key=Transformation.ACTION, value=Transformation.A_REJECT)
+        Rule.objects.get(pk=2).enable(self.ruleset)
+        content = self._to_buffer(generated=False)
+        self.assertIn('reject tcp', content)
+        self.assertEqual(self.ruleset.rules_count, 3)
+        self.ruleset.invalidate_artifact()
+        self.assertEqual(self._body(content), self._body(self._to_buffer(generated=True)))
+
+    def test_007_patch_limit(self):
+        self._to_buffer(generated=True)
+        with self.settings(RULESET_ARTIFACT_PATCH_MAX_RULES=1):
+            self.ruleset.disable_rules(Rule.objects.filter(pk__in=[1, 2]))
+            self.assertEqual(self._to_buffer(generated=True).count('sid:'), 1)
+
+    def test_008_patch_lookup(self):
+        for sid in xrange(4, 11):
+            Rule.objects.create(sid=sid, category=self.category, msg='artifact rule %d' % sid, content=self.RULE % (sid, sid))
+        self._to_buffer(generated=True)
+        index = self.ruleset._load_artifact_index(self.ruleset.artifact_state())
+        with open(index['offsets_path'], 'rb') as offsets_file:
+            self.assertEqual(self.ruleset._find_artifact_record(offsets_file, 7)[0], 7)
+            self.assertEqual(self.ruleset._find_artifact_record(offsets_file, 42), None)
+
+        # only the changed rules are loaded from the database
+        Rule.objects.get(pk=5).disable(self.ruleset)
+        Rule.objects.get(pk=8).set_transformation(self.ruleset, key=Transformation.ACTION, value=Transformation.A_DROP)
+        with CaptureQueriesContext(connection) as queries:
+            content = self._to_buffer(generated=False)
+        rules_queries = [query['sql'] for query in queries if 'FROM "rules_rule"' in query['sql']]
+        self.assertEqual(len(rules_queries), 2)
+        self.assertIn(' IN (', rules_queries[-1])
+        self.assertEqual(self.ruleset.rules_count, 9)
+
+        self.ruleset.invalidate_artifact()
+        self.assertEqual(self._body(content), self._body(self._to_buffer(generated=True)))
+        self.assertIn('drop tcp', content)
+
+    def test_009_stream(self):
+        with self.settings(RULESET_EXPORT_CHUNK_SIZE=10):
+            # generated: header and first rule, then one chunk per rule
+            chunks = list(self.ruleset.iter_buffer())
+            self.assertEqual(len(chunks), 3)
+            data = b''.join(chunks)
+            self.assertEqual(data.decode('utf-8'), self._to_buffer(generated=False))
+            # stored
+            self.assertEqual(len(list(self.ruleset.iter_buffer())), (len(data) + 9) / 10)
+
+        # interrupted stream does not store a partial rules file
+        self.ruleset.invalidate_artifact()
+        with self.settings(RULESET_EXPORT_CHUNK_SIZE=10):
+            stream = self.ruleset.iter_buffer()
+            next(stream)
+            stream.close()
+        self.assertEqual(os.listdir(self.tmpdirname), [])
+
+    def test_010_export(self):
+        user = User.objects.create(username='scirius', password='scirius', is_superuser=True, is_staff=True)
+        self.client.force_login(user)
+        for url in (reverse('export_ruleset', args=(self.ruleset.pk,)), '/rest/rules/ruleset/%d/export/' % self.ruleset.pk):
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(response.streaming)
+            content = b''.join(response.streaming_content).decode('utf-8')
+            self.assertEqual(content.count('sid:'), 3)
+
+
+class RulesetGenerateTestCase(TestCase):
+    RULE = 'alert tcp any any -> any any (msg:"generate rule %d"; sid:%d; rev:1;)'
+
+    def setUp(self):
+        now = timezone.now()
+        self.rulesets = []
+        self.sources = []
+        for idx in xrange(2):
+            source = Source.objects.create(name='source %d' % idx, method='local', datatype='sigs', created_date=now)
+            category = Category.objects.create(name='category %d' % idx, filename='test', source=source)
+            for sid in xrange(idx * 10, idx * 10 + 5):
+                Rule.objects.create(sid=sid, category=category, msg='rule %d' % sid, content=self.RULE % (sid, sid), state=sid != 3)
+            self.sources.append(source)
+        for idx in xrange(3):
+            self.rulesets.append(Ruleset.objects.create(name='ruleset %d' % idx, created_date=now, updated_date=now))
+
+        self.rulesets[0].sources.add(SourceAtVersion.objects.create(source=self.sources[0], version='HEAD'))
+        self.rulesets[0].categories.add(*Category.objects.all())
+        self.rulesets[1].sources.add(*SourceAtVersion.objects.all())
+        self.rulesets[1].sources.add(SourceAtVersion.objects.create(source=self.sources[1], version='42'))
+        self.rulesets[1].categories.add(*Category.objects.all())
+        self.rulesets[1].disable_rules(Rule.objects.filter(pk__in=[1, 2, 11]))
+        self.rulesets[1].set_transformation(key=Transformation.ACTION, value=Transformation.A_DROP)
+        self.rulesets[2].disable_rules(Rule.objects.filter(pk__in=[4]))
+
+    def test_001_suppressed_in_ruleset(self):
+        # suppressions of other rulesets are ignored
+        self.assertEqual(sorted(self.rulesets[0].generate().values_list('pk', flat=True)), [0, 1, 2, 4])
+        self.assertEqual(sorted(self.rulesets[1].generate().values_list('pk', flat=True)), [0, 4, 10, 12, 13, 14])
+        self.assertEqual(self.rulesets[2].generate().count(), 0)
+
+    def test_002_rules_counts(self):
+        with self.assertNumQueries(1):
+            counts = Ruleset.get_rules_counts()
+        self.assertEqual(counts, dict((ruleset.pk, ruleset.generate().count()) for ruleset in self.rulesets))
+        self.assertEqual(counts[self.rulesets[1].pk], 6)
+
+
+class SuricataTestPoolTestCase(RulesTarMixin, TestCase):
+    # stub of suricata -T: fails on rules containing "broken", "invalid" or an
+    # undefined $FOO variable, and logs the configuration file used
+    STUB = """#!/bin/sh
+echo "$7" >> "%(log)s"
+sleep %(delay)s
+if grep -v '^#' "$5" | grep -q '$FOO '; then
+    echo '{"engine": {"error_code": 101, "message": "Variable \\"FOO\\" is not defined"}}' >&2
+    exit 1
+fi
+if grep -q broken "$5"; then
+    echo '{"engine": {"error_code": 2, "message": "broken signature"}}' >&2
+    exit 1
+fi
+if grep -q invalid "$5"; then
+    echo '{"engine": {"error_code": 39, "message": "error parsing signature \\"invalid sid:1;\\" from file"}}' >&2
+    exit 1
+fi
+exit 0
+"""
+    DELAY = 0.3
+
+    def setUp(self):
+        self.tmpdirname = tempfile.mkdtemp()
+        self.log = os.path.join(self.tmpdirname, 'calls.log')
+        stub = os.path.join(self.tmpdirname, 'suricata')
+        with open(stub, 'w') as f:
+            f.write(self.STUB % {'log': self.log, 'delay': self.DELAY})
+        os.chmod(stub, 0o755)
+        self.settings_override = self.settings(SURICATA_BINARY=stub)
+        self.settings_override.enable()
+
+    def tearDown(self):
+        self.settings_override.disable()
+        rmtree(self.tmpdirname)
+
+    def _configs(self):
+        with open(self.log) as f:
+            return [line.strip() for line in f]
+
+    def test_001_result(self):
+        res = TestRules().rules('alert tcp any any -> any any (msg:"valid"; sid:1;)')
+        self.assertTrue(res['status'])
+        res = TestRules().rules('alert tcp any any -> any any (msg:"invalid"; sid:1;)')
+        self.assertFalse(res['status'])
+        self.assertEqual(res['errors'][0]['sid'], 1)
+
+    def test_002_sandbox_reuse(self):
+        testor = TestRules()
+        for sid in xrange(2):
+            testor.rules('alert tcp any any -> any any (msg:"valid"; sid:%d;)' % sid, related_files={'a.list': '1.2.3.4'})
+        testor.rules('alert tcp any any -> any any (msg:"valid"; sid:1;)', related_files={'a.list': '1.2.3.5'})
+        configs = self._configs()
+        self.assertEqual(len(configs), 3)
+        self.assertEqual(configs[0], configs[1])
+        self.assertNotEqual(configs[0], configs[2])
+        self.assertTrue(os.path.isfile(configs[0]))
+
+    def test_003_concurrency(self):
+        pool = TestSandboxPool(workers=4, queue_size=2, max_sandboxes=1)
+        testor = TestRules()
+        start = time.time()
+        jobs = [pool.submit('alert tcp any any -> any any (msg:"valid"; sid:%d;)' % sid, testor.CONFIG_FILE,
+                            {'a.list': unicode(sid % 2)}, testor.REFERENCE_CONFIG, testor.CLASSIFICATION_CONFIG)
+                for sid in xrange(8)]
+        self.assertTrue(all(job.result()['status'] for job in jobs))
+        self.assertLess(time.time() - start, self.DELAY * 4)
+        # one sandbox kept once tests are done
+        self.assertEqual(len(set(self._configs())), 2)
+        self.assertEqual(len(pool.sandboxes), 1)
+        self.assertEqual(len([config for config in set(self._configs()) if os.path.exists(config)]), 1)
+        pool.close()
+
+    def test_004_ruleset_related_files(self):
+        source = Source.objects.create(name='test source', method='local', datatype='sigs', created_date=timezone.now())
+        with self.settings(GIT_SOURCES_BASE_DIRECTORY=self.tmpdirname):
+            source.handle_rules_in_tar(self._build_tar({'first': [(1, 1)]}))
+            ruleset = Ruleset.objects.create(name='test ruleset', created_date=timezone.now(), updated_date=timezone.now())
+            ruleset.sources.add(SourceAtVersion.objects.get(source=source))
+            ruleset.categories.add(Category.objects.get(source=source))
+
+            exports = []
+            export_files = Source.export_files
+
+            def counted(self, directory, version):
+                exports.append(version)
+                return export_files(self, directory, version)
+            Source.export_files = counted
+            try:
+                for _ in xrange(2):
+                    self.assertTrue(ruleset.test()['status'])
+            finally:
+                Source.export_files = export_files
+        self.assertEqual(exports, ['HEAD'])
+
+    def test_005_iprep_files_key(self):
+        source = Source.objects.create(name='iprep source', method='local', datatype='sigs', created_date=timezone.now())
+        category = Category.objects.create(name='iprep category', filename='iprep', source=source)
+        Rule.objects.create(sid=1, category=category, msg='iprep group', content='alert ip any any -> any any (sid:1;)',
+                            group=True, group_ips_list='1.2.3.4')
+        key = TestSandboxPool._key('config')
+        # group IPs change on source update without touching updated_date
+        Rule.objects.filter(sid=1).update(group_ips_list='1.2.3.4,5.6.7.8')
+        self.assertNotEqual(TestSandboxPool._key('config'), key)
+
+        testor = TestRules()
+        testor.rules('alert tcp any any -> any any (msg:"valid"; sid:2;)')
+        sandbox_dir = os.path.dirname(self._configs()[-1])
+        with open(os.path.join(sandbox_dir, 'scirius-iprep.list')) as f:
+            self.assertEqual(f.read(), '1.2.3.4,1,100\n5.6.7.8,1,100\n')
+
+    def test_006_variables(self):
+        rule_buffer = 'alert tcp $HOME_NET any -> [$FOO,!$BAR] $FOO_PORTS (msg:"$FOO"; sid:1;)\n\
+# alert tcp $FOO any -> any any (msg:"commented"; sid:2;)\n\
+alert tcp $FOO $HTTP_PORTS -> $EXTERNAL_NET any (msg:"valid"; sid:3;)\n'
+        testor = TestRules()
+        resolved, warnings = testor.resolve_variables(rule_buffer, testor.CONFIG_FILE)
+        self.assertEqual(resolved, 'alert tcp $HOME_NET any -> [any,any] any (msg:"$FOO"; sid:1;)\n\
+# alert tcp $FOO any -> any any (msg:"commented"; sid:2;)\n\
+alert tcp any $HTTP_PORTS -> $EXTERNAL_NET any (msg:"valid"; sid:3;)\n')
+
+        res = testor.rules(rule_buffer)
+        self.assertTrue(res['status'])
+        self.assertEqual(res['errors'], [])
+        self.assertEqual([warning['message'] for warning in res['warnings']],
+                         ['Custom address variable &quot;$%s&quot; is used and need to be defined in probes configuration' % var
+                          for var in ('FOO', 'BAR', 'FOO_PORTS')])
+        self.assertEqual(len(self._configs()), 1)
+
+        # tests of other configurations run concurrently
+        configs = [testor.CONFIG_FILE, testor.CONFIG_FILE.replace('EXTERNAL_NET:', 'OTHER_NET:')]
+        errors = []
+
+        def resolve(config):
+            try:
+                for _ in xrange(50):
+                    variables = TestRules().get_config_variables(config)
+                    if ('OTHER_NET' in variables) != (config is configs[1]):
+                        errors.append(variables)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=resolve, args=(configs[i % 2],)) for i in xrange(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+
+    def test_007_rule_validator(self):
+        source = Source.objects.create(name='test source', method='local', datatype='sigs', created_date=timezone.now())
+        rules = [(sid, 1) for sid in xrange(1, 9) if sid != 5]
+        rules.append('alert tcp any any -> any any (msg:"broken rule"; sid:5; rev:1;)\n')
+        with self.settings(GIT_SOURCES_BASE_DIRECTORY=self.tmpdirname):
+            source.handle_rules_in_tar(self._build_tar({'first': rules}))
+            ruleset = Ruleset.objects.create(name='test ruleset', created_date=timezone.now(), updated_date=timezone.now())
+            ruleset.sources.add(SourceAtVersion.objects.get(source=source))
+            ruleset.categories.add(Category.objects.get(source=source))
+
+            # valid rules are tested in a single run
+            res = RuleValidator(ruleset).validate_sids([1, 2, 3, 4])
+            self.assertEqual(res, dict((sid, {'status': True, 'errors': ''}) for sid in xrange(1, 5)))
+            self.assertEqual(len(self._configs()), 1)
+
+            # rules 1 to 4 are cached, 5 to 8 are bisected
+            res = RuleValidator(ruleset).validate_sids(xrange(1, 9))
+            self.assertEqual(sorted(sid for sid in res if res[sid]['status']), [1, 2, 3, 4, 6, 7, 8])
+            self.assertEqual(res[5]['errors'][0]['message'], 'broken signature')
+            self.assertEqual(len(self._configs()), 6)
+
+            RuleValidator(ruleset).validate_sids(xrange(1, 9))
+            self.assertEqual(len(self._configs()), 6)
+            # same result as a single rule test
+            self.assertEqual(res[6], Rule.objects.get(pk=6).test(ruleset))
+
+    def test_008_results_cache(self):
+        testor = TestRules()
+        rule_buffer = 'alert tcp any any -> any any (msg:"invalid"; sid:1;)'
+        res = testor.rules(rule_buffer)
+        res['errors'] = []
+        self.assertEqual(testor.rules(rule_buffer)['errors'][0]['sid'], 1)
+        self.assertEqual(len(self._configs()), 1)
+        # other processes get results from the Django cache
+        get_test_results_cache().clear()
+        self.assertFalse(testor.rules(rule_buffer)['status'])
+        self.assertEqual(len(self._configs()), 1)
+        testor.rules(rule_buffer, related_files={'a.list': '1.2.3.4'})
+        self.assertEqual(len(self._configs()), 2)
+
+        results = TestResultsCache(max_size=70, timeout=60)
+        for key in ('a', 'b', 'c'):
+            results.set(key, {'status': True, 'errors': ''})
+        results.get('b')
+        results.set('d', {'status': True, 'errors': ''})
+        self.assertEqual(results.results.keys(), ['b', 'd'])
+        self.assertLessEqual(results.size, 70)
+
 
 class RestAPITestBase(object):
     def setUp(self):
@@ -698,6 +1887,14 @@ class RestAPIRulesetTestCase(RestAPITestBase, APITestCase):
         response = self.http_post(reverse('ruleset-list'), params, status=status.HTTP_201_CREATED)
         self.assertEqual(response['name'], name)
 
+    def test_010_rules_count(self):
+        params = {"name": "MyCreatedRuleset",
+                  "sources": [self.source.pk],
+                  "categories": [self.category.pk]}
+        ruleset = self.http_post(reverse('ruleset-list'), params, status=status.HTTP_201_CREATED)
+        self.assertEqual(self.http_get(reverse('ruleset-rules-count', args=(ruleset['pk'],))), {'rules_count': 1})
+        self.assertEqual(self.http_get(reverse('ruleset-rules-counts')), {ruleset['pk']: 1})
+
 
 class RestAPIRuleTestCase(RestAPITestBase, APITestCase):
     def setUp(self):
@@ -868,6 +2065,10 @@ flowbits:set,ET.BotccIP; classtype:trojan-activity; sid:2404000; rev:4933;)'
         self.assertTrue(self.ruleset.pk in status_)
         self.assertEqual(status_[self.ruleset.pk]['transformations']['action'], 'reject')
 
+        res = self.http_post(reverse('rule-validate'), {'sids': [self.rule.pk], 'rulesets': [self.ruleset.pk]})
+        self.assertEqual(res.keys(), [self.ruleset.pk])
+        self.assertEqual(res[self.ruleset.pk][self.rule.pk], status_[self.ruleset.pk]['valid'])
+
     def test_007_rule_toggle_availability(self):
         self.http_post(reverse('rule-toggle-availability', args=(self.rule.pk,)), {}, status=status.HTTP_200_OK)
         rule = Rule.objects.get(pk=self.rule.pk)
@@ -1536,3 +2737,434 @@ class RestAPISystemSettingsTestCase(RestAPITestBase, APITestCase):
         content = self.http_put(reverse('systemsettings'), params)
         self.assertEqual(content['use_http_proxy'], False)
         self.assertEqual(content['use_elasticsearch'], False)
+
+
+def progress_job(job, steps, fail=False, cancel_at=None):
+    for step in xrange(steps):
+        if step == cancel_at:
+            Job.objects.get(pk=job.pk).cancel()
+        job.set_progress(step * 100 / steps, 'Step %d' % step)
+    if fail:
+        raise IOError('Can not fetch data')
+    return {'steps': steps}
+
+
+class JobTestCase(RestAPITestBase, APITestCase):
+    def setUp(self):
+        RestAPITestBase.setUp(self)
+        APITestCase.setUp(self)
+        JOBS['progress'] = 'rules.tests.progress_job'
+        self.runner = JobRunner(workers=0, poll_interval=1)
+
+    def tearDown(self):
+        del JOBS['progress']
+
+    def test_001_run(self):
+        job = Job.submit('progress', user=self.user, steps=3)
+        self.assertEqual(job.status, Job.PENDING)
+        self.runner.run_pending()
+        job.refresh_from_db()
+        self.assertEqual(job.status, Job.SUCCESS)
+        self.assertEqual(job.progress, 100)
+        self.assertEqual(job.message, 'Step 2')
+        self.assertEqual(job.get_result(), {'steps': 3})
+        self.assertIsNotNone(job.ended_date)
+        self.assertRaises(ValueError, Job.submit, 'unknown')
+
+    def test_002_failure(self):
+        job = Job.submit('progress', steps=1, fail=True)
+        self.runner.run_pending()
+        job.refresh_from_db()
+        self.assertEqual(job.status, Job.FAILURE)
+        self.assertEqual(job.message, 'Can not fetch data')
+
+    def test_003_cancel(self):
+        pending = Job.submit('progress', steps=1)
+        pending.cancel()
+        running = Job.submit('progress', steps=3, cancel_at=1)
+        self.runner.run_pending()
+
+        pending.refresh_from_db()
+        self.assertEqual(pending.status, Job.CANCELLED)
+        self.assertIsNone(pending.started_date)
+        running.refresh_from_db()
+        self.assertEqual(running.status, Job.CANCELLED)
+        self.assertEqual(running.progress, 33)
+
+    def test_004_recover(self):
+        # no process has this pid
+        dead_worker = '%s:%d' % (socket.gethostname(), 2 ** 22 + 1)
+        interrupted = Job.submit('progress', steps=2)
+        self.assertTrue(interrupted.claim(dead_worker))
+        cancelled = Job.submit('progress', steps=2)
+        self.assertTrue(cancelled.claim(dead_worker))
+        Job.objects.get(pk=cancelled.pk).cancel()
+        alive = Job.submit('progress', steps=2)
+        self.assertTrue(alive.claim(self.runner.worker))
+
+        self.runner.recover()
+        self.runner.run_pending()
+        statuses = [(job.status, job.worker) for job in Job.objects.filter(pk__in=[interrupted.pk, cancelled.pk, alive.pk]).order_by('pk')]
+        self.assertEqual(statuses, [(Job.SUCCESS, self.runner.worker), (Job.CANCELLED, dead_worker), (Job.RUNNING, self.runner.worker)])
+
+    def test_005_rest(self):
+        source = Source.objects.create(name='test source', created_date=timezone.now(), method='local', datatype='sig')
+        res = self.http_post(reverse('source-update-source', args=(source.pk,)) + '?async=true', {'comment': 'async update'})
+        self.assertEqual(res['status'], Job.PENDING)
+        job = Job.objects.get(pk=res['job'])
+        self.assertEqual((job.name, job.get_params()), ('update_source', {'source': source.pk, 'comment': 'async update'}))
+        # the update is only recorded once it has run
+        self.assertFalse(UserAction.objects.filter(action_type='update_source').exists())
+
+        ruleset = Ruleset.objects.create(name='test ruleset', created_date=timezone.now(), updated_date=timezone.now())
+        res = self.http_post(reverse('ruleset-test', args=(ruleset.pk,)) + '?async=true', {})
+        res = self.http_get(reverse('job-detail', args=(res['job'],)))
+        self.assertEqual((res['name'], res['status'], res['username']), ('test_ruleset', Job.PENDING, 'scirius'))
+
+        test_job = res['pk']
+        self.http_post(reverse('job-cancel', args=(test_job,)), {})
+        res = self.http_get(reverse('job-list') + '?status=cancelled')
+        self.assertEqual([entry['pk'] for entry in res['results']], [test_job])
+        self.http_post(reverse('job-cancel', args=(test_job,)), {}, status=status.HTTP_400_BAD_REQUEST)
+
+        # cancelled job is not run
+        self.runner.run_pending()
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.get_result()), (Job.SUCCESS, {'update': 'ok'}))
+        self.assertEqual(Job.objects.get(pk=test_job).started_date, None)
+        action = UserAction.objects.get(action_type='update_source')
+        self.assertEqual((action.comment, action.user.username), ('async update', 'scirius'))
+
+    def test_006_user_jobs(self):
+        other = User.objects.create(username='other', password='other')
+        own_job = Job.submit('progress', user=other, steps=1)
+        staff_job = Job.submit('progress', user=self.user, steps=1)
+        res = self.http_get(reverse('job-list'))
+        self.assertEqual([entry['pk'] for entry in res['results']], [staff_job.pk, own_job.pk])
+
+        # non-staff users can not see jobs of other users
+        self.client.force_login(other)
+        res = self.http_get(reverse('job-list'))
+        self.assertEqual([entry['pk'] for entry in res['results']], [own_job.pk])
+        self.http_get(reverse('job-detail', args=(staff_job.pk,)), status=status.HTTP_404_NOT_FOUND)
+
+    def test_007_push_refused(self):
+        from suricata.models import Suricata
+        output_dir = tempfile.mkdtemp()
+        self.addCleanup(rmtree, output_dir)
+        ruleset = Ruleset.objects.create(name='test ruleset', created_date=timezone.now(), updated_date=timezone.now())
+        Suricata.objects.create(name='probe', descr='probe', output_directory=output_dir, yaml_file='suricata.yaml',
+                                created_date=timezone.now(), updated_date=timezone.now(), ruleset=ruleset)
+        # a restart is already pending
+        open(os.path.join(output_dir, 'scirius.reload'), 'w').close()
+
+        job = Job.submit('update_push_all', user=self.user)
+        self.runner.run_pending()
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.message), (Job.FAILURE, 'Suricata restart already asked'))
+        self.assertFalse(UserAction.objects.filter(action_type='update_push_all').exists())
+
+
+class ESTransportTestCase(TestCase):
+    def setUp(self):
+        self.server = FakeESServer()
+        self.server.responses['/_cluster/health'] = {'status': 'green'}
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_001_keep_alive(self):
+        for _ in xrange(5):
+            self.assertEqual(ESQuery(None)._urlopen(self.server.url('/_cluster/health')), {'status': 'green'})
+        ESQuery(None)._urlopen(self.server.url('/_cluster/health'), '{"query": {}}')
+        # all requests on a single connection, responses are compressed
+        self.assertEqual(len(set(request[3] for request in self.server.requests)), 1)
+        self.assertEqual([request[0] for request in self.server.requests], ['GET'] * 5 + ['POST'])
+        self.assertEqual(self.server.requests[5][2], '{"query": {}}')
+        self.assertEqual(self.server.requests[0][4]['accept-encoding'], 'gzip')
+
+    def test_002_errors(self):
+        with self.assertRaises(ESError) as ctx:
+            ESQuery(None)._urlopen(self.server.url('/unknown/_search'))
+        self.assertIn('404', unicode(ctx.exception))
+
+        class SlowQuery(ESQuery):
+            TIMEOUT = 0.2
+
+        self.server.delay = 1
+        with self.assertRaises(ESError) as ctx:
+            SlowQuery(None)._urlopen(self.server.url('/_cluster/health'))
+        self.assertIn('Request timeout', unicode(ctx.exception))
+
+    def test_003_delete_alerts(self):
+        self.server.responses['/%s*/_delete_by_query' % settings.ELASTICSEARCH_LOGSTASH_ALERT_INDEX] = {'task': 'node:42'}
+        with self.settings(ELASTICSEARCH_ADDRESS='127.0.0.1:%d' % self.server.server_address[1]):
+            reset_es_address()
+            try:
+                # deletions have their own timeout
+                self.server.delay = 0.3
+                with self.settings(ELASTICSEARCH_DELETE_TIMEOUT=0.1):
+                    self.assertEqual(es_delete_alerts_by_sid_v5(1)['status'], 500)
+                self.server.delay = 0
+
+                # the deletion is run as an ES task
+                self.assertEqual(es_delete_alerts_by_sid_v5(1), {'task': 'node:42', 'status': 200})
+                self.assertIn('wait_for_completion=false', self.server.requests[-1][1])
+            finally:
+                reset_es_address()
+
+
+class FakeESTestBase(RestAPITestBase):
+    # ES address of the system settings is the fake ES server
+    TIMELINE = {'aggregations': {'date': {'buckets': [
+        {'key': 1000, 'host': {'buckets': [{'key': 'probe', 'doc_count': 3}]}}
+    ]}}}
+
+    def setUp(self):
+        super(FakeESTestBase, self).setUp()
+        get_es_query_cache().clear()
+        self.server = FakeESServer()
+        self.server.responses['/_cluster/stats'] = {'nodes': {'versions': ['6.8.0']}}
+        self.server.responses['/_cluster/health'] = {'status': 'green'}
+        self.server.handler = self._handler
+        self.count_error = False
+        self.es_settings = self.settings(ELASTICSEARCH_ADDRESS='127.0.0.1:%d' % self.server.server_address[1])
+        self.es_settings.enable()
+        reset_es_address()
+        reset_es_version()
+
+    def tearDown(self):
+        self.server.stop()
+        self.es_settings.disable()
+        reset_es_address()
+        reset_es_version()
+        get_es_query_cache().clear()
+
+    def _handler(self, method, path, body):
+        if path != '/_msearch':
+            return FakeESServer.handler(self.server, method, path, body)
+
+        lines = body.splitlines()
+        responses = []
+        for header, query in zip(lines[::2], lines[1::2]):
+            json.loads(header)
+            query = json.loads(query)
+            if 'date' in query.get('aggregations', query.get('aggs', {})):
+                responses.append(dict(self.TIMELINE, status=200))
+            elif self.count_error:
+                responses.append({'status': 400, 'error': {'type': 'parsing_exception'}})
+            else:
+                responses.append({'status': 200, 'hits': {'total': 42, 'hits': []}})
+        return 200, {'responses': responses}
+
+    def _paths(self):
+        return [request[1].split('?')[0] for request in self.server.requests]
+
+    def _search_path(self):
+        url = ESQuery(None)._get_es_url()
+        return url[len(get_es_address()) - 1:].split('?')[0]
+
+    def _request(self, **params):
+        request = HttpRequest()
+        request.GET.update(params)
+        return request
+
+
+class ESMultiSearchTestCase(FakeESTestBase, APITestCase):
+    def test_001_multi_search(self):
+        multi_search = ESMultiSearch()
+        timeline = multi_search.add(ESTimeline(None).get)
+        count = multi_search.add(ESAlertsCount(None).get)
+        health = multi_search.add(ESHealth(None).get)
+        multi_search.run()
+
+        self.assertEqual(multi_search.result(timeline)['probe'], {'entries': [{'time': 1000, 'count': 3}]})
+        self.assertEqual(multi_search.result(count), {'doc_count': 42})
+        self.assertEqual(multi_search.result(health), {'status': 'green'})
+
+        # searches are sent in a single request, health isn't a search
+        self.assertEqual(sorted(self._paths()), ['/_cluster/health', '/_cluster/stats', '/_msearch'])
+        msearch = [request for request in self.server.requests if request[1] == '/_msearch'][0]
+        self.assertEqual(msearch[4]['content-type'], 'application/x-ndjson')
+        lines = msearch[2].splitlines()
+        self.assertEqual(len(lines), 4)
+        self.assertEqual(json.loads(lines[0])['ignore_unavailable'], True)
+
+    def test_002_errors(self):
+        self.count_error = True
+        multi_search = ESMultiSearch()
+        timeline = multi_search.add(ESTimeline(None).get)
+        count = multi_search.add(ESAlertsCount(None).get)
+        multi_search.run()
+
+        self.assertIn('probe', multi_search.result(timeline))
+        with self.assertRaises(ESError) as ctx:
+            multi_search.result(count)
+        self.assertIn('parsing_exception', unicode(ctx.exception))
+
+        # the whole _msearch fails
+        get_es_query_cache().clear()
+        self.server.stop()
+        multi_search = ESMultiSearch()
+        timeline = multi_search.add(ESTimeline(None).get)
+        multi_search.run()
+        with self.assertRaises(ESError):
+            multi_search.result(timeline)
+        self.server = FakeESServer()
+
+    def test_003_rest_multi(self):
+        url = reverse('es_multi') + '?hosts=probe'
+        data = self.http_post(url, {
+            'timeline': {'widget': 'timeline'},
+            'count': {'widget': 'alerts_count'},
+            'rule': {'widget': 'rule'},
+        })
+        self.assertEqual(data['timeline']['probe'], {'entries': [{'time': 1000, 'count': 3}]})
+        self.assertEqual(data['count'], {'doc_count': 42})
+        # missing sid parameter
+        self.assertIn('sid', data['rule']['error'])
+        self.assertEqual(self._paths().count('/_msearch'), 1)
+        self.assertNotIn('/_search', ''.join(self._paths()))
+
+        self.http_post(url, {'timeline': {'widget': 'delete_logs'}}, status=status.HTTP_400_BAD_REQUEST)
+
+    def test_004_rest_multi_widgets(self):
+        class AdminCountViewSet(ESMultiViewSet.WIDGETS['alerts_count']):
+            permission_classes = (IsAdminUser,)
+
+        class BrokenViewSet(ESMultiViewSet.WIDGETS['alerts_count']):
+            def _get(self, request, format=None):
+                raise ValueError('broken widget')
+
+        widgets = ESMultiViewSet.WIDGETS
+        ESMultiViewSet.WIDGETS = dict(widgets, admin_count=AdminCountViewSet, broken=BrokenViewSet)
+        try:
+            user = User.objects.create(username='viewer', password='viewer')
+            self.client.force_login(user)
+            url = reverse('es_multi') + '?hosts=probe'
+            data = self.http_post(url, {
+                'count': {'widget': 'alerts_count'},
+                'admin_count': {'widget': 'admin_count'},
+                'broken': {'widget': 'broken'},
+            })
+        finally:
+            ESMultiViewSet.WIDGETS = widgets
+
+        # read only widgets are available to any user, failures are per widget
+        self.assertEqual(data['count'], {'doc_count': 42})
+        self.assertIn('permission', data['admin_count']['error'])
+        self.assertIn('broken widget', data['broken']['error'])
+
+
+class ESQueryCacheTestCase(FakeESTestBase, APITestCase):
+    def test_001_cache(self):
+        self.server.responses[self._search_path()] = self.TIMELINE
+        first = ESTimeline(None).get()
+        second = ESTimeline(None).get()
+        self.assertEqual(first, second)
+        self.assertEqual(self._paths().count(self._search_path()), 1)
+
+        # another query body
+        ESTimeline(self._request(qfilter='alert.severity:1')).get()
+        self.assertEqual(self._paths().count(self._search_path()), 2)
+
+        # responses of multi searches are cached
+        multi_search = ESMultiSearch()
+        multi_search.add(ESTimeline(self._request(qfilter='alert.severity:2')).get)
+        multi_search.run()
+        ESTimeline(self._request(qfilter='alert.severity:2')).get()
+        self.assertEqual(self._paths().count('/_msearch'), 1)
+        self.assertEqual(self._paths().count(self._search_path()), 2)
+
+        stats = get_es_query_cache().stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['entries']), (2, 3, 3))
+        data = self.http_get(reverse('es_query_cache'))
+        self.assertEqual(data['hits'], 2)
+
+    def test_002_timeouts(self):
+        with self.settings(ELASTICSEARCH_CACHE_LIVE_TIMEOUT=30, ELASTICSEARCH_CACHE_LIVE_DELAY=300,
+                           ELASTICSEARCH_CACHE_TIMEOUT=3600):
+            now = int(time.time() * 1000)
+            self.assertEqual(ESQuery(None)._cache_timeout(), 30)
+            self.assertEqual(ESQuery(self._request(to_date='now'))._cache_timeout(), 30)
+            self.assertEqual(ESQuery(self._request(to_date=now - 60 * 1000))._cache_timeout(), 30)
+            self.assertEqual(ESQuery(self._request(to_date=now - 3600 * 1000))._cache_timeout(), 3600)
+
+            # now is rounded for queries of windows ending now to be the same
+            self.assertEqual(ESQuery(None)._now() % (30 * 1000), 0)
+
+    def test_003_memory_bound(self):
+        query_cache = ESQueryCache(25)
+        query_cache.set('first', '"0123456789"', 60)
+        query_cache.set('second', '"0123456789"', 60)
+        self.assertEqual(query_cache.get('first'), '0123456789')
+        query_cache.set('third', '"0123456789"', 60)
+        # least recently used is evicted
+        self.assertEqual(query_cache.get('second'), None)
+        self.assertEqual(query_cache.get('first'), '0123456789')
+        query_cache.set('big', '"%s"' % ('x' * 30), 60)
+        self.assertEqual(query_cache.get('big'), None)
+
+        query_cache.set('expired', '"0"', 0.01)
+        time.sleep(0.02)
+        self.assertEqual(query_cache.get('expired'), None)
+
+        stats = query_cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['evictions']), (2, 3, 2))
+        self.assertLessEqual(stats['size'], 25)
+
+
+class ESQueryTemplateTestCase(FakeESTestBase, APITestCase):
+    def test_001_escaping(self):
+        request = self._request(hosts='probe,pro"be\\1', qfilter='alert.signature:"ET \\ POLICY"')
+        data = ESQuery(request)._render_template(get_top_query(), {'count': 5, 'field': 'src_ip"}', 'sid': 1})
+        query = json.loads(bytes(data).decode('utf-8'))
+        self.assertEqual(query['aggs']['table']['terms']['field'], 'src_ip"}')
+        query_string = query['query']['bool']['must'][0]['query_string']['query']
+        self.assertIn('(host.raw:"probe" host.raw:"pro\\"be\\\\1")', query_string)
+        self.assertIn('AND alert.signature:"ET \\ POLICY"', query_string)
+
+    def test_002_sids(self):
+        self.server.responses[self._search_path()] = {'aggregations': {'alerts': {'buckets': []}}}
+        ESSigsListHits(None).get('2000000,2000001')
+        query = json.loads(self.server.requests[-1][2])
+        self.assertEqual(query['query']['bool']['must'][2]['constant_score']['filter']['terms'],
+                         {'alert.signature_id': [2000000, 2000001]})
+        self.assertEqual(query['aggs']['alerts']['terms']['size'], 2)
+
+        with self.assertRaises(ValueError):
+            ESSigsListHits(None).get('1]}}, {"match_all": {}')
+
+        url = reverse('es_sigs_list') + '?hosts=probe&sids=1%5D%7D'
+        data = self.http_get(url, status=status.HTTP_400_BAD_REQUEST)
+        self.assertIn('sids', data)
+
+    def test_003_compiled_once(self):
+        self.assertIs(get_query_template(get_top_query()), get_query_template(get_top_query()))
+
+    def test_004_version_retry(self):
+        del self.server.responses['/_cluster/stats']
+        self.assertEqual(get_es_major_version(), 6)
+        self.assertEqual(get_es_major_version(), 6)
+        # ES is not requested again for each query
+        self.assertEqual(self._paths(), ['/_cluster/stats'])
+
+        self.server.responses['/_cluster/stats'] = {'nodes': {'versions': ['5.6.0']}}
+        reset_es_version()
+        self.assertEqual(get_es_major_version(), 5)
+
+
+class ESRulesStatsTestCase(FakeESTestBase, APITestCase):
+    def test_001_rules_stats(self):
+        source = Source.objects.create(name='stats source', method='local', datatype='sigs', created_date=timezone.now())
+        category = Category.objects.create(name='stats category', filename='stats', source=source)
+        for sid in (1, 2):
+            Rule.objects.create(sid=sid, category=category, msg='stats rule %d' % sid, content='alert ip any any -> any any (sid:%d;)' % sid)
+        self.server.responses[self._search_path()] = {'aggregations': {'table': {'buckets': [
+            {'key': 2, 'doc_count': 5}, {'key': 3, 'doc_count': 4}, {'key': 1, 'doc_count': 2}
+        ]}}}
+        get_es_major_version()
+
+        with self.assertNumQueries(1):
+            rules = ESRulesStats(self._request()).get()
+        self.assertEqual([(rule.sid, rule.hits) for rule in rules.data.data], [(2, 5), (1, 2)])
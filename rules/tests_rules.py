@@ -19,17 +19,295 @@ along with Scirius.  If not, see <http://www.gnu.org/licenses/>.
 """
 
 from __future__ import unicode_literals
+from collections import OrderedDict
 import psutil
 import subprocess
 import tempfile
+import threading
+import Queue
+import hashlib
+import atexit
 import shutil
+import sys
 import os
 import json
 import StringIO
 import re
+import yaml
 
+from django.conf import settings
+from django.core.cache import cache
 from django.utils.html import escape
 
+
+class TestSandbox(object):
+    # Directory with the configuration and related files of a test. Only the
+    # rules file and the log directory are specific to each run, so the
+    # sandbox is shared by all tests using the same files.
+    def __init__(self, config_buffer, related_files, reference_config, classification_config, iprep_files=None):
+        self.directory = tempfile.mkdtemp()
+        self.users = 0
+        try:
+            self._write('reference.config', reference_config)
+            self._write('classification.config', classification_config)
+
+            self.config_file = self._write('suricata.yaml', config_buffer)
+            with open(self.config_file, 'a') as cf:
+                cf.write("mpm-algo: ac-bs\n")
+                cf.write("default-rule-path: " + self.directory + "\n")
+                cf.write("reference-config-file: " + self.directory + "/reference.config\n")
+                cf.write("classification-file: " + self.directory + "/classification.config\n")
+                cf.write("reputation-categories-file: " + self.directory + "/scirius-categories.txt\n")
+                cf.write("default-reputation-path: " + self.directory + "\n")
+                cf.write("""reputation-files:
+  - scirius-iprep.list
+""")
+
+            for rfile in related_files:
+                self._write(rfile, related_files[rfile])
+
+            from rules.models import export_iprep_files
+            export_iprep_files(self.directory, iprep_files)
+        except:
+            self.close()
+            raise
+
+    def _write(self, filename, content):
+        path = os.path.join(self.directory, filename)
+        with open(path, 'w') as f:
+            try:
+                f.write(content)
+            except UnicodeEncodeError:
+                f.write(content.encode('utf-8'))
+        return path
+
+    def run(self, rule_buffer):
+        run_dir = tempfile.mkdtemp(dir=self.directory)
+        try:
+            rule_file = os.path.join(run_dir, 'file.rules')
+            with open(rule_file, 'w') as rf:
+                try:
+                    rf.write(rule_buffer)
+                except UnicodeEncodeError:
+                    rf.write(rule_buffer.encode('utf-8'))
+
+            suri_cmd = [settings.SURICATA_BINARY, '-T', '-l', run_dir, '-S', rule_file, '-c', self.config_file]
+            # start suricata in test mode
+            suriprocess = subprocess.Popen(suri_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            (outdata, errdata) = suriprocess.communicate()
+        finally:
+            shutil.rmtree(run_dir)
+        # if success ok
+        if suriprocess.returncode == 0:
+            return {'status': True, 'errors': ''}
+        # if not return error
+        return {'status': False, 'errors': errdata}
+
+    def close(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+class TestJob(object):
+    def __init__(self, sandbox, rule_buffer):
+        self.sandbox = sandbox
+        self.rule_buffer = rule_buffer
+        self.done = threading.Event()
+        self.value = None
+        self.exc_info = None
+
+    def result(self):
+        self.done.wait()
+        if self.exc_info:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.value
+
+
+class TestSandboxPool(object):
+    # Suricata tests are run by worker threads, each one waiting for its
+    # suricata process, so tests run concurrently on several cores. Pending
+    # tests are limited by a bounded queue, callers block when it is full.
+    # Sandboxes are kept by content of their files, the least recently used
+    # ones are removed once max_sandboxes is reached.
+    def __init__(self, workers, queue_size, max_sandboxes):
+        self.workers = workers
+        self.max_sandboxes = max_sandboxes
+        self.queue = Queue.Queue(maxsize=queue_size)
+        self.sandboxes = OrderedDict()
+        self.lock = threading.Lock()
+        self.threads = []
+
+    def _start(self):
+        # called with lock held
+        while len(self.threads) < self.workers:
+            thread = threading.Thread(target=self._work, name='suricata-test-%d' % len(self.threads))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def _work(self):
+        while True:
+            job = self.queue.get()
+            try:
+                job.value = job.sandbox.run(job.rule_buffer)
+            except:
+                job.exc_info = sys.exc_info()
+            finally:
+                self._release(job.sandbox)
+                job.done.set()
+                self.queue.task_done()
+
+    @staticmethod
+    def _key(*files, **kwargs):
+        # ip reputation files exported from the group rules are part of
+        # the key, iprep_files is given when they were already generated
+        from rules.models import get_iprep_files
+        iprep_files = kwargs.get('iprep_files')
+        if iprep_files is None:
+            iprep_files = get_iprep_files()
+        digest = hashlib.sha256()
+        for content in files + (sorted(iprep_files.items()),):
+            digest.update(repr(content).encode('utf-8'))
+        return digest.hexdigest()
+
+    def _acquire(self, config_buffer, related_files, reference_config, classification_config):
+        from rules.models import get_iprep_files
+        related_files = sorted(related_files.items())
+        iprep_files = get_iprep_files()
+        key = self._key(config_buffer, related_files, reference_config, classification_config, iprep_files=iprep_files)
+        with self.lock:
+            sandbox = self.sandboxes.pop(key, None)
+            if sandbox is not None:
+                self.sandboxes[key] = sandbox
+                sandbox.users += 1
+                return sandbox
+
+        sandbox = TestSandbox(config_buffer, dict(related_files), reference_config, classification_config, iprep_files)
+        with self.lock:
+            if key in self.sandboxes:
+                # created concurrently
+                sandbox.close()
+                sandbox = self.sandboxes.pop(key)
+            self.sandboxes[key] = sandbox
+            sandbox.users += 1
+            self._evict()
+        return sandbox
+
+    def _evict(self):
+        # called with lock held, sandboxes in use are kept
+        unused = [key for key, sandbox in self.sandboxes.iteritems() if sandbox.users == 0]
+        for key in unused[:max(len(self.sandboxes) - self.max_sandboxes, 0)]:
+            self.sandboxes.pop(key).close()
+
+    def _release(self, sandbox):
+        with self.lock:
+            sandbox.users -= 1
+            if sandbox.users == 0 and sandbox not in self.sandboxes.values():
+                sandbox.close()
+            self._evict()
+
+    def submit(self, rule_buffer, config_buffer, related_files, reference_config, classification_config):
+        sandbox = self._acquire(config_buffer, related_files, reference_config, classification_config)
+        job = TestJob(sandbox, rule_buffer)
+        with self.lock:
+            self._start()
+        try:
+            self.queue.put(job)
+        except:
+            self._release(sandbox)
+            raise
+        return job
+
+    def close(self):
+        with self.lock:
+            for sandbox in self.sandboxes.values():
+                if sandbox.users == 0:
+                    sandbox.close()
+            self.sandboxes.clear()
+
+
+_test_pool = None
+_test_pool_lock = threading.Lock()
+
+
+def get_test_pool():
+    global _test_pool
+    with _test_pool_lock:
+        if _test_pool is None:
+            _test_pool = TestSandboxPool(settings.SURICATA_TEST_WORKERS, settings.SURICATA_TEST_QUEUE_SIZE,
+                                         settings.SURICATA_TEST_SANDBOXES)
+            atexit.register(_test_pool.close)
+        return _test_pool
+
+
+class TestResultsCache(object):
+    # Results of tests by digest of the tested rules, configuration and
+    # files. Most recently used results are kept in memory up to max_size
+    # bytes, all results are shared with other processes through the Django
+    # cache.
+    CACHE_PREFIX = 'suricata_test_result'
+
+    def __init__(self, max_size, timeout):
+        self.max_size = max_size
+        self.timeout = timeout
+        self.size = 0
+        self.results = OrderedDict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(rule_buffer, config_buffer, related_files, single):
+        # result depends on the suricata version, which is not known without
+        # running it: binary path is used instead
+        return TestSandboxPool._key(settings.SURICATA_BINARY, single, rule_buffer, config_buffer,
+                                    sorted(related_files.items()))
+
+    def _store(self, key, data):
+        with self.lock:
+            previous = self.results.pop(key, None)
+            if previous is not None:
+                self.size -= len(previous)
+            if len(data) > self.max_size:
+                return
+            self.results[key] = data
+            self.size += len(data)
+            while self.size > self.max_size:
+                _, evicted = self.results.popitem(last=False)
+                self.size -= len(evicted)
+
+    def get(self, key):
+        # results are stored serialized, so callers get their own copy
+        with self.lock:
+            data = self.results.pop(key, None)
+            if data is not None:
+                self.results[key] = data
+        if data is None:
+            data = cache.get('%s:%s' % (self.CACHE_PREFIX, key))
+            if data is None:
+                return None
+            self._store(key, data)
+        return json.loads(data)
+
+    def set(self, key, result):
+        data = json.dumps(result)
+        cache.set('%s:%s' % (self.CACHE_PREFIX, key), data, self.timeout)
+        self._store(key, data)
+
+    def clear(self):
+        with self.lock:
+            self.results.clear()
+            self.size = 0
+
+
+_test_results = None
+_test_results_lock = threading.Lock()
+
+
+def get_test_results_cache():
+    global _test_results
+    with _test_results_lock:
+        if _test_results is None:
+            _test_results = TestResultsCache(settings.SURICATA_TEST_CACHE_SIZE, settings.SURICATA_TEST_CACHE_TIMEOUT)
+        return _test_results
+
 class TestRules():
     VARIABLE_ERROR = 101
     OPENING_RULE_FILE = 41 # Error when opening a file referenced in the source
@@ -142,6 +420,58 @@ config classification: policy-violation,Potential Corporate Privacy Violation,1
 config classification: default-login-attempt,Attempt to login by a default username and password,2
 """
 
+    VARIABLE_REGEXP = re.compile(r'!?\$([A-Za-z_][A-Za-z0-9_]*)')
+    # (config_buffer, variables) of the last parsed configuration, replaced
+    # as a whole so that concurrent tests always read a consistent pair
+    _config_variables = (None, None)
+
+    def get_config_variables(self, config_buffer):
+        # address and port groups defined in configuration, None if it
+        # can't be parsed
+        memo_buffer, variables = TestRules._config_variables
+        if memo_buffer == config_buffer:
+            return variables
+
+        try:
+            config = yaml.safe_load(config_buffer)
+            variables = set()
+            for group in ('address-groups', 'port-groups'):
+                variables.update(config['vars'][group] or {})
+        except (yaml.YAMLError, KeyError, TypeError):
+            variables = None
+        TestRules._config_variables = (config_buffer, variables)
+        return variables
+
+    def resolve_variables(self, rule_buffer, config_buffer):
+        # Variables of rules headers that are not defined in configuration
+        # are replaced by "any" in a single pass, so suricata does not need
+        # to be run again for each of them
+        variables = self.get_config_variables(config_buffer)
+        if variables is None or '$' not in rule_buffer:
+            return rule_buffer, []
+
+        unknown = []
+
+        def replace(match):
+            var = match.group(1)
+            if var in variables:
+                return match.group(0)
+            if var not in unknown:
+                unknown.append(var)
+            return 'any'
+
+        lines = []
+        for line in rule_buffer.splitlines(True):
+            if '$' in line and not line.lstrip().startswith('#'):
+                header, sep, options = line.partition('(')
+                line = self.VARIABLE_REGEXP.sub(replace, header) + sep + options
+            lines.append(line)
+
+        warnings = [{'error_code': self.VARIABLE_ERROR, 'error': 'SC_ERR_UNDEFINED_VAR',
+                     'message': "Custom address variable \"$%s\" is used and need to be defined in probes configuration" % var}
+                    for var in unknown]
+        return ''.join(lines), warnings
+
     def parse_suricata_error(self, error, single = False):
         ret = {
             'errors': [],
@@ -203,69 +533,17 @@ config classification: default-login-attempt,Attempt to login by a default usern
                     ret['errors'].append(s_err['engine'])
         return ret
 
-    def rule_buffer(self, rule_buffer, config_buffer = None, related_files = None, reference_config = None, classification_config = None):
-        # create temp directory
-        tmpdir = tempfile.mkdtemp()
-        # write the rule file in temp dir
-        rule_file = os.path.join(tmpdir, "file.rules")
-        rf = open(rule_file, 'w')
-        try:
-            rf.write(rule_buffer)
-        except UnicodeEncodeError:
-            rf.write(rule_buffer.encode('utf-8'))
-        rf.close()
-
-        if not reference_config:
-            refence_config = self.REFERENCE_CONFIG
-        reference_file = os.path.join(tmpdir, "reference.config")
-        rf = open(reference_file, 'w')
-        rf.write(refence_config)
-        rf.close()
-
-        if not classification_config:
-            classification_config = self.CLASSIFICATION_CONFIG
-        classification_file = os.path.join(tmpdir, "classification.config")
-        cf = open(classification_file, 'w')
-        cf.write(classification_config)
-        cf.close()
-
-        if not config_buffer:
-            config_buffer = self.CONFIG_FILE
-        config_file = os.path.join(tmpdir, "suricata.yaml")
-        cf = open(config_file, 'w')
-        # write the config file in temp dir
-        cf.write(config_buffer)
-        cf.write("mpm-algo: ac-bs\n")
-        cf.write("default-rule-path: " + tmpdir + "\n")
-        cf.write("reference-config-file: " + tmpdir + "/reference.config\n")
-        cf.write("classification-file: " + tmpdir + "/classification.config\n")
-        cf.write("reputation-categories-file: " + tmpdir + "/scirius-categories.txt\n")
-        cf.write("default-reputation-path: " + tmpdir + "\n")
-        cf.write("""reputation-files:
-  - scirius-iprep.list
-""")
+    def submit_rule_buffer(self, rule_buffer, config_buffer = None, related_files = None, reference_config = None, classification_config = None):
+        return get_test_pool().submit(rule_buffer,
+                                      config_buffer or self.CONFIG_FILE,
+                                      related_files or {},
+                                      reference_config or self.REFERENCE_CONFIG,
+                                      classification_config or self.CLASSIFICATION_CONFIG)
 
-        cf.close()
-        related_files = related_files or {}
-        for rfile in related_files:
-            related_file = os.path.join(tmpdir, rfile)
-            rf = open(related_file, 'w')
-            rf.write(related_files[rfile])
-            rf.close()
-
-        from rules.models import export_iprep_files
-        export_iprep_files(tmpdir)
-            
-        suri_cmd = ['suricata', '-T', '-l', tmpdir, '-S', rule_file, '-c', config_file]
-        # start suricata in test mode
-        suriprocess = subprocess.Popen(suri_cmd , stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        (outdata, errdata) = suriprocess.communicate()
-        shutil.rmtree(tmpdir)
-        # if success ok
-        if suriprocess.returncode == 0:
-            return {'status': True, 'errors': ''}
-        # if not return error
-        return {'status': False, 'errors': errdata}
+    def rule_buffer(self, rule_buffer, config_buffer = None, related_files = None, reference_config = None, classification_config = None):
+        job = self.submit_rule_buffer(rule_buffer, config_buffer = config_buffer, related_files = related_files,
+                                      reference_config = reference_config, classification_config = classification_config)
+        return job.result()
 
     def _escape_result(self, res):
         for key in ('warnings', 'errors'):
@@ -276,12 +554,23 @@ config classification: default-login-attempt,Attempt to login by a default usern
 
     def check_rule_buffer(self, rule_buffer, config_buffer = None, related_files = None, single = False):
         related_files = related_files or {}
+        results = get_test_results_cache()
+        key = results.key(rule_buffer, config_buffer or self.CONFIG_FILE, related_files, single)
+        result = results.get(key)
+        if result is None:
+            result = self._check_rule_buffer(rule_buffer, config_buffer = config_buffer, related_files = related_files, single = single)
+            results.set(key, result)
+        return result
+
+    def _check_rule_buffer(self, rule_buffer, config_buffer = None, related_files = None, single = False):
+        rule_buffer, warnings = self.resolve_variables(rule_buffer, config_buffer or self.CONFIG_FILE)
         prov_result = self.rule_buffer(rule_buffer, config_buffer = config_buffer, related_files = related_files)
-        if prov_result['status'] and not prov_result.has_key('warnings'):
+        if prov_result['status'] and not warnings:
             return self._escape_result(prov_result)
         res = self.parse_suricata_error(prov_result['errors'], single = single)
         prov_result['errors'] = res['errors']
-        prov_result['warnings'] = res['warnings']
+        prov_result['warnings'] = warnings + res['warnings']
+        # variables that were not found by resolve_variables
         i = 6 # support only 6 unknown variables per rule
         prov_result['iter'] = 0;
         while len(res['warnings']) and i > 0:
@@ -20,7 +20,7 @@ along with Scirius.  If not, see <http://www.gnu.org/licenses/>.
 from __future__ import unicode_literals
 from django.shortcuts import render, get_object_or_404, redirect
 from django.utils import timezone
-from django.http import HttpResponse, HttpResponseServerError
+from django.http import HttpResponse, HttpResponseServerError, StreamingHttpResponse
 from django.db import IntegrityError
 from django.conf import settings
 from elasticsearch.exceptions import ConnectionError
@@ -31,7 +31,7 @@ import requests
 from scirius.utils import scirius_render, scirius_listing
 
 from rules.es_data import ESData
-from rules.models import Ruleset, Source, SourceUpdate, Category, Rule, dependencies_check, get_system_settings, Threshold, Transformation, CategoryTransformation, RulesetTransformation, UserAction, UserActionObject, reset_es_address
+from rules.models import Ruleset, Source, SourceUpdate, Category, Rule, dependencies_check, get_system_settings, Threshold, Transformation, CategoryTransformation, RulesetTransformation, UserAction, UserActionObject, reset_es_address, FlowbitGraph
 from rules.tables import UpdateRuleTable, DeletedRuleTable, ThresholdTable, HistoryTable
 
 from rules.es_graphs import (ESError, ESRulesStats, ESFieldStatsAsTable, ESSidByHosts, ESIndices, ESDeleteAlertsBySid,
@@ -681,8 +681,9 @@ def switch_rule(request, rule_id, operation = 'disable'):
 
     context = { 'rule': rule_object, 'form': form }
     rulesets = Ruleset.objects.all()
+    flowbit_graph = FlowbitGraph()
     for ruleset in rulesets:
-        ruleset.deps_rules = rule_object.get_dependant_rules(ruleset)
+        ruleset.deps_rules = rule_object.get_dependant_rules(ruleset, flowbit_graph = flowbit_graph)
     context['rulesets'] = rulesets
     context['operation'] = operation
     return scirius_render(request, 'rules/disable_rule.html', context)
@@ -1346,8 +1347,7 @@ def ruleset(request, ruleset_id, mode = 'struct', error = None):
         if error:
             context['error'] = error
     elif mode == 'export':
-        file_content = ruleset.to_buffer()
-        response = HttpResponse(file_content, content_type="text/plain")
+        response = StreamingHttpResponse(ruleset.iter_buffer(), content_type="text/plain")
         response['Content-Disposition'] = 'attachment; filename=scirius.rules'
         return response
 
@@ -1619,9 +1619,10 @@ def ruleset_add_supprule(request, ruleset_id):
             form = CommentForm(request.POST)
             if not form.is_valid():
                 return redirect(ruleset)
+            flowbit_graph = FlowbitGraph()
             for rule in request.POST.getlist('rule_selection'):
                 rule_object = get_object_or_404(Rule, pk=rule)
-                rule_object.disable(ruleset, user = request.user, comment = form.cleaned_data['comment'])
+                rule_object.disable(ruleset, user = request.user, comment = form.cleaned_data['comment'], flowbit_graph = flowbit_graph)
             ruleset.save()
         return redirect(ruleset)
 
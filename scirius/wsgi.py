@@ -13,3 +13,7 @@ os.environ.setdefault("DJANGO_SETTINGS_MODULE", "scirius.settings")
 
 from django.core.wsgi import get_wsgi_application
 application = get_wsgi_application()
+
+# Run background jobs in the web processes, see JOBS_WORKERS
+from rules.jobs import get_job_runner
+get_job_runner().start()
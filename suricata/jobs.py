@@ -0,0 +1,40 @@
+"""
+Copyright(C) 2018 Stamus Networks
+
+This file is part of Scirius.
+
+Scirius is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+Scirius is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Scirius.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from __future__ import unicode_literals
+from django.utils import timezone
+
+from rules.models import UserAction
+from suricata.models import Suricata
+
+
+def update_push_all(job, comment=None):
+    suri = Suricata.objects.first()
+    job.set_progress(0, 'Updating sources of ruleset "%s"' % suri.ruleset.name)
+    suri.ruleset.update()
+    job.set_progress(60, 'Generating rules')
+    suri.generate()
+    job.set_progress(90, 'Pushing rules')
+    ret = suri.push()
+    suri.updated_date = timezone.now()
+    suri.save()
+    if not ret:
+        raise Exception('Suricata restart already asked')
+    UserAction.create(action_type='update_push_all', user=job.user, ruleset=suri.ruleset, comment=comment)
+    return {'update_push_all': 'ok'}
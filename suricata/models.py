@@ -53,16 +53,16 @@ class Suricata(models.Model):
     def generate(self):
         # FIXME extract archive file for sources
         # generate rule file
-        rules = self.ruleset.to_buffer()
         # write to file
         with open(self.output_directory + "/" + "scirius.rules", 'w') as rfile:
-            rfile.write(rules.encode('utf-8'))
+            for data in self.ruleset.iter_buffer():
+                rfile.write(data)
         # export files at version
         self.ruleset.export_files(self.output_directory)
         # FIXME gruick
         with open(self.output_directory + "/" + "rules.json", 'w') as rfile:
-            for rule in Rule.objects.all():
-                dic = {'sid': rule.pk, 'created': unicode(rule.created), 'updated': unicode(rule.updated)}
+            for sid, created, updated in Rule.objects.values_list('pk', 'created', 'updated').iterator():
+                dic = {'sid': sid, 'created': unicode(created), 'updated': unicode(updated)}
                 rfile.write(json.dumps(dic) + '\n')
         # Export IPrep
         export_iprep_files(self.output_directory)
@@ -7,8 +7,8 @@ from suricata.models import Suricata
 from rest_framework.decorators import list_route
 from django.utils import timezone
 
-from rules.models import UserAction
-from rules.rest_api import CommentSerializer
+from rules.models import UserAction, Job
+from rules.rest_api import CommentSerializer, is_async_request
 
 
 class SuricataViewSet(APIView):
@@ -22,11 +22,26 @@ class SuricataViewSet(APIView):
         HTTP/1.1 200 OK
         {"update_push_all":"ok"}
 
+    Update and Push ruleset in a background job:\n
+        curl -v -k https://x.x.x.x/rest/suricata/update_push_all/\\?async=true  -H 'Authorization: Token <token>' -H 'Content-Type: application/json'  -X POST
+
+    Return:\n
+        HTTP/1.1 200 OK
+        {"job":42,"status":"pending"}
+
     =============================================================================================================================================================
     """
 
     def post(self, request, format=None):
         suri = Suricata.objects.first()
+        if is_async_request(request):
+            comment = request.data.get('comment', None)
+            comment_serializer = CommentSerializer(data={'comment': comment})
+            comment_serializer.is_valid(raise_exception=True)
+            # the user action is recorded by the job once the push succeeded
+            job = Job.submit('update_push_all', user=request.user, comment=comment_serializer.validated_data['comment'])
+            return Response({'job': job.pk, 'status': job.status})
+
         try:
             suri.ruleset.update()
         except IOError as e: